@@ -1,15 +1,23 @@
 #!/usr/bin/python
 """
-This script takes as input a URL and checks with wget if it can be accessed,
-with mail notifications when the site goes up or down.
+This script takes as input a URL and checks if it can be accessed, either
+in-process or with wget, with mail notifications when the site goes up or down.
 """
 
+from array import array
 from optparse import OptionParser
+import bisect
+import calendar
 import datetime
+import errno
+import heapq
+import importlib
+import io
 import os
 import re
+import signal
+import socket
 import stat
-import subprocess
 import sys
 import threading
 import time
@@ -25,78 +33,625 @@ try:
 except ImportError:
     import ConfigParser as configparser
 
+try:
+    from urllib.parse import urljoin, urlsplit
+except ImportError:
+    from urlparse import urljoin, urlsplit
+
+# How the config files spell booleans, Python 2 keeps the map private
+BOOLEAN_STATES = getattr(configparser.RawConfigParser, "BOOLEAN_STATES",
+                         getattr(configparser.RawConfigParser, "_boolean_states", None))
+
+# Byte range locks, without them every run owns all sites
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class LazyModule(object):
+    """A module that is imported the first time one of its attributes is used. Most runs
+    only need a few of the heavy modules, quick commands like -l need none of them. The
+    other names are tried in order if the first can not be imported, for Python 2."""
+
+    def __init__(self, *names):
+        self.__names = names
+        self.__module = None
+
+    def load(self):
+        if self.__module is None:
+            for name in self.__names[:-1]:
+                try:
+                    self.__module = importlib.import_module(name)
+                    return self.__module
+                except ImportError:
+                    pass
+            self.__module = importlib.import_module(self.__names[-1])
+        return self.__module
+
+    def available(self):
+        try:
+            self.load()
+        except ImportError:
+            return False
+        return True
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
 
-import smtplib
-from email.mime.text import MIMEText
+
+asyncio = LazyModule("asyncio")
+futures = LazyModule("concurrent.futures")
+hashlib = LazyModule("hashlib")
+httplib = LazyModule("http.client", "httplib")
+httpserver = LazyModule("http.server", "BaseHTTPServer")
+json = LazyModule("json")
+mimetext = LazyModule("email.mime.text")
+smtplib = LazyModule("smtplib")
+sqlite3 = LazyModule("sqlite3")
+ssl = LazyModule("ssl")
+subprocess = LazyModule("subprocess")
 
 
 class SiteThread(threading.Thread):
     """Manages one site in a thread"""
 
     results_queue = queue.PriorityQueue()
+    # Gets told when checks start and finish, used for strict ordering
+    observer = None
 
-    def __init__(self, site):
+    def __init__(self, site, limiter=None):
         threading.Thread.__init__(self)
         self.__site = site
+        self.__limiter = limiter
 
     def run(self):
-        self.__site.get_res()
-        SiteThread.results_queue.put(self.__site)
+        SiteThread.check(self.__site, self.__limiter)
+
+    @staticmethod
+    def check(site, limiter=None):
+        if limiter is None:
+            site.get_res()
+        else:
+            # Wait for a free slot on the host of the site before the check starts
+            key = limiter.key(site)
+            limiter.acquire(key)
+            try:
+                site.get_res()
+            finally:
+                limiter.release(key)
+        SiteThread.finished(site)
+
+    @staticmethod
+    def work(jobs, limiter=None):
+        """Check the sites put on the jobs queue until None is put"""
+        while True:
+            site = jobs.get()
+            if site is None:
+                return
+            SiteThread.check(site, limiter)
+
+    @staticmethod
+    def started(site):
+        observer = SiteThread.observer
+        if observer is not None:
+            observer.site_started(site)
+
+    @staticmethod
+    def finished(site):
+        """Publish the result of a finished check, unless it was cancelled"""
+        if not site.end_check():
+            return
+        SiteThread.results_queue.put(site)
+        observer = SiteThread.observer
+        if observer is not None:
+            observer.site_finished(site)
 
     def get_site(self):
         return self.__site
 
 
-class Site(object):
-    """Class that handles one site to check"""
+class AsyncRunner(threading.Thread):
+    """Runs the checks of all sites on one asyncio event loop, at most concurrency at the same time.
+    The results are put on the same queue as the results of SiteThread. A persistent runner keeps
+    the loop running when idle so more sites can be submitted, until stop() is called. With a
+    HostLimiter sites whose host is busy wait aside so they do not hold up other hosts."""
+
+    def __init__(self, alive, sites, concurrency, persistent=False, limiter=None):
+        threading.Thread.__init__(self)
+        self.__alive = alive
+        self.__pending = list(reversed(sites))
+        self.__concurrency = concurrency
+        self.__persistent = persistent
+        self.__limiter = limiter
+        # Sites waiting for their host, key -> list
+        self.__waiting = {}
+        self.__running = 0
+        self.__loop = asyncio.new_event_loop()
+        self.__executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+        # loop.create_future is not in Python 3.4
+        self.__done = asyncio.Future(loop=self.__loop)
+
+    def run(self):
+        self.__loop.call_soon(self.fill)
+        try:
+            self.__loop.run_until_complete(self.__done)
+        finally:
+            self.__executor.shutdown()
+            self.__loop.close()
+
+    def submit(self, sites):
+        """Queue more sites for checking, can be called from any thread"""
+        self.__loop.call_soon_threadsafe(self.add, list(sites))
+
+    def add(self, sites):
+        self.__pending[:0] = reversed(sites)
+        self.fill()
+
+    def stop(self):
+        self.__loop.call_soon_threadsafe(self.finish)
+
+    def cancel(self):
+        """Drop the sites that have not started, can be called from any thread"""
+        try:
+            self.__loop.call_soon_threadsafe(self.drop)
+        except RuntimeError:
+            # The loop is already closed
+            pass
+
+    def drop(self):
+        del self.__pending[:]
+        self.__waiting.clear()
+        self.fill()
+
+    def finish(self):
+        if not self.__done.done():
+            self.__done.set_result(None)
+
+    def fill(self):
+        """Start checks until the concurrency limit is reached"""
+        while self.__pending and self.__running < self.__concurrency:
+            site = self.__pending.pop()
+            if self.__limiter is not None:
+                key = self.__limiter.key(site)
+                if not self.__limiter.try_acquire(key):
+                    self.__waiting.setdefault(key, []).append(site)
+                    continue
+            self.__running += 1
+            site.start_check()
+            future = self.__alive.get_probe(site.get_probe_type()).check_async(self.__loop, self.__executor, site)
+            future.add_done_callback(lambda done, site=site: self.finished(site, done))
+        if not self.__running and not self.__persistent:
+            self.finish()
+
+    def finished(self, site, future):
+        self.__running -= 1
+        if self.__limiter is not None:
+            key = self.__limiter.key(site)
+            self.__limiter.release(key)
+            waiting = self.__waiting.get(key)
+            if waiting:
+                # Next in line for the host
+                self.__pending.append(waiting.pop(0))
+                if not waiting:
+                    del self.__waiting[key]
+        try:
+            res = future.result()
+        except Exception as err:  # pylint: disable=W0703
+            self.__alive.write_warn("check of %s failed: %s\n" % (site.get_url(), err))
+            res = Result.GENERIC
+        site.set_res(res)
+        SiteThread.finished(site)
+        self.fill()
+
+
+class RunningChecks(object):
+    """The sockets and child processes of running checks, so a check can be cancelled from
+    another thread. Checks are run by call() and the probes add what they open, cancelling
+    shuts the sockets down, kills the processes and calls the callables. A site stays known
+    until the thread checking it is done() with it, so the result of a cancelled check is
+    dropped even when it comes in after the run that cancelled it."""
+
+    # The (running checks, site) of the check done by the current thread
+    current = threading.local()
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # id(site) -> list of handles, None once cancelled
+        self.__checks = {}
+        # id(site) -> site for the cancelled sites, so their ids are not reused while known
+        self.__cancelled = {}
+
+    def track(self, site):
+        """From now on the check of the site can be cancelled, even before it is entered"""
+        with self.__lock:
+            self.__checks.setdefault(id(site), [])
+
+    def forget(self, site):
+        with self.__lock:
+            self.__checks.pop(id(site), None)
+            self.__cancelled.pop(id(site), None)
+
+    def done(self, site):
+        """The thread of the check is done with the site, returns False if the check was
+        cancelled and its result must not be used"""
+        with self.__lock:
+            handles = self.__checks.pop(id(site), [])
+            self.__cancelled.pop(id(site), None)
+        return handles is not None
+
+    def call(self, site, check):
+        """Returns check(site) run as the check of the site in this thread, the result of a
+        cancelled check that failed is Result.GENERIC"""
+        self.track(site)
+        RunningChecks.current.check = (self, site)
+        try:
+            return check(site)
+        except Exception:
+            if self.is_cancelled(site):
+                return Result.GENERIC
+            raise
+        finally:
+            RunningChecks.current.check = None
+
+    def is_cancelled(self, site):
+        with self.__lock:
+            return id(site) in self.__checks and self.__checks[id(site)] is None
+
+    def cancel(self, *sites):
+        """Cancel the checks of the sites. All are marked before any is aborted, so a check
+        ending does not let another one that waits for it start."""
+        handles = []
+        with self.__lock:
+            for site in sites:
+                if id(site) in self.__checks:
+                    handles += self.__checks[id(site)] or []
+                    self.__checks[id(site)] = None
+                    self.__cancelled[id(site)] = site
+        for handle in handles:
+            self.abort(handle)
+
+    def add(self, site, handle):
+        """Add a socket, process or callable of the check, if it is already cancelled the
+        handle is aborted and socket.error raised"""
+        with self.__lock:
+            handles = self.__checks.get(id(site), [])
+            if handles is not None:
+                handles.append(handle)
+                return
+        self.abort(handle)
+        raise socket.error(errno.ECANCELED, "Check cancelled")
+
+    def remove(self, site, handle):
+        """Take back a handle the check hands on, like a connection going back to the pool.
+        Returns False if the check was cancelled, the handle may then have been aborted."""
+        with self.__lock:
+            handles = self.__checks.get(id(site), [])
+            if handles is None:
+                return False
+            if handle in handles:
+                handles.remove(handle)
+            return True
+
+    @staticmethod
+    def add_current(handle):
+        """Add to the check of the current thread, if it has entered one"""
+        check = getattr(RunningChecks.current, "check", None)
+        if check is not None:
+            check[0].add(check[1], handle)
+
+    @staticmethod
+    def remove_current(handle):
+        """Take back from the check of the current thread, False if it was cancelled"""
+        check = getattr(RunningChecks.current, "check", None)
+        if check is not None:
+            return check[0].remove(check[1], handle)
+        return True
+
+    @staticmethod
+    def abort(handle):
+        try:
+            if hasattr(handle, "kill"):
+                handle.kill()
+            elif hasattr(handle, "shutdown"):
+                handle.shutdown(socket.SHUT_RDWR)
+            else:
+                handle()
+        except (OSError, socket.error):
+            pass
+
 
-    def __init__(self, url, config, alive):
-        """We need to pass by reference so pass the config as an array wrapper"""
+class HostLimiter(object):
+    """Limits how many checks run against each (scheme, host, port) at the same time, so the
+    sites of one host take turns on a few reused keep-alive connections."""
+
+    def __init__(self, limit):
+        self.__limit = limit
+        self.__running = {}
+        self.__condition = threading.Condition()
+
+    @staticmethod
+    def key(site):
+        """The (scheme, host, port) of the site, None if it can not be parsed"""
+        try:
+            return HttpProbe.split_url(site.get_url())[0]
+        except ValueError:
+            return None
+
+    def try_acquire(self, key):
+        with self.__condition:
+            if key is not None and self.__running.get(key, 0) >= self.__limit:
+                return False
+            self.__running[key] = self.__running.get(key, 0) + 1
+            return True
+
+    def acquire(self, key):
+        with self.__condition:
+            while not self.try_acquire(key):
+                self.__condition.wait()
+
+    def release(self, key):
+        with self.__condition:
+            self.__running[key] -= 1
+            if not self.__running[key]:
+                del self.__running[key]
+            self.__condition.notify_all()
+
+
+class StrictOrder(object):
+    """Hands out finished sites in order of time spent. The fastest finished site is released
+    as soon as all checks have started and every check still running has been running for
+    longer than it took, since then no later result can be faster."""
+
+    def __init__(self, count):
+        self.__cond = threading.Condition()
+        self.__unstarted = count
+        self.__seq = 0
+        # Min heap of (time spent, seq, site) of the finished sites not yet handed out
+        self.__finished = []
+        # Max heap of (-start, seq, site) of the started sites, finished ones are removed lazily
+        self.__running = []
+        self.__done = set()
+
+    def site_started(self, site):
+        with self.__cond:
+            self.__unstarted -= 1
+            self.__seq += 1
+            heapq.heappush(self.__running, (-site.get_start(), self.__seq, site))
+            self.__cond.notify()
+
+    def site_finished(self, _site):
+        with self.__cond:
+            self.__cond.notify()
+
+    def collect(self):
+        """Move everything from the results queue to our heap"""
+        while True:
+            try:
+                site = SiteThread.results_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.__seq += 1
+            heapq.heappush(self.__finished, (site.get_time_spent(), self.__seq, site))
+            self.__done.add(id(site))
+
+    def wait_time(self, time_spent):
+        """Seconds until a site that took time_spent is known to be the fastest, None if unknown"""
+        if self.__unstarted > 0:
+            return None
+        while self.__running and id(self.__running[0][2]) in self.__done:
+            heapq.heappop(self.__running)
+        if not self.__running:
+            return 0
+        return time_spent - (time.time() + self.__running[0][0])
+
+    def get(self, deadline=None):
+        """Blocks until the next site in order is known and returns it, raises queue.Empty
+        if that is not known by the deadline"""
+        with self.__cond:
+            while True:
+                self.collect()
+                timeout = None
+                if self.__finished:
+                    timeout = self.wait_time(self.__finished[0][0])
+                    if timeout is not None and timeout <= 0:
+                        return heapq.heappop(self.__finished)[2]
+                if deadline is not None:
+                    if time.time() >= deadline:
+                        raise queue.Empty()
+                    timeout = deadline - time.time() if timeout is None else min(timeout, deadline - time.time())
+                self.__cond.wait(timeout)
+
+
+class LatencyHistory(object):
+    """Fixed size ring buffer with the durations and result codes of the latest checks of a site.
+    It is stored in two arrays so the memory use is small and the same for every site."""
+
+    __slots__ = ("__durations", "__codes", "__pos", "__count")
+
+    def __init__(self, size):
+        self.__durations = array('f', [0.0]) * size
+        self.__codes = array('B', [0]) * size
+        self.__pos = 0
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def add(self, duration, code):
+        self.__durations[self.__pos] = duration
+        self.__codes[self.__pos] = min(max(code, 0), 255)
+        self.__pos = (self.__pos + 1) % len(self.__durations)
+        self.__count = min(self.__count + 1, len(self.__durations))
+
+    def entries(self):
+        """Returns a list of (duration, code) from the oldest to the newest"""
+        size = len(self.__durations)
+        first = (self.__pos - self.__count) % size
+        return [(self.__durations[(first + i) % size], self.__codes[(first + i) % size]) for i in range(self.__count)]
+
+    def percentile(self, pct, codes=None):
+        """Returns the duration that pct percent of the checks were faster or equal to, None without history.
+        If codes is given only the checks with one of those result codes are included."""
+        if codes is None:
+            durations = sorted(self.__durations[:self.__count])
+        else:
+            durations = sorted(duration for duration, code in self.entries() if code in codes)
+        if not durations:
+            return None
+        rank = int(-(-pct * len(durations) // 100))
+        return durations[max(rank, 1) - 1]
+
+    def is_rising(self, recent, factor):
+        """True if the recent successful checks took on average factor times the median of the older ones"""
+        durations = [duration for duration, code in self.entries() if code in (Result.OK, Result.AUTH)]
+        older = sorted(durations[:-recent])
+        if len(older) < recent:
+            return False
+        return sum(durations[-recent:]) / recent > factor * older[len(older) // 2]
+
+    def encode(self):
+        return " ".join("%.3f:%d" % entry for entry in self.entries())
+
+    @staticmethod
+    def decode(text, size):
+        history = LatencyHistory(size)
+        for entry in text.split():
+            try:
+                duration, code = entry.split(":")
+                history.add(float(duration), int(code))
+            except ValueError:
+                pass
+        return history
+
+
+class Site(object):
+    """Class that handles one site to check. The state is kept in typed slots, changes are
+    collected until pop_changes() hands them to Alive.sync_sites to be saved in bulk."""
+
+    # Guards the collected changes of all sites, probes record state from their threads
+    # while the daemon syncs. One lock for all sites keeps the objects small.
+    changes_lock = threading.Lock()
+
+    # With --adaptive the timeout is this many times the slowest successful check,
+    # once there are enough checks in the history
+    ADAPTIVE_FACTOR = 4
+    ADAPTIVE_SAMPLES = 5
+
+    # Sites that changed state within this many seconds, or whose last checks were this
+    # many times slower than usual, are checked before the others
+    RECENT_CHANGE = 3600
+    RISING_FACTOR = 1.5
+    RISING_SAMPLES = 3
+
+    # Options that hold the state of the site, the others are settings made by the user
+    STATE_KEYS = ("time", "down", "history", "failures", "next_check", "next_due", "cert_expires", "last_check",
+                  "unfinished", "trigger_status", "trigger_duration", "trigger_started")
+
+    __slots__ = ("__url", "__alive", "__options", "__res", "__time", "__start", "__queued", "__phases", "__history",
+                 "__new", "__down", "__last_change", "__failures", "__next_check", "__next_due", "__cert_expires",
+                 "__last_check", "__unfinished", "__changes")
+
+    def __init__(self, url, alive, values=None):
+        """values are the options of the site as strings, None for a site that is not known yet"""
         self.__url = url
-        self.__config = config
         self.__alive = alive
         self.__res = None
         self.__time = None
         self.__start = None
-        if not config[0].has_section(url):
-            config[0].add_section(url)
-            self.__new = True
-        else:
-            self.__new = False
+        self.__queued = time.time()
+        self.__phases = None
+        self.__changes = None
+        self.__new = values is None
+        values = values or {}
+        self.__down = BOOLEAN_STATES.get(values.get("down", "").lower(), False)
+        # The last check was cancelled before it finished
+        self.__unfinished = BOOLEAN_STATES.get(values.get("unfinished", "").lower(), False)
+        # Kept encoded until it is used
+        self.__history = values.get("history", "")
+        self.__failures = int(self.parse_float(values.get("failures"), 0))
+        self.__next_check = self.parse_float(values.get("next_check"), 0)
+        self.__next_due = self.parse_float(values.get("next_due"), 0)
+        self.__cert_expires = int(self.parse_float(values.get("cert_expires"), 0))
+        # "time result seconds" of the last check, kept encoded until it is used
+        self.__last_check = values.get("last_check")
+        self.__options = dict((key, value) for key, value in values.items() if key not in self.STATE_KEYS) or None
         try:
-            self.__down = config[0].getboolean(url, "down")
-        except ValueError:
-            self.__down = False
-        except configparser.NoOptionError:
-            self.__down = False
+            self.__last_change = int(values["time"])
+        except (ValueError, KeyError):
+            self.set_last_change(int(time.time()))
+
+    @staticmethod
+    def parse_float(text, default):
         try:
-            self.__last_change = config[0].getint(url, "time")
-        except (ValueError, configparser.NoOptionError):
-            self.__last_change = int(time.time())
-            self.set_config(url, "time", self.__last_change)
+            return float(text)
+        except (TypeError, ValueError):
+            return default
 
     def __cmp__(self, other):
         return cmp(self.__time, other.__time)
 
-    def set_config(self, section, key, val):
-        if sys.hexversion < 0x03000000:
-            self.__config[0].set(section, key, val)
-        else:
-            self.__config[0][section][key] = str(val)
+    def __lt__(self, other):
+        return self.__time < other.__time
+
+    def set_state(self, key, value):
+        """Record a changed state value to be saved by the next sync"""
+        with Site.changes_lock:
+            if self.__changes is None:
+                self.__changes = {}
+            self.__changes[key] = str(value)
+
+    def pop_changes(self):
+        """Returns the (key, value) strings changed since the last call"""
+        with Site.changes_lock:
+            changes = self.__changes
+            self.__changes = None
+        return sorted(changes.items()) if changes else []
+
+    def get_option(self, key, default=None):
+        """A setting of the site, like interval or up_trigger"""
+        if self.__options is None:
+            return default
+        return self.__options.get(key, default)
+
+    def get_options(self):
+        """The settings of the site as a dict"""
+        return dict(self.__options or {})
+
+    def set_option(self, key, value):
+        if self.__options is None:
+            self.__options = {}
+        self.__options[key] = str(value)
+        self.set_state(key, value)
 
     def get_last_change(self):
         return self.__last_change
 
     def set_last_change(self, new_time):
-        self.set_config(self.__url, "time", new_time)
         self.__last_change = new_time
+        self.set_state("time", new_time)
 
     def get_down(self):
         return self.__down
 
     def set_down(self, down):
-        self.set_config(self.__url, "down", "yes" if down else "no")
         self.__down = down
+        self.set_state("down", "yes" if down else "no")
+
+    def get_probe_type(self):
+        """How the site is checked, the probe option: http, or tcp and tls that only connect.
+        Groups of mirrors are checked by their members."""
+        if self.__url.startswith(GroupProbe.PREFIX):
+            return "group"
+        return self.get_option("probe", "http")
+
+    def get_cert_expires(self):
+        """When the certificate seen by the last tls probe expires, 0 if not known"""
+        return self.__cert_expires
+
+    def set_cert_expires(self, expires):
+        self.__cert_expires = expires
+        self.set_state("cert_expires", expires)
 
     def get_url(self):
         return self.__url
@@ -107,45 +662,1691 @@ class Site(object):
     def get_time_since_start(self):
         return (time.time() - self.__start)
 
+    def get_start(self):
+        return self.__start
+
     def get_new(self):
         return self.__new
 
-    def get_config(self):
-        return self.__config
+    def get_history(self):
+        """The latency history, it is decoded when first used"""
+        if not isinstance(self.__history, LatencyHistory):
+            self.__history = LatencyHistory.decode(self.__history, self.__alive.options.HISTORY_SIZE)
+        return self.__history
+
+    def add_to_history(self):
+        """Add the result of the last check to the latency history"""
+        history = self.get_history()
+        history.add(self.__time, self.__res)
+        self.set_state("history", history.encode())
+
+    def get_float(self, key, default):
+        """Returns the option as a float, or default if it is not set or invalid"""
+        return self.parse_float(self.get_option(key), default)
+
+    def get_interval(self, default):
+        """Seconds between checks in daemon mode, can be set per site with the interval option"""
+        return self.get_float("interval", default)
+
+    def get_timeout(self, default):
+        """Timeout for each try. The timeout option of the site wins, with --adaptive it is
+        derived from the time the successful checks in the latency history took."""
+        options = self.__alive.options
+        timeout = self.get_float("timeout", None)
+        if timeout is not None:
+            return timeout
+        if options.ADAPTIVE:
+            history = self.get_history()
+            if len(history) >= self.ADAPTIVE_SAMPLES:
+                slowest = history.percentile(99, (Result.OK, Result.AUTH))
+                if slowest is not None:
+                    return min(default, max(options.MIN_TIMEOUT, slowest * self.ADAPTIVE_FACTOR))
+        return default
+
+    def get_matcher(self, limit):
+        """A BodyMatcher for the expect (text) or expect_regex option, None if the body is not checked.
+        At most limit bytes are read, or the expect_limit option of the site."""
+        text = self.get_option("expect")
+        regex = self.get_option("expect_regex")
+        if text is None and regex is None:
+            return None
+        return BodyMatcher(text, regex, int(self.get_float("expect_limit", limit)))
+
+    def get_tries(self, default):
+        """Number of tries, can be set per site with the tries option"""
+        return max(1, int(self.get_float("tries", default)))
+
+    def get_next_due(self):
+        """Time the site should be checked again, used by --due"""
+        return self.__next_due
+
+    def get_due(self, now, default_interval):
+        """When the site is due after a check at now, its interval later or when it is no
+        longer backing off"""
+        due = now + self.get_interval(default_interval)
+        if self.is_backing_off(due):
+            due = self.__next_check
+        return due
+
+    def update_due(self, now, default_interval):
+        """Set when the site is due after a check at now, returns the new due time"""
+        due = self.get_due(now, default_interval)
+        self.__next_due = int(due)
+        self.set_state("next_due", self.__next_due)
+        if self.__unfinished:
+            self.__unfinished = False
+            self.set_state("unfinished", "no")
+        return due
+
+    def set_unfinished(self):
+        """The check was cancelled before it finished, the site is due at once and goes first"""
+        self.__unfinished = True
+        self.set_state("unfinished", "yes")
+        self.__next_due = 0
+        self.set_state("next_due", 0)
+
+    def set_last_check(self, when):
+        """Remember the result of the check that finished at when"""
+        self.__last_check = "%d %d %.3f" % (when, self.__res, self.__time)
+        self.set_state("last_check", self.__last_check)
+
+    def get_cached_result(self, max_age, now):
+        """Returns (result, seconds) of the last check if it is at most max_age old, else None"""
+        try:
+            when, res, time_spent = self.__last_check.split()
+            if now - int(when) <= max_age:
+                return int(res), float(time_spent)
+        except (AttributeError, ValueError):
+            pass
+        return None
+
+    def get_priority(self):
+        """Lower is checked first: sites that are down or whose last check did not finish,
+        then sites that changed state recently, then sites that got slower, then the rest"""
+        if self.__down or self.__unfinished:
+            return 0
+        if time.time() - self.__last_change < self.RECENT_CHANGE and not self.__new:
+            return 1
+        if self.get_history().is_rising(self.RISING_SAMPLES, self.RISING_FACTOR):
+            return 2
+        return 3
+
+    def get_failures(self):
+        """Number of checks in a row that found the site down"""
+        return self.__failures
+
+    def get_next_check(self):
+        """Time before which a site that is down is not checked again"""
+        return self.__next_check
+
+    def is_backing_off(self, now):
+        """True if the site is down and should not be checked yet, see update_backoff"""
+        if not (self.__alive.options.ADAPTIVE and self.__down and now < self.__next_check):
+            return False
+        return BOOLEAN_STATES.get(self.get_option("backoff", "yes").lower(), True)
+
+    def update_backoff(self, down):
+        """Count the failures in a row and, with --adaptive, set when a site that is down should be
+        checked next. The delay doubles with each failure up to --backoff-max."""
+        options = self.__alive.options
+        if not down:
+            if self.__failures:
+                self.__failures = 0
+                self.set_state("failures", 0)
+            return
+        if not options.ADAPTIVE:
+            return
+        self.__failures += 1
+        self.set_state("failures", self.__failures)
+        delay = min(options.BACKOFF_BASE * 2 ** min(self.__failures - 1, 32), options.BACKOFF_MAX)
+        self.__next_check = int(time.time() + delay)
+        self.set_state("next_check", self.__next_check)
+
+    def reset(self):
+        """Forget the result of the last check so the site can be checked again"""
+        if self.__res is not None:
+            self.__new = False
+        self.__res = None
+        self.__time = None
+        self.__start = None
+        self.__queued = time.time()
+        self.__phases = None
 
     def get_res(self):
         if self.__res is None:
             self.check_alive()
         return self.__res
 
+    def has_result(self):
+        return self.__res is not None
+
     def has_started(self):
         return self.__start is not None
 
     def check_alive(self):
+        running = self.__alive.get_running_checks()
+        if running.is_cancelled(self):
+            # Cancelled at the deadline before it started, it is not reported
+            self.__res = Result.GENERIC
+            return
+        self.start_check()
+        try:
+            res = running.call(self, self.__alive.get_probe(self.get_probe_type()).check)
+        except Exception as err:  # pylint: disable=W0703
+            self.__alive.write_warn("check of %s failed: %s\n" % (self.__url, err))
+            res = Result.GENERIC
+        self.set_res(res)
+
+    def end_check(self):
+        """The check is done, returns False if it was cancelled and its result is not used"""
+        return self.__alive.get_running_checks().done(self)
+
+    def start_check(self):
         self.__start = time.time()
-        wget_args = ["wget", "--no-check-certificate", "--quiet", "--timeout=40", "--tries=3", "--spider",
-                     self.get_url()]
-        self.__alive.write_debug("Checking using cmd: '" + ' '.join(wget_args) + "'\n")
-        wget = subprocess.Popen(args=wget_args)
-        self.__res = wget.wait()
+        self.__alive.get_metrics().check_started(self.__start - self.__queued)
+        SiteThread.started(self)
+
+    def set_res(self, res):
+        """Store the result of a finished check"""
+        self.__res = res
         self.__time = self.get_time_since_start()
+        self.__alive.get_metrics().check_finished(res, self.__time, self.__phases)
+
+    def load_result(self, res, time_spent, phases=None):
+        """Use the result of a check done elsewhere, by a shard worker"""
+        self.__res = res
+        self.__time = time_spent
+        self.__phases = phases
+
+    def get_phases(self):
+        """Seconds spent on each phase of the last check, None if the probe does not record them"""
+        return self.__phases
+
+    def set_phases(self, phases):
+        self.__phases = phases
+
+    def get_trigger(self, down=False):
+        """The command to run when the site goes down or up, empty if there is none"""
+        return self.get_option("down_trigger" if down else "up_trigger", "")
 
     def activate_triggers(self, down=False):
         """When site switch state it can have some triggers that should be activated"""
-        command = ""
-        if down and self.__config[0].has_option(self.__url, "down_trigger"):
-            command = self.__config[0].get(self.__url, "down_trigger")
-        elif not down and self.__config[0].has_option(self.__url, "up_trigger"):
-            command = self.__config[0].get(self.__url, "up_trigger")
-
+        command = self.get_trigger(down)
         if len(command):
-            ret = 1
+            self.__alive.get_trigger_runner().run(self, command, self.get_trigger_timeout())
+
+    def get_trigger_timeout(self):
+        """Seconds a trigger may run before it is killed, can be set per site with the trigger_timeout option"""
+        return self.get_float("trigger_timeout", self.__alive.options.TRIGGER_TIMEOUT)
+
+    def set_trigger_result(self, status, duration, started):
+        """Record how the last trigger went, status is the exit status or 'timeout' or 'error'"""
+        self.set_state("trigger_status", status)
+        self.set_state("trigger_duration", "%.2f" % duration)
+        self.set_state("trigger_started", int(started))
+
+
+class TriggerRunner(object):
+    """Runs the up and down triggers in a bounded pool of worker threads, so slow triggers do
+    not hold up the reporting. A trigger running longer than its timeout is killed together
+    with its children. The results are recorded on the sites by apply_results() which is
+    called from the reporting thread."""
+
+    def __init__(self, alive, workers):
+        self.__alive = alive
+        self.__workers = workers
+        self.__threads = []
+        self.__jobs = queue.Queue()
+        self.__results = queue.Queue()
+        # Kill functions of the running triggers
+        self.__kills = set()
+        self.__lock = threading.Lock()
+
+    def run(self, site, command, timeout):
+        if not self.__threads:
+            for _ in range(self.__workers):
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.__threads.append(thread)
+        self.__jobs.put((site, command, timeout))
+
+    def work(self):
+        while True:
+            job = self.__jobs.get()
+            if job is None:
+                return
+            site, command, timeout = job
+            started = time.time()
+            status = self.execute(command, timeout)
+            self.__results.put((site, status, time.time() - started, started))
+            if status != 0:
+                self.__alive.write_warn("could not run '%s' (%s)\n" % (command, status), Color.YELLOW)
+
+    def execute(self, command, timeout):
+        """Returns the exit status of the command, or 'timeout' if it had to be killed"""
+        self.__alive.write_debug("Running trigger '%s'\n" % command)
+        try:
+            # Run it in its own process group so the children of the shell can be killed too
+            if sys.hexversion < 0x03020000:
+                process = subprocess.Popen(command, shell=True, preexec_fn=os.setsid)
+            else:
+                process = subprocess.Popen(command, shell=True, start_new_session=True)
+        except OSError:
+            return "error"
+        killed = []
+
+        def kill(reason="timeout"):
+            killed.append(reason)
             try:
-                ret = subprocess.call(command, shell=True)
+                os.killpg(process.pid, signal.SIGKILL)
             except OSError:
                 pass
-            if ret:
-                self.__alive.write_warn("could not run '%s'\n" % command, Color.YELLOW)
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        with self.__lock:
+            self.__kills.add(kill)
+        try:
+            ret = process.wait()
+        finally:
+            timer.cancel()
+            with self.__lock:
+                self.__kills.discard(kill)
+        return killed[0] if killed else ret
+
+    def apply_results(self):
+        """Record the results of the finished triggers, returns their sites"""
+        sites = []
+        while True:
+            try:
+                site, status, duration, started = self.__results.get_nowait()
+            except queue.Empty:
+                return sites
+            site.set_trigger_result(status, duration, started)
+            sites.append(site)
+
+    def close(self, timeout=None):
+        """Wait for all triggers to finish and record their results. The triggers that have
+        not finished after timeout seconds are killed and the queued ones are not run, their
+        status is 'deadline'."""
+        for _ in self.__threads:
+            self.__jobs.put(None)
+        end = None if timeout is None else time.time() + timeout
+        for thread in self.__threads:
+            thread.join(None if end is None else max(0, end - time.time()))
+        if any(thread.is_alive() for thread in self.__threads):
+            while True:
+                try:
+                    job = self.__jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is not None:
+                    self.__results.put((job[0], "deadline", 0, time.time()))
+            for _ in self.__threads:
+                self.__jobs.put(None)
+            with self.__lock:
+                kills = list(self.__kills)
+            for kill in kills:
+                kill("deadline")
+            for thread in self.__threads:
+                thread.join(self.__alive.CANCEL_GRACE)
+        self.__threads = []
+        return self.apply_results()
+
+
+class Result(object):
+    """Result codes of a check, these are the exit codes used by wget"""
+    OK = 0
+    GENERIC = 1
+    NETWORK = 4
+    SSL = 5
+    AUTH = 6
+    PROTOCOL = 7
+    SERVER = 8
+    # Not used by wget, the body did not contain the expected text
+    CONTENT = 9
+
+
+class BodyMatcher(object):
+    """Looks for the expected text, or a match of the regex, in a response body while it is
+    read. Reading stops as soon as it is found or when limit bytes have been read."""
+
+    CHUNK = 8192
+
+    def __init__(self, text=None, regex=None, limit=65536):
+        self.__text = text.encode("utf-8") if regex is None else None
+        self.__regex = re.compile(regex.encode("utf-8")) if regex is not None else None
+        self.__limit = limit
+        self.reset()
+
+    def reset(self):
+        self.__seen = 0
+        self.__window = b""
+        self.matched = False
+
+    def feed(self, chunk):
+        """Returns True once the expected text has been seen"""
+        chunk = chunk[:self.__limit - self.__seen]
+        self.__seen += len(chunk)
+        window = self.__window + chunk
+        if self.__regex is not None:
+            self.matched = self.__regex.search(window) is not None
+            self.__window = window
+        else:
+            self.matched = self.__text in window
+            # Keep what could be the start of a match split over two chunks
+            self.__window = window[len(window) - len(self.__text) + 1:] if len(self.__text) > 1 else b""
+        return self.matched
+
+    def is_done(self):
+        return self.matched or self.__seen >= self.__limit
+
+    def read(self, stream):
+        """Feed it from a file like object, returns True if the whole stream was read"""
+        self.reset()
+        read = getattr(stream, "read1", stream.read)
+        while not self.is_done():
+            chunk = read(self.CHUNK)
+            if not chunk:
+                return True
+            self.feed(chunk)
+        return False
+
+
+class ResolverCache(object):
+    """Caches name lookups for all checks. Addresses are kept for ttl seconds, names that do
+    not exist for negative_ttl seconds (0 turns that off). When several checks look up the
+    same name at the same time only the first one asks the resolver, the others wait for it."""
+
+    MAX_ENTRIES = 10000
+    NEGATIVE_ERRORS = [getattr(socket, name) for name in ("EAI_NONAME", "EAI_NODATA") if hasattr(socket, name)]
+
+    def __init__(self, ttl, negative_ttl):
+        self.__ttl = ttl
+        self.__negative_ttl = negative_ttl
+        self.__lock = threading.Lock()
+        # (host, port) -> (expires, addresses or the error)
+        self.__cache = {}
+        # (host, port) -> Event set when the lookup in progress is done
+        self.__pending = {}
+
+    def resolve(self, host, port):
+        """Returns the getaddrinfo list for host and port, raises socket.gaierror like getaddrinfo"""
+        key = (host, port)
+        while True:
+            with self.__lock:
+                entry = self.__cache.get(key)
+                if entry is not None and entry[0] > time.time():
+                    if isinstance(entry[1], socket.gaierror):
+                        raise entry[1]
+                    return entry[1]
+                pending = self.__pending.get(key)
+                if pending is None:
+                    pending = self.__pending[key] = threading.Event()
+                    break
+            # Someone else is looking it up, wait for it and look in the cache again
+            pending.wait()
+        try:
+            result = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            self.store(key, result, self.__ttl)
+            return result
+        except socket.gaierror as err:
+            if err.errno in self.NEGATIVE_ERRORS:
+                self.store(key, err, self.__negative_ttl)
+            raise
+        finally:
+            with self.__lock:
+                del self.__pending[key]
+            pending.set()
+
+    def store(self, key, result, ttl):
+        if ttl <= 0:
+            return
+        with self.__lock:
+            if len(self.__cache) >= self.MAX_ENTRIES:
+                self.purge()
+            self.__cache[key] = (time.time() + ttl, result)
+
+    def purge(self):
+        """Drop the expired entries, the lock must be held"""
+        now = time.time()
+        for key in [key for key, entry in self.__cache.items() if entry[0] <= now]:
+            del self.__cache[key]
+
+
+class ConnectionPool(object):
+    """Keeps idle keep-alive connections around, one list per (scheme, host, port).
+    New connections are opened by open() which records how long each phase took."""
+
+    def __init__(self, resolver=None, max_idle=4):
+        self.__resolver = resolver
+        self.__max_idle = max_idle
+        self.__idle = {}
+        self.__lock = threading.Lock()
+        self.__context = ssl.create_default_context()
+        self.__context.check_hostname = False
+        self.__context.verify_mode = ssl.CERT_NONE
+
+    def get(self, key, timeout):
+        """Returns a (connection, reused) tuple for the given key"""
+        with self.__lock:
+            idle = self.__idle.get(key)
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        return self.create(key, timeout), False
+
+    def create(self, key, timeout):
+        """Returns a new, not yet connected, connection for the key"""
+        scheme, host, port = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, port, timeout=timeout, context=self.__context)
+        return httplib.HTTPConnection(host, port, timeout=timeout)
+
+    def open(self, conn, key, phases):
+        """Connect the connection, adding the time spent on dns, connect and tls to phases"""
+        scheme, host, port = key
+        start = time.time()
+        if self.__resolver is not None:
+            addresses = self.__resolver.resolve(host, port)
+        else:
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        resolved = time.time()
+        phases["dns"] += resolved - start
+        sock = self.connect(addresses, conn.timeout)
+        connected = time.time()
+        phases["connect"] += connected - resolved
+        if scheme == "https":
+            try:
+                sock = self.__context.wrap_socket(sock, server_hostname=host)
+                RunningChecks.add_current(sock)
+            except Exception:
+                sock.close()
+                raise
+            phases["tls"] += time.time() - connected
+        conn.sock = sock
+
+    @staticmethod
+    def connect(addresses, timeout):
+        """Returns a socket connected to the first of the getaddrinfo addresses that answers"""
+        error = socket.error("no addresses to connect to")
+        for family, socktype, proto, _, sockaddr in addresses:
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                sock.settimeout(timeout)
+                RunningChecks.add_current(sock)
+                sock.connect(sockaddr)
+                return sock
+            except socket.error as err:
+                error = err
+                if sock is not None:
+                    sock.close()
+        raise error
+
+    def put(self, key, conn):
+        """Hand back a connection whose response has been fully read"""
+        with self.__lock:
+            idle = self.__idle.setdefault(key, [])
+            if len(idle) < self.__max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.__lock:
+            for idle in self.__idle.values():
+                for conn in idle:
+                    conn.close()
+            self.__idle = {}
+
+
+class HttpProbe(object):
+    """Checks a site in-process with HEAD (falling back to GET) requests over pooled
+    keep-alive connections. The outcome is mapped to the exit codes wget would give.
+    Sites with an expect option are fetched with GET and the body is matched as it arrives."""
+
+    MAX_REDIRECTS = 20
+    USER_AGENT = "alive.py"
+    PHASES = ("dns", "connect", "tls", "ttfb")
+
+    def __init__(self, alive, timeout=40, tries=3, expect_limit=65536):
+        self.__alive = alive
+        self.__timeout = timeout
+        self.__tries = tries
+        self.__expect_limit = expect_limit
+        # Keep a connection for each check that may run against a host at the same time
+        self.__pool = ConnectionPool(alive.get_resolver(), alive.options.PER_HOST or 4)
+
+    def check_async(self, loop, executor, site):
+        """The checks are blocking so they are run by the executor of the event loop"""
+        return loop.run_in_executor(executor, self.__alive.get_running_checks().call, site, self.check)
+
+    @staticmethod
+    def split_url(url):
+        """Returns ((scheme, host, port), path) for the url, http is assumed if there is no scheme"""
+        if "://" not in url:
+            url = "http://" + url
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError("Unsupported url '%s'" % url)
+        port = parts.port or (443 if scheme == "https" else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        return (scheme, parts.hostname, port), path
+
+    def check(self, site):
+        url = site.get_url()
+        self.__alive.write_debug("Checking '%s' in-process\n" % url)
+        phases = dict.fromkeys(self.PHASES, 0.0)
+        timeout = site.get_timeout(self.__timeout)
+        matcher = site.get_matcher(self.__expect_limit)
+        running = self.__alive.get_running_checks()
+        for tries in range(1, site.get_tries(self.__tries) + 1):
+            res, retry = self.check_once(url, phases, timeout, matcher)
+            if not retry or running.is_cancelled(site):
+                break
+        phases["retries"] = tries - 1
+        site.set_phases(phases)
+        self.__alive.write_debug("Checked '%s': %s\n" % (url, " ".join("%s=%.3f" % (phase, phases[phase])
+                                                                         for phase in self.PHASES)))
+        return res
+
+    def check_once(self, url, phases, timeout, matcher=None):
+        """Returns (result, retry) where retry tells if it is worth trying again"""
+        try:
+            for _ in range(self.MAX_REDIRECTS + 1):
+                key, path = self.split_url(url)
+                status, location = self.request(key, path, "GET" if matcher else "HEAD", phases, timeout, matcher)
+                if status in (405, 501) and not matcher:
+                    status, location = self.request(key, path, "GET", phases, timeout)
+                if 300 <= status < 400 and location:
+                    url = urljoin(url if "://" in url else "http://" + url, location)
+                    continue
+                res = self.map_status(status)
+                if res == Result.OK and matcher and not matcher.matched:
+                    res = Result.CONTENT
+                return res, False
+            return Result.GENERIC, False
+        except (ValueError, socket.error, IOError, httplib.HTTPException) as err:
+            return self.map_error(err)
+
+    @staticmethod
+    def map_error(err):
+        """Returns (result, retry) for an error raised while checking"""
+        if isinstance(err, ValueError):
+            return Result.GENERIC, False
+        if isinstance(err, socket.gaierror):
+            return Result.NETWORK, False
+        if isinstance(err, ssl.SSLError):
+            return Result.SSL, False
+        if isinstance(err, socket.timeout):
+            return Result.NETWORK, True
+        if isinstance(err, httplib.HTTPException):
+            return Result.PROTOCOL, True
+        return Result.NETWORK, err.errno != errno.ECONNREFUSED
+
+    @staticmethod
+    def map_status(status):
+        if status < 400:
+            return Result.OK
+        if status in (401, 407):
+            return Result.AUTH
+        return Result.SERVER
+
+    def request(self, key, path, method, phases, timeout, matcher=None):
+        """Does one request and returns (status, location). With a matcher the body of
+        a successful response is fed to it."""
+        conn, reused = self.__pool.get(key, timeout)
+        try:
+            if conn.sock is not None:
+                RunningChecks.add_current(conn.sock)
+            try:
+                if conn.sock is None:
+                    self.__pool.open(conn, key, phases)
+                response = self.send(conn, path, method, phases)
+            except (httplib.BadStatusLine, socket.error):
+                if not reused:
+                    raise
+                # The server closed the idle keep-alive connection, try once with a new one
+                conn.close()
+                conn = self.__pool.create(key, timeout)
+                self.__pool.open(conn, key, phases)
+                response = self.send(conn, path, method, phases)
+            length = response.getheader("content-length")
+            if matcher and 200 <= response.status < 300:
+                # The rest of the body is not read when the match is decided early
+                response.will_close = response.will_close or not matcher.read(response)
+            # We do not care about the content, only read it if it is small so the connection can be reused
+            elif method == "HEAD" or (length is not None and length.isdigit() and int(length) <= 65536):
+                response.read()
+            else:
+                response.will_close = True
+            location = response.getheader("location")
+            # A pooled connection is used by other checks, cancelling this one must not touch it
+            if response.will_close or not RunningChecks.remove_current(conn.sock):
+                conn.close()
+            else:
+                self.__pool.put(key, conn)
+            return response.status, location
+        except Exception:
+            conn.close()
+            raise
+
+    def send(self, conn, path, method, phases):
+        start = time.time()
+        conn.request(method, path, headers={"User-Agent": self.USER_AGENT})
+        response = conn.getresponse()
+        phases["ttfb"] += time.time() - start
+        return response
+
+    def close(self):
+        self.__pool.close()
+
+
+class SocketProbe(object):
+    """Checks a site by only opening a TCP connection to it, with tls the TLS handshake is
+    done as well and the expiry of the certificate is recorded. The host and port are
+    taken from the url, like tcp://db.example.com:5432 or smtp.example.com:465."""
+
+    DEFAULT_PORTS = {"http": 80, "https": 443}
+    PHASES = ("dns", "connect", "tls")
+
+    def __init__(self, alive, timeout=40, tries=3, tls=False):
+        self.__alive = alive
+        self.__timeout = timeout
+        self.__tries = tries
+        self.__context = None
+        if tls:
+            # The certificate is only read, not verified
+            self.__context = ssl.create_default_context()
+            self.__context.check_hostname = False
+            self.__context.verify_mode = ssl.CERT_NONE
+
+    def check_async(self, loop, executor, site):
+        return loop.run_in_executor(executor, self.__alive.get_running_checks().call, site, self.check)
+
+    def split_url(self, url):
+        """Returns (host, port) for the url, a tls probe defaults to port 443"""
+        if "://" not in url:
+            url = "tcp://" + url
+        parts = urlsplit(url)
+        port = parts.port or self.DEFAULT_PORTS.get(parts.scheme.lower()) or (443 if self.__context else None)
+        if not parts.hostname or not port:
+            raise ValueError("No host and port in '%s'" % url)
+        return parts.hostname, port
+
+    def check(self, site):
+        url = site.get_url()
+        self.__alive.write_debug("Connecting to '%s'\n" % url)
+        phases = dict.fromkeys(self.PHASES, 0.0)
+        timeout = site.get_timeout(self.__timeout)
+        running = self.__alive.get_running_checks()
+        for tries in range(1, site.get_tries(self.__tries) + 1):
+            res, retry = self.check_once(site, phases, timeout)
+            if not retry or running.is_cancelled(site):
+                break
+        phases["retries"] = tries - 1
+        site.set_phases(phases)
+        return res
+
+    def check_once(self, site, phases, timeout):
+        """Returns (result, retry) where retry tells if it is worth trying again"""
+        try:
+            host, port = self.split_url(site.get_url())
+            start = time.time()
+            resolver = self.__alive.get_resolver()
+            if resolver is not None:
+                addresses = resolver.resolve(host, port)
+            else:
+                addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            resolved = time.time()
+            phases["dns"] += resolved - start
+            sock = ConnectionPool.connect(addresses, timeout)
+            connected = time.time()
+            phases["connect"] += connected - resolved
+            try:
+                if self.__context is None:
+                    return Result.OK, False
+                sock = self.__context.wrap_socket(sock, server_hostname=host)
+                RunningChecks.add_current(sock)
+                phases["tls"] += time.time() - connected
+                expires = self.cert_expires(sock.getpeercert(True))
+            finally:
+                sock.close()
+            if expires is None:
+                return Result.SSL, False
+            site.set_cert_expires(expires)
+            if expires < time.time():
+                self.__alive.write_debug("The certificate of '%s' expired %s\n" % (site.get_url(), time.ctime(expires)))
+                return Result.SSL, False
+            return Result.OK, False
+        except (ValueError, socket.error, IOError) as err:
+            return HttpProbe.map_error(err)
+
+    @staticmethod
+    def cert_expires(der):
+        """Returns when a DER encoded certificate expires as a timestamp, None if it can not be read"""
+        data = bytearray(der or b"")
+
+        def element(pos):
+            """Returns (tag, start, end) of the contents of the element at pos"""
+            tag, length, pos = data[pos], data[pos + 1], pos + 2
+            if length & 0x80:
+                count = length & 0x7f
+                length = 0
+                for byte in data[pos:pos + count]:
+                    length = length << 8 | byte
+                pos += count
+            return tag, pos, pos + length
+
+        try:
+            # Certificate, TBSCertificate and then the optional version, serial number,
+            # signature algorithm and issuer come before the validity
+            pos = element(element(0)[1])[1]
+            if element(pos)[0] == 0xa0:
+                pos = element(pos)[2]
+            for _ in range(3):
+                pos = element(pos)[2]
+            not_before = element(pos)[1]
+            tag, start, end = element(element(not_before)[2])
+            text = bytes(data[start:end]).decode("ascii")
+            if tag == 0x17:
+                # UTCTime has two digit years, 50 and up are in the 1900s
+                year, text = int(text[:2]), text[2:]
+                year += 1900 if year >= 50 else 2000
+            else:
+                year, text = int(text[:4]), text[4:]
+            return calendar.timegm((year, int(text[0:2]), int(text[2:4]), int(text[4:6]), int(text[6:8]),
+                                    int(text[8:10]), 0, 0, 0))
+        except (IndexError, ValueError):
+            return None
+
+    def close(self):
+        pass
+
+
+class GroupProbe(object):
+    """Checks a group of mirrors, a section named group:<name> with a members option listing
+    their urls. The group is up as soon as quorum members (default 1) are up and down as soon
+    as that can no longer happen, the checks of the other members are then cancelled. The
+    other options of the group, like probe, timeout or expect, are used for the members."""
+
+    PREFIX = "group:"
+    GROUP_KEYS = ("members", "quorum")
+
+    def __init__(self, alive, concurrency=10):
+        self.__alive = alive
+        # Members of all groups checked at the same time
+        self.__slots = threading.Semaphore(concurrency)
+
+    def check_async(self, loop, executor, site):
+        return loop.run_in_executor(executor, self.__alive.get_running_checks().call, site, self.check)
+
+    def check(self, site):
+        values = dict((key, value) for key, value in site.get_options().items() if key not in self.GROUP_KEYS)
+        members = [Site(url, self.__alive, values) for url in site.get_option("members", "").split()]
+        if not members:
+            self.__alive.write_warn("Group %s has no members\n" % site.get_url())
+            return Result.GENERIC
+        quorum = min(max(int(site.get_float("quorum", 1)), 1), len(members))
+        running = self.__alive.get_running_checks()
+        results = queue.Queue()
+
+        def cancel():
+            running.cancel(*members)
+            results.put((None, None))
+        # Cancelling the group cancels its members
+        RunningChecks.add_current(cancel)
+        for member in members:
+            running.track(member)
+            thread = threading.Thread(target=self.check_member, args=(member, results),
+                                      name="%s member %s" % (site.get_url(), member.get_url()))
+            thread.daemon = True
+            thread.start()
+        up, down, res = 0, 0, None
+        try:
+            while up < quorum and len(members) - down >= quorum:
+                member, member_res = results.get()
+                if member is None:
+                    return Result.GENERIC
+                self.__alive.write_debug("Member %s of %s: %d\n" % (member.get_url(), site.get_url(), member_res))
+                if member_res in (Result.OK, Result.AUTH):
+                    up += 1
+                else:
+                    down += 1
+                    res = member_res if res is None else res
+        finally:
+            running.cancel(*members)
+        return Result.OK if up >= quorum else res
+
+    def check_member(self, member, results):
+        """Check a member when a slot is free, within --concurrency and --per-host"""
+        running = self.__alive.get_running_checks()
+        limiter = self.__alive.get_host_limiter()
+        res = Result.GENERIC
+        with self.__slots:
+            key = limiter.key(member) if limiter else None
+            if limiter:
+                limiter.acquire(key)
+            try:
+                if not running.is_cancelled(member):
+                    res = running.call(member, self.__alive.get_probe(member.get_probe_type()).check)
+            except Exception:  # pylint: disable=W0703
+                res = Result.GENERIC
+            finally:
+                running.forget(member)
+                if limiter:
+                    limiter.release(key)
+        results.put((member, res))
+
+    def close(self):
+        pass
+
+
+class WgetProbe(object):
+    """Checks a site by running wget in a child process. For sites with an expect option
+    the body is read from its stdout and wget is stopped once the match is decided."""
+
+    # Whether an event loop outside the main thread can watch child processes, before
+    # Python 3.8 the child watcher needs a loop in the main thread
+    ASYNC_CHILDREN = sys.version_info >= (3, 8)
+
+    def __init__(self, alive, timeout=40, tries=3, expect_limit=65536):
+        self.__alive = alive
+        self.__timeout = timeout
+        self.__tries = tries
+        self.__expect_limit = expect_limit
+
+    def command(self, site, stream=False):
+        """With stream the body is written to stdout instead of only checking that it exists"""
+        wget_args = ["wget", "--no-check-certificate", "--quiet", "--timeout=%g" % site.get_timeout(self.__timeout),
+                     "--tries=%d" % site.get_tries(self.__tries)] + (["-O", "-"] if stream else ["--spider"]) + [site.get_url()]
+        self.__alive.write_debug("Checking using cmd: '" + ' '.join(wget_args) + "'\n")
+        return wget_args
+
+    @staticmethod
+    def matched_result(matcher, status):
+        """The result when wget streamed the body to the matcher, status is None if wget was stopped early"""
+        if matcher.matched:
+            return Result.OK
+        return status or Result.CONTENT
+
+    def check(self, site):
+        matcher = site.get_matcher(self.__expect_limit)
+        if matcher is None:
+            wget = subprocess.Popen(args=self.command(site))
+            try:
+                RunningChecks.add_current(wget)
+            finally:
+                status = wget.wait()
+            return status
+        wget = subprocess.Popen(args=self.command(site, True), stdout=subprocess.PIPE)
+        try:
+            RunningChecks.add_current(wget)
+            complete = matcher.read(wget.stdout)
+        finally:
+            if wget.poll() is None:
+                try:
+                    wget.kill()
+                except OSError:
+                    pass
+            status = wget.wait()
+            wget.stdout.close()
+        return self.matched_result(matcher, status if complete else None)
+
+    def check_async(self, loop, executor, site):
+        """Returns a future with the exit code of wget, the child process is watched by the event
+        loop if it can, else the blocking check is run by the executor"""
+        if not self.ASYNC_CHILDREN:
+            return loop.run_in_executor(executor, self.__alive.get_running_checks().call, site, self.check)
+        result = asyncio.Future(loop=loop)
+        matcher = site.get_matcher(self.__expect_limit)
+
+        def finish(res):
+            if not result.done():
+                result.set_result(res)
+
+        def guarded(callback, wget=None):
+            """The callback of a task, the check fails instead of hanging if the task failed or was cancelled"""
+            def run(task):
+                try:
+                    callback(task)
+                except BaseException:  # pylint: disable=W0703
+                    if wget is not None and wget.returncode is None:
+                        try:
+                            wget.kill()
+                        except OSError:
+                            pass
+                    finish(Result.GENERIC)
+            return run
+
+        def started(task):
+            wget = task.result()
+            try:
+                self.__alive.get_running_checks().add(site, wget)
+            except socket.error:
+                # Cancelled while starting, the killed process is still waited for
+                loop.create_task(wget.wait()).add_done_callback(lambda _: finish(Result.GENERIC))
+                return
+            if matcher is None:
+                loop.create_task(wget.wait()).add_done_callback(guarded(lambda waited: finish(waited.result()), wget))
+            else:
+                loop.create_task(wget.stdout.read(BodyMatcher.CHUNK)).add_done_callback(
+                    guarded(lambda read: streamed(wget, read), wget))
+
+        def streamed(wget, read):
+            chunk = read.result()
+            if chunk and not matcher.feed(chunk) and not matcher.is_done():
+                loop.create_task(wget.stdout.read(BodyMatcher.CHUNK)).add_done_callback(
+                    guarded(lambda read: streamed(wget, read), wget))
+                return
+            if chunk and wget.returncode is None:
+                try:
+                    wget.kill()
+                except OSError:
+                    pass
+            # Drain what is left in the pipe, the process is only waited for once it is closed
+            loop.create_task(wget.communicate()).add_done_callback(
+                lambda _: finish(self.matched_result(matcher, None if chunk else wget.returncode)))
+
+        if matcher is None:
+            command = asyncio.create_subprocess_exec(*self.command(site))
+        else:
+            matcher.reset()
+            command = asyncio.create_subprocess_exec(*self.command(site, True), stdout=asyncio.subprocess.PIPE)
+        loop.create_task(command).add_done_callback(guarded(started))
+        return result
+
+    def close(self):
+        pass
+
+
+class ConfigStore(object):
+    """Keeps the state in the config file. Changes are only made to the config object,
+    save() then replaces the whole file atomically."""
+
+    SECTION = re.compile(r"\[(.+)\]")
+    # Whether update() writes the changes, here they are only written by save()
+    WRITES_UPDATES = False
+
+    def __init__(self, filename):
+        self.__filename = filename
+
+    def load(self, urls=None):
+        """The state, with urls given only their sections, the others are not parsed"""
+        config = configparser.ConfigParser()
+        if urls is None:
+            config.read(self.__filename)
+            return config
+        wanted = set(urls)
+        lines, keep = [], False
+        try:
+            with open(self.__filename) as configfile:
+                for line in configfile:
+                    match = self.SECTION.match(line.rstrip())
+                    if match:
+                        keep = match.group(1) in wanted
+                    if keep:
+                        lines.append(line)
+        except IOError:
+            return config
+        if hasattr(config, "read_file"):
+            config.read_file(lines, self.__filename)
+        else:
+            config.readfp(io.BytesIO("".join(lines)), self.__filename)
+        return config
+
+    def peek(self, urls):
+        """The saved state of urls, what the store keeps is left as it is"""
+        return self.load(urls)
+
+    def sections(self):
+        """The section names, read line by line without parsing the rest of the file"""
+        try:
+            configfile = open(self.__filename)
+        except IOError:
+            return
+        with configfile:
+            for line in configfile:
+                match = self.SECTION.match(line.rstrip())
+                if match:
+                    yield match.group(1)
+
+    def update(self, changes):
+        pass
+
+    def save(self, config, sections=None):
+        """Write the config, with sections given only those are taken from it and the
+        rest is kept as it is in the file"""
+        if sections is not None:
+            merged = self.load()
+            for section in config.sections():
+                if section in sections:
+                    if merged.has_section(section):
+                        merged.remove_section(section)
+                    merged.add_section(section)
+                    for key in config.options(section):
+                        merged.set(section, key, config.get(section, key, raw=True))
+            config = merged
+        self.write_file(config, self.__filename)
+        self.write_index(config)
+
+    def write_index(self, config):
+        """Write the sections sorted by next_due to a file next to the config, written
+        after it so an index older than the config file is known to be stale"""
+        index = self.__filename + ".due"
+        entries = sorted((Site.parse_float(config.get(url, "next_due", raw=True), 0)
+                          if config.has_option(url, "next_due") else 0, url) for url in config.sections())
+        with open(index + ".tmp", 'w') as indexfile:
+            for next_due, url in entries:
+                indexfile.write("%d %s\n" % (next_due, url))
+        os.rename(index + ".tmp", index)
+
+    def due(self, now):
+        """The URLs that are due at now from the index, None if there is no usable index"""
+        index = self.__filename + ".due"
+        try:
+            if os.path.getmtime(index) < os.path.getmtime(self.__filename):
+                return None
+            indexfile = open(index)
+        except (IOError, OSError):
+            return None
+        urls = []
+        with indexfile:
+            for line in indexfile:
+                next_due, url = line.rstrip("\n").split(" ", 1)
+                if float(next_due) > now:
+                    break
+                urls.append(url)
+        return urls
+
+    @staticmethod
+    def write_file(config, filename):
+        """Write to a temporary file that is renamed over the old one, so a
+        crash while writing leaves either the old or the new file"""
+        tmpname = filename + ".tmp"
+        with open(tmpname, 'w') as configfile:
+            os.chmod(tmpname, stat.S_IRUSR | stat.S_IWUSR)
+            config.write(configfile)
+            configfile.flush()
+            os.fsync(configfile.fileno())
+        os.rename(tmpname, filename)
+
+    def close(self):
+        pass
+
+
+class SqliteStore(object):
+    """Keeps the state in an SQLite database. Each update() is written at once in its own
+    transaction, save() only writes what differs from the database. A read only store
+    ignores all changes."""
+
+    WRITES_UPDATES = True
+
+    def __init__(self, filename, read_only=False):
+        self.__filename = filename
+        self.__read_only = read_only
+        self.__db = None
+        self.__lock = threading.Lock()
+        # What is in the database, (url, key) -> value and the set of urls
+        self.__saved = {}
+        self.__sections = set()
+
+    def connect(self):
+        if self.__db is None:
+            self.__db = sqlite3.connect(self.__filename, check_same_thread=False)
+            with self.__db:
+                self.__db.execute("CREATE TABLE IF NOT EXISTS sites (url TEXT PRIMARY KEY)")
+                self.__db.execute("CREATE TABLE IF NOT EXISTS options (url TEXT NOT NULL, key TEXT NOT NULL, "
+                                  "value TEXT NOT NULL, PRIMARY KEY (url, key))")
+                # The next_due option of every site, indexed so --due does not read all sites
+                indexed = self.__db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'due'").fetchone()
+                self.__db.execute("CREATE TABLE IF NOT EXISTS due (url TEXT PRIMARY KEY, next_due REAL NOT NULL)")
+                self.__db.execute("CREATE INDEX IF NOT EXISTS due_next ON due (next_due)")
+                if not indexed:
+                    self.__db.execute("INSERT INTO due (url, next_due) SELECT url, 0 FROM sites")
+                    self.__db.execute("INSERT OR REPLACE INTO due (url, next_due) SELECT url, CAST(value AS REAL) "
+                                      "FROM options WHERE key = 'next_due'")
+            os.chmod(self.__filename, stat.S_IRUSR | stat.S_IWUSR)
+        return self.__db
+
+    # URLs looked up in one query when only some sites are loaded
+    LOAD_BATCH = 500
+
+    def load(self, urls=None):
+        """The state, with urls given only their sites. Only those are saved by save() then,
+        it must be given them as sections."""
+        config = configparser.ConfigParser()
+        with self.__lock:
+            self.__saved = {}
+            self.__sections = set()
+            self.read(config, urls)
+        return config
+
+    def fetch(self, config, urls):
+        """Add the sites of urls to the config, keeping the ones loaded before, so sites can
+        be loaded while others are checked"""
+        with self.__lock:
+            self.read(config, [url for url in urls if not config.has_section(url)])
+
+    def peek(self, urls):
+        """The saved state of urls, what the store keeps is left as it is"""
+        config = configparser.ConfigParser()
+        with self.__lock:
+            self.read(config, urls, False)
+        return config
+
+    def read(self, config, urls, keep=True):
+        """Add the sites of urls, all sites with None, to config and with keep to what is
+        kept of the database, the lock must be held"""
+        db = self.connect()
+        if urls is None:
+            queries = [("SELECT url FROM sites ORDER BY rowid", "SELECT url, key, value FROM options ORDER BY rowid",
+                        ())]
+        else:
+            urls = list(urls)
+            queries = []
+            for start in range(0, len(urls), self.LOAD_BATCH):
+                batch = tuple(urls[start:start + self.LOAD_BATCH])
+                where = "WHERE url IN (%s) ORDER BY rowid" % ", ".join("?" * len(batch))
+                queries.append(("SELECT url FROM sites " + where, "SELECT url, key, value FROM options " + where,
+                                batch))
+        for sites, options, args in queries:
+            for (url,) in db.execute(sites, args):
+                config.add_section(url)
+                if keep:
+                    self.__sections.add(url)
+            for url, key, value in db.execute(options, args):
+                config.set(url, key, value)
+                if keep:
+                    self.__saved[(url, key)] = value
+
+    def sections(self):
+        with self.__lock:
+            cursor = self.connect().execute("SELECT url FROM sites ORDER BY rowid")
+        for (url,) in cursor:
+            yield url
+
+    def update(self, changes):
+        """Write the changed (url, key, value) options"""
+        with self.__lock:
+            changes = [change for change in changes if self.__saved.get(change[:2]) != change[2]]
+            if self.__read_only or not changes:
+                return
+            db = self.connect()
+            with db:
+                new = [(url,) for url in sorted(set(change[0] for change in changes)) if url not in self.__sections]
+                db.executemany("INSERT OR IGNORE INTO sites (url) VALUES (?)", new)
+                db.executemany("INSERT OR IGNORE INTO due (url, next_due) VALUES (?, 0)", new)
+                db.executemany("INSERT OR REPLACE INTO options (url, key, value) VALUES (?, ?, ?)", changes)
+                db.executemany("UPDATE due SET next_due = ? WHERE url = ?",
+                               [(Site.parse_float(value, 0), url) for url, key, value in changes if key == "next_due"])
+            for url, key, value in changes:
+                self.__sections.add(url)
+                self.__saved[(url, key)] = value
+
+    def save(self, config, sections=None):
+        """Write what differs from the database, with sections given only those sections"""
+        if self.__read_only:
+            return
+        owned = set(config.sections()) if sections is None else set(config.sections()) & set(sections)
+        current = {}
+        for section in owned:
+            for key in config.options(section):
+                current[(section, key)] = config.get(section, key, raw=True)
+        with self.__lock:
+            # Sites and options of other sections are left alone
+            saved = dict(item for item in self.__saved.items() if sections is None or item[0][0] in sections)
+            known = self.__sections if sections is None else self.__sections & set(sections)
+            new = [url for url in config.sections() if url in owned and url not in self.__sections]
+            due = set(new) | set(url for url, key in set(saved) | set(current)
+                                 if key == "next_due" and saved.get((url, key)) != current.get((url, key)))
+            db = self.connect()
+            with db:
+                db.executemany("INSERT INTO sites (url) VALUES (?)", [(url,) for url in new])
+                db.executemany("DELETE FROM sites WHERE url = ?", [(url,) for url in known - owned])
+                db.executemany("DELETE FROM due WHERE url = ?", [(url,) for url in known - owned])
+                db.executemany("INSERT OR REPLACE INTO due (url, next_due) VALUES (?, ?)",
+                               [(url, Site.parse_float(current.get((url, "next_due")), 0)) for url in due])
+                db.executemany("DELETE FROM options WHERE url = ? AND key = ?",
+                               [item for item in saved if item not in current])
+                db.executemany("INSERT OR REPLACE INTO options (url, key, value) VALUES (?, ?, ?)",
+                               [item + (value,) for item, value in current.items() if saved.get(item) != value])
+            self.__sections = (self.__sections - known) | owned
+            for item in saved:
+                del self.__saved[item]
+            self.__saved.update(current)
+
+    def forget(self, config, urls):
+        """Drop the written sites from the config and from what is kept of the database"""
+        with self.__lock:
+            for url in urls:
+                if config.has_section(url):
+                    for key in config.options(url):
+                        self.__saved.pop((url, key), None)
+                    config.remove_section(url)
+                self.__sections.discard(url)
+
+    def due(self, now):
+        """The URLs that are due at now, the ones due the longest first"""
+        with self.__lock:
+            cursor = self.connect().execute("SELECT url FROM due WHERE next_due <= ? ORDER BY next_due, rowid", (now,))
+            return [url for (url,) in cursor]
+
+    def close(self):
+        with self.__lock:
+            if self.__db is not None:
+                self.__db.close()
+                self.__db = None
+
+
+class SiteLocks(object):
+    """Claims sites with byte range locks on the lock file, one byte per site chosen by
+    hashing the URL. The locks belong to the process and go away when it exits, so several
+    runs can check disjoint sites against the same state. Byte 0 guards writing the state.
+    The sites are hashed into SLOTS bytes, so a run takes at most that many locks and the
+    kernel merges them into a few ranges. Sites that share a byte share its lock, a site
+    of another run that shares one with ours is taken for claimed by that run.
+    While a claimed site is checked the same byte is also locked in a second file, until
+    its state is written, so other runs can wait for its result without waiting for the
+    claim, which is held for the whole run."""
+
+    # Locking a byte gets slower with each lock the process holds apart from it
+    SLOTS = 4096
+    # Seconds between tries when waiting for a site
+    POLL = 0.05
+
+    def __init__(self, filename):
+        self.__fd = os.open(filename, os.O_RDWR | os.O_CREAT, stat.S_IRUSR | stat.S_IWUSR)
+        self.__marks = os.open(filename + ".checking", os.O_RDWR | os.O_CREAT, stat.S_IRUSR | stat.S_IWUSR)
+        self.__claimed = set()
+        # offset -> number of claimed sites locking it
+        self.__held = {}
+        # offset -> URLs being checked, marks are made from the thread reading --input too
+        self.__checking = {}
+        self.__lock = threading.Lock()
+
+    def offset(self, url):
+        return 1 + HashRing.hash(url) % self.SLOTS
+
+    def claim(self, url):
+        """Try to lock the site, returns False if another process has it. Claims are made
+        from the thread reading --input while the main thread releases others."""
+        with self.__lock:
+            if url not in self.__claimed:
+                offset = self.offset(url)
+                if offset not in self.__held:
+                    try:
+                        fcntl.lockf(self.__fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+                    except (IOError, OSError) as err:
+                        if err.errno not in (errno.EACCES, errno.EAGAIN):
+                            raise
+                        return False
+                self.__held[offset] = self.__held.get(offset, 0) + 1
+                self.__claimed.add(url)
+        return True
+
+    def start_check(self, url):
+        """Mark a claimed site as being checked, until end_check() once its state is written.
+        Its claim keeps other runs from marking the byte."""
+        offset = self.offset(url)
+        with self.__lock:
+            if offset not in self.__checking:
+                fcntl.lockf(self.__marks, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+                self.__checking[offset] = set()
+            self.__checking[offset].add(url)
+
+    def end_check(self, url):
+        offset = self.offset(url)
+        with self.__lock:
+            urls = self.__checking.get(offset)
+            if urls is not None and url in urls:
+                urls.discard(url)
+                if not urls:
+                    del self.__checking[offset]
+                    fcntl.lockf(self.__marks, fcntl.LOCK_UN, 1, offset)
+
+    def end_checks(self):
+        """Unmark all sites, once the state is written"""
+        with self.__lock:
+            for offset in self.__checking:
+                fcntl.lockf(self.__marks, fcntl.LOCK_UN, 1, offset)
+            self.__checking = {}
+
+    def is_checking(self, url):
+        """Whether another run is checking the site, which this run has not claimed"""
+        offset = self.offset(url)
+        with self.__lock:
+            if offset in self.__checking:
+                return False
+            try:
+                fcntl.lockf(self.__marks, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+            except (IOError, OSError) as err:
+                if err.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+                return True
+            fcntl.lockf(self.__marks, fcntl.LOCK_UN, 1, offset)
+        return False
+
+    def release(self, url):
+        """Give up a claimed site, once its state has been written"""
+        with self.__lock:
+            if url in self.__claimed:
+                offset = self.offset(url)
+                self.__held[offset] -= 1
+                if not self.__held[offset]:
+                    # No other claimed site shares the byte
+                    del self.__held[offset]
+                    fcntl.lockf(self.__fd, fcntl.LOCK_UN, 1, offset)
+                self.__claimed.discard(url)
+
+    def is_claimed(self, url):
+        return url in self.__claimed
+
+    def get_claimed(self):
+        with self.__lock:
+            return set(self.__claimed)
+
+    def lock_state(self):
+        """Waits until no other process is writing the state"""
+        fcntl.lockf(self.__fd, fcntl.LOCK_EX, 1, 0)
+
+    def unlock_state(self):
+        fcntl.lockf(self.__fd, fcntl.LOCK_UN, 1, 0)
+
+    def close(self):
+        os.close(self.__fd)
+        os.close(self.__marks)
+        self.__claimed = set()
+        self.__held = {}
+        self.__checking = {}
+
+
+class MailDispatcher(threading.Thread):
+    """Sends the notification mails from a background thread, reusing one SMTP session.
+    With a digest window all notifications within the window are merged into one mail,
+    a window of 0 merges everything until close() is called at the end of the run.
+    Mails that could not be sent are tried again every RETRY_INTERVAL seconds, the
+    ones still not sent when closing are returned by close()."""
+
+    RETRY_INTERVAL = 60
+
+    def __init__(self, alive, digest_window=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.__alive = alive
+        self.__window = digest_window
+        self.__queue = queue.Queue()
+        self.__pending = []
+        self.__unsent = []
+        self.__retry = None
+        self.__smtp = None
+        # id(item) -> item of the queued mails not sent yet
+        self.__outstanding = {}
+        self.__lock = threading.Lock()
+
+    def notify(self, subject, body, change=None):
+        """Queue a mail, change is handed back by close() if the mail could not be sent"""
+        item = (subject, body, change)
+        with self.__lock:
+            self.__outstanding[id(item)] = item
+        self.__queue.put(item)
+
+    def close(self, timeout=None):
+        """Send what is left and end the SMTP session, returns the (subject, body, change)
+        of the mails that could not be sent. After timeout seconds the dispatcher is left
+        to itself and the mails it has not sent yet are returned too."""
+        self.__queue.put(None)
+        self.join(timeout)
+        with self.__lock:
+            return list(self.__outstanding.values())
+
+    def run(self):
+        deadline = None
+        while True:
+            wakeups = [when for when in (deadline, self.__retry) if when is not None]
+            try:
+                item = self.__queue.get(timeout=max(0, min(wakeups) - time.time()) if wakeups else None)
+            except queue.Empty:
+                if deadline is not None and time.time() >= deadline:
+                    self.send_digest()
+                    deadline = None
+                if self.__retry is not None and time.time() >= self.__retry:
+                    items, self.__unsent, self.__retry = self.__unsent, [], None
+                    self.send_items(items)
+                continue
+            if item is None:
+                break
+            if self.__window is None:
+                self.send_items([item])
+            else:
+                self.__pending.append(item)
+                if self.__window and deadline is None:
+                    deadline = time.time() + self.__window
+        # The last try, together with the ones that failed before
+        items, self.__unsent, self.__pending = self.__unsent + self.__pending, [], []
+        self.__unsent = self.deliver(items)
+        self.disconnect()
+
+    def send_digest(self):
+        items, self.__pending = self.__pending, []
+        self.send_items(items)
+
+    def send_items(self, items):
+        unsent = self.deliver(items)
+        if unsent:
+            self.__unsent += unsent
+            if self.__retry is None:
+                self.__retry = time.time() + self.RETRY_INTERVAL
+
+    def deliver(self, items):
+        """Send the mails, as one digest with a window, returns the ones that could not be sent"""
+        if self.__window is None or len(items) == 1:
+            unsent = [item for item in items if not self.send(item[0], item[1])]
+        elif items and not self.send("%d sites changed state" % len(items),
+                                     "\n".join("%s: %s" % item[:2] for item in items)):
+            unsent = items
+        else:
+            unsent = []
+        with self.__lock:
+            for item in items:
+                if not any(item is other for other in unsent):
+                    self.__outstanding.pop(id(item), None)
+        return unsent
+
+    def send(self, subject, body):
+        options = self.__alive.options
+        msg = mimetext.MIMEText(body)
+        msg['Subject'] = subject
+        if options.FROM:
+            msg['From'] = options.FROM
+        msg['To'] = options.TO
+        # A reused session may have been closed by the server, then try once more with a new one
+        for _ in range(2):
+            try:
+                if self.__smtp is None:
+                    self.__smtp = self.connect()
+                self.__smtp.sendmail(options.FROM, [options.TO], msg.as_string())
+                return True
+            except smtplib.SMTPServerDisconnected:
+                self.__smtp = None
+            except (IOError, smtplib.SMTPException) as err:
+                self.__alive.write_warn("Could not send email '%s' (%s), do you have an SMTP server running on %s?\n" %
+                                        (subject, err, options.SMTP))
+                self.disconnect()
+                return False
+        return False
+
+    def connect(self):
+        smtp = smtplib.SMTP()
+        if self.__alive.options.DEBUG:
+            smtp.set_debuglevel(True)
+        smtp.connect(self.__alive.options.SMTP)
+        return smtp
+
+    def disconnect(self):
+        if self.__smtp is not None:
+            try:
+                self.__smtp.quit()
+            except (IOError, smtplib.SMTPException):
+                pass
+            self.__smtp = None
+
+
+class JsonLinesReporter(object):
+    """Writes one JSON object per checked site. The records are buffered and written
+    together every flush_every records, 0 only writes them when flushed or closed."""
+
+    def __init__(self, stream, flush_every=1):
+        self.__stream = stream
+        self.__flush_every = flush_every
+        self.__buffer = []
+        self.__lock = threading.Lock()
+
+    def add(self, site, state, previous, saved=True, cached=False):
+        record = {"url": site.get_url(), "state": state, "previous": previous,
+                  "changed": previous not in (None, state) and state != "unknown", "duration": None, "result": None,
+                  "time": int(time.time())}
+        if state != "unknown":
+            record["duration"] = round(site.get_time_spent(), 3)
+            record["result"] = site.get_res()
+        if site.get_cert_expires():
+            record["cert_expires"] = site.get_cert_expires()
+        if not saved:
+            record["saved"] = False
+        if cached:
+            record["cached"] = True
+        with self.__lock:
+            self.__buffer.append(json.dumps(record, sort_keys=True) + "\n")
+            if self.__flush_every and len(self.__buffer) >= self.__flush_every:
+                self.write()
+
+    def write(self):
+        if self.__buffer:
+            self.__stream.write("".join(self.__buffer))
+            self.__stream.flush()
+            self.__buffer = []
+
+    def flush(self):
+        with self.__lock:
+            self.write()
+
+    def close(self):
+        self.flush()
+
+
+class Metrics(object):
+    """Counters and timings of the checks and runs, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__in_flight = 0
+        self.__results = {}
+        # name -> [sum, count]
+        self.__summaries = {"check": [0.0, 0], "queue_wait": [0.0, 0]}
+        self.__phases = {}
+        self.__retries = 0
+        self.__runs = 0
+        self.__last_run = 0.0
+
+    def check_started(self, queue_wait):
+        with self.__lock:
+            self.__in_flight += 1
+            self.add(self.__summaries["queue_wait"], queue_wait)
+
+    def check_finished(self, res, duration, phases):
+        with self.__lock:
+            self.__in_flight -= 1
+            self.__results[res] = self.__results.get(res, 0) + 1
+            self.add(self.__summaries["check"], duration)
+            for phase, seconds in (phases or {}).items():
+                if phase == "retries":
+                    self.__retries += seconds
+                else:
+                    self.add(self.__phases.setdefault(phase, [0.0, 0]), seconds)
+
+    def run_finished(self, duration):
+        with self.__lock:
+            self.__runs += 1
+            self.__last_run = duration
+
+    @staticmethod
+    def add(summary, value):
+        summary[0] += value
+        summary[1] += 1
+
+    def render(self):
+        with self.__lock:
+            lines = ["# HELP alive_checks_in_flight Checks currently running.",
+                     "# TYPE alive_checks_in_flight gauge",
+                     "alive_checks_in_flight %d" % self.__in_flight,
+                     "# HELP alive_checks_total Finished checks by result code (the wget exit codes).",
+                     "# TYPE alive_checks_total counter"]
+            lines += ['alive_checks_total{result="%d"} %d' % item for item in sorted(self.__results.items())]
+            lines += ["# HELP alive_check_retries_total Tries made after the first one.",
+                      "# TYPE alive_check_retries_total counter",
+                      "alive_check_retries_total %d" % self.__retries]
+            for name, help_text in (("check", "Wall time of the checks."),
+                                    ("queue_wait", "Time from a check being scheduled until it started.")):
+                lines += ["# HELP alive_%s_seconds %s" % (name, help_text), "# TYPE alive_%s_seconds summary" % name,
+                          "alive_%s_seconds_sum %f" % (name, self.__summaries[name][0]),
+                          "alive_%s_seconds_count %d" % (name, self.__summaries[name][1])]
+            lines += ["# HELP alive_check_phase_seconds Time spent in each phase of the in-process checks.",
+                      "# TYPE alive_check_phase_seconds summary"]
+            for phase, (total, count) in sorted(self.__phases.items()):
+                lines += ['alive_check_phase_seconds_sum{phase="%s"} %f' % (phase, total),
+                          'alive_check_phase_seconds_count{phase="%s"} %d' % (phase, count)]
+            lines += ["# HELP alive_runs_total Finished runs.",
+                      "# TYPE alive_runs_total counter",
+                      "alive_runs_total %d" % self.__runs,
+                      "# HELP alive_run_duration_seconds Wall time of the last run.",
+                      "# TYPE alive_run_duration_seconds gauge",
+                      "alive_run_duration_seconds %f" % self.__last_run]
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(object):
+    """Serves the metrics on /metrics, mixed into the BaseHTTPRequestHandler by start_metrics_server"""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HashRing(object):
+    """Consistent hashing of URLs to shards. Each shard has many points on the ring so the
+    URLs are spread evenly, and going from N to N + 1 shards only moves about 1/(N + 1) of them."""
+
+    POINTS = 100
+
+    def __init__(self, shards):
+        ring = sorted((self.hash("%d-%d" % (shard, point)), shard) for shard in range(shards) for point in range(self.POINTS))
+        self.__keys = [key for key, _ in ring]
+        self.__shards = [shard for _, shard in ring]
+
+    @staticmethod
+    def hash(text):
+        return int(hashlib.md5(text.encode("utf-8")).hexdigest()[:16], 16)
+
+    def shard(self, url):
+        return self.__shards[bisect.bisect(self.__keys, self.hash(url)) % len(self.__keys)]
 
 
 class Color(object):
@@ -162,12 +2363,40 @@ class Color(object):
 
 class Alive(object):
     """
-    This class takes as input a URL and checks with wget if it can be accessed,
+    This class takes as input a URL and checks if it can be accessed,
     with mail notifications when the site goes up or down.
     """
 
+    BACKENDS = {"http": HttpProbe, "wget": WgetProbe}
+    # Seconds the checks cancelled at the deadline get to end
+    CANCEL_GRACE = 1
+    # With --input, sites read ahead for each check that can run at once and sites synced together
+    INPUT_AHEAD = 2
+    SYNC_BATCH = 1000
+    # Sites with the probe option set to one of these are checked by it instead of the backend
+    PROBES = {"tcp": SocketProbe, "tls": SocketProbe}
+
     def __init__(self):
         self.options = None
+        self.__probes = {}
+        # The threads of the first checks all ask for the probe at once
+        self.__probe_lock = threading.Lock()
+        self.__store = None
+        # Whether only some sections of the state were loaded, then only those are saved
+        self.__partial = False
+        # When setup() was called, the run and its --deadline start then
+        self.__run_start = None
+        self.__locks = None
+        self.__mailer = None
+        self.__reporter = None
+        self.__triggers = None
+        self.__resolver = None
+        self.__running = RunningChecks()
+        # Sites of this run answered with the result of an earlier check
+        self.__cached = set()
+        self.__limiter = None
+        self.__metrics = Metrics()
+        self.__stop = threading.Event()
 
     def permission_check(self, file_name):
         """Check permissions"""
@@ -194,41 +2423,53 @@ class Alive(object):
 
         parser = OptionParser(usage="%prog [options]",
                               description=("This script takes as input one or several URLs "
-                                           "and checks with wget if they can be accessed."))
+                                           "and checks if they can be accessed."))
         (self.options, args) = self.add_options(parser).parse_args()
+        self.close_store()
+        self.close_locks()
+        self.__limiter = None
 
         if self.options.DEBUG:
             self.permission_check(sys.argv[0])
-            self.permission_check(self.options.CONFIGFILE)
+            self.permission_check(self.get_state_file())
 
-        if not (self.options.URL or self.options.KNOWN or self.options.LIST) or len(args):
+        if not (self.options.URL or self.options.KNOWN or self.options.DUE or self.options.INPUT or self.options.LIST or
+                self.options.DAEMON or
+                self.options.IMPORT or self.options.EXPORT or self.options.PERCENTILES) or len(args):
             parser.print_help()
             return False
 
-        # Lock such that several instances does not work with the same config file simultaneously
-        lockfilename = self.options.CONFIGFILE + "_lock"
-        if os.path.exists(lockfilename):
-            self.write("Lock file '%s' exists\n" % lockfilename)
-            # Read pid from lock file
-            with open(lockfilename) as lockfile:
-                pid = lockfile.readline()
-            if re.match('\d+', pid):
-                if int(pid) == os.getpid():
-                    self.write("We have a lockfile for ourself, ignoring\n")
-                elif os.path.exists("/proc/" + pid):
-                    self.write_warn("Another process (%s) is still alive, aborting.\n" % pid)
-                    sys.exit(1)
-                else:
-                    self.write_warn(("we had a lock file but the process is no longer alive. "
-                                     "Deleting lock file and will continue...\n"))
-                    os.remove(lockfilename)
-            else:
-                self.write_warn("The lockfile did not contain a valid pid. Please check it manually. Aborting.")
-                sys.exit(1)
-
-        # We are not locked, then create our lockfile
-        with open(lockfilename, 'w') as lockfile:
-            lockfile.write("%s" % os.getpid())
+        if self.options.STATE == "sqlite" and not sqlite3.available():
+            parser.error("the sqlite state store requires the sqlite3 module")
+
+        if self.options.MODE == "asyncio" and not (asyncio.available() and futures.available()):
+            parser.error("asyncio mode requires Python 3")
+        if self.options.CONCURRENCY < 1:
+            parser.error("--concurrency must be at least 1")
+        if self.options.TRIGGER_WORKERS < 1:
+            parser.error("--trigger-workers must be at least 1")
+        if self.options.HISTORY_SIZE < 1:
+            parser.error("--history-size must be at least 1")
+        if self.options.INTERVAL <= 0 or self.options.FLUSH_INTERVAL <= 0:
+            parser.error("--interval and --flush-interval must be positive")
+        if self.options.PER_HOST < 0:
+            parser.error("--per-host must not be negative")
+        if self.options.EXPECT_LIMIT < 1:
+            parser.error("--expect-limit must be at least 1")
+        if self.options.OUTPUT_FLUSH < 0:
+            parser.error("--output-flush must not be negative")
+
+        if self.options.SHARD is not None:
+            match = re.match(r"^(\d+)/(\d+)$", self.options.SHARD)
+            if not match or int(match.group(1)) >= int(match.group(2)):
+                parser.error("--shard must be I/N with 0 <= I < N")
+            self.options.SHARD = (int(match.group(1)), int(match.group(2)))
+        if self.options.SHARDS is not None and self.options.SHARDS < 1:
+            parser.error("--shards must be at least 1")
+        if self.options.SHARDS is not None and self.options.STRICT:
+            parser.error("--strict can not be used with --shards, the workers report in any order")
+        if self.options.INPUT and (self.options.SHARDS is not None or self.options.SHARD is not None):
+            parser.error("--input can not be used with --shards or --shard, the workers do not read it")
 
         return True
 
@@ -237,6 +2478,13 @@ class Alive(object):
                           help=("URL(s) to try to retrieve. You can write several URLs separated "
                                 "by space, but remember to quote the string."))
         parser.add_option("-q", "--quiet", action="store_true", dest="QUIET", help="Avoid all non warning prints")
+        parser.add_option("--format", dest="FORMAT", type="choice", choices=["text", "jsonl"], default="text",
+                          help=("How to write the results, 'text' for people and 'jsonl' for one JSON object per site "
+                                "with url, state, previous, changed, duration and result. Other output then goes to "
+                                "stderr. Default is text."))
+        parser.add_option("--output-flush", dest="OUTPUT_FLUSH", type="int", default=1, metavar="N",
+                          help=("With --format jsonl, write the buffered records every N records, 0 only at the end of "
+                                "the run or each --flush-interval in daemon mode. Default is 1."))
         parser.add_option("-n", "--nocolor", action="store_false", dest="COLOR", default=True,
                           help="Don't output colored text")
         parser.add_option("-d", "--debug", action="store_true", dest="DEBUG", help="Print debug messages")
@@ -244,36 +2492,194 @@ class Alive(object):
         parser.add_option("-t", "--to", dest="TO",
                           help=("to email address - If specified an email will "
                                 "be sent to this address if the site is down"))
+        parser.add_option("--smtp", dest="SMTP", default="localhost",
+                          help="SMTP server (host or host:port) used for sending mail. Default is localhost.")
+        parser.add_option("--digest", dest="DIGEST", action="store_true",
+                          help="Send one mail with all state changes of a run instead of one mail per change.")
+        parser.add_option("--digest-window", dest="DIGEST_WINDOW", type="float", default=0,
+                          help=("Seconds to collect state changes for one digest mail, implies --digest. By default "
+                                "a digest is sent at the end of each run, or every --flush-interval in daemon mode."))
         parser.add_option("-c", "--config", dest="CONFIGFILE", default="alive.cfg",
                           help="The configuration file. By default this is alive.cfg in the current directory.")
         parser.add_option("-k", "--test-known", dest="KNOWN", action="store_true",
                           help="Test all existing URLs in the cfg file.")
+        parser.add_option("--input", dest="INPUT", metavar="FILE",
+                          help=("Check the URLs in FILE, one or more on each line, or in stdin if FILE is -. The checks "
+                                "start while the file is read and only --concurrency sites are checked at the same "
+                                "time, also in threads mode. With --state sqlite the memory used does not grow with "
+                                "the number of URLs, the cfg state keeps all sites in memory until the end of the "
+                                "run."))
+        parser.add_option("--due", dest="DUE", action="store_true",
+                          help=("Like -k but only check the known URLs that are due, their --interval or interval option "
+                                "has passed since the last check. Sites that are down, changed state recently or got "
+                                "slower are checked first."))
         parser.add_option("-l", "--list", dest="LIST", action="store_true", help="List known URLs in the config file.")
+        parser.add_option("-p", "--percentiles", dest="PERCENTILES", action="store_true",
+                          help=("Show the 50th, 95th and 99th percentile of the check times of the URLs given with -u, "
+                                "or of all known URLs."))
+        parser.add_option("--history-size", dest="HISTORY_SIZE", type="int", default=50,
+                          help="Number of check times and results to keep for each site. Default is 50.")
         parser.add_option("-s", "--strict", dest="STRICT", action="store_true",
                           help="Strict ordering. Output can be slightly slower but guarantees that the site with shortest response time is printed first.")
+        parser.add_option("-b", "--backend", dest="BACKEND", type="choice", choices=sorted(self.BACKENDS), default="http",
+                          help=("How to check the sites, 'http' checks in-process and 'wget' runs wget. Sites with "
+                                "the probe option set to 'tcp' only get a connection opened, 'tls' also does the TLS "
+                                "handshake and records when the certificate expires. A group:<name> section "
+                                "with a members option is up once quorum (default 1) of its members are up, the "
+                                "checks of the other members are then cancelled. Default is http."))
+        parser.add_option("-m", "--mode", dest="MODE", type="choice", choices=["threads", "asyncio"], default="threads",
+                          help=("How to run the checks, 'threads' starts one thread per site and 'asyncio' runs "
+                                "them on one event loop limited by --concurrency. Default is threads."))
+        parser.add_option("--concurrency", dest="CONCURRENCY", type="int", default=100,
+                          help="Maximum number of simultaneous checks in asyncio mode and with --input. Default is 100.")
+        parser.add_option("--per-host", dest="PER_HOST", type="int", default=6, metavar="N",
+                          help=("Check at most N sites on the same scheme, host and port at the same time, they then "
+                                "share N keep-alive connections. 0 turns the limit off. Default is 6."))
+        parser.add_option("--daemon", dest="DAEMON", action="store_true",
+                          help=("Keep running and check the known URLs (and those given with -u) repeatedly, "
+                                "each site at its own interval."))
+        parser.add_option("--max-age", dest="MAX_AGE", type="float", metavar="SECONDS",
+                          help=("Use the result of the last check of a site if it is at most SECONDS old, only the "
+                                "other sites are checked. Sites that another run is checking get its result, they are "
+                                "waited for as long as their check may take and not past --deadline. With --input or "
+                                "--shards the results saved before are used but other runs are not waited for."))
+        parser.add_option("--deadline", dest="DEADLINE", type="float", default=0, metavar="SECONDS",
+                          help=("Seconds a run may take. The checks that have not finished by then are cancelled and "
+                                "their sites reported as unknown, without changing their state, and checked first by "
+                                "the next run. Default is no deadline."))
+        parser.add_option("--interval", dest="INTERVAL", type="float", default=60,
+                          help="Seconds between checks in daemon mode for sites without an interval option. Default is 60.")
+        parser.add_option("--flush-interval", dest="FLUSH_INTERVAL", type="float", default=300,
+                          help="Seconds between writes of the config file in daemon mode. Default is 300.")
+        parser.add_option("--state", dest="STATE", type="choice", choices=["cfg", "sqlite"], default="cfg",
+                          help=("Where to keep the state of the sites, 'cfg' rewrites the config file after each run and "
+                                "'sqlite' only writes the changed values to a database. Default is cfg."))
+        parser.add_option("--state-file", dest="STATE_FILE",
+                          help="The database file for the sqlite state. By default this is the config file name with .db appended.")
+        parser.add_option("--import", dest="IMPORT", metavar="FILE",
+                          help="Import the sections of a file in the config file format into the state.")
+        parser.add_option("--export", dest="EXPORT", metavar="FILE", help="Export the state to a file in the config file format.")
+        parser.add_option("--trigger-timeout", dest="TRIGGER_TIMEOUT", type="float", default=60,
+                          help=("Seconds a trigger may run before it is killed, can be set per site with the "
+                                "trigger_timeout option. Default is 60."))
+        parser.add_option("--trigger-workers", dest="TRIGGER_WORKERS", type="int", default=4,
+                          help="Maximum number of triggers running at the same time. Default is 4.")
+        parser.add_option("--dns-ttl", dest="DNS_TTL", type="float", default=300,
+                          help=("Seconds to cache name lookups for the in-process checks, 0 only caches the names that "
+                                "do not exist with --dns-negative-ttl. Default is 300."))
+        parser.add_option("--dns-negative-ttl", dest="DNS_NEGATIVE_TTL", type="float", default=0,
+                          help="Seconds to remember names that do not exist. Default is 0, they are looked up every time.")
+        parser.add_option("--metrics-file", dest="METRICS_FILE", metavar="FILE",
+                          help=("Write check and run metrics in the Prometheus text format to this file after each run, "
+                                "or at each flush in daemon mode."))
+        parser.add_option("--metrics-port", dest="METRICS_PORT", type="int",
+                          help="In daemon mode, serve the metrics on http://127.0.0.1:PORT/metrics.")
+        parser.add_option("--shards", dest="SHARDS", type="int",
+                          help=("Split the URLs into this many shards by consistent hashing, check each shard in a worker "
+                                "process and report the merged results."))
+        parser.add_option("--remote-workers", dest="REMOTE_WORKERS", action="store_true",
+                          help=("With --shards, do not start the workers but wait for workers started with --shard on other "
+                                "machines to write their results to the --shard-dir."))
+        parser.add_option("--shard", dest="SHARD", metavar="I/N",
+                          help="Run as worker for shard I of N: check only those URLs and write the results to the --shard-dir.")
+        parser.add_option("--shard-dir", dest="SHARD_DIR", metavar="DIR",
+                          help="Directory shared by the coordinator and the workers. By default the config file name with _shards appended.")
+        parser.add_option("--shard-wait", dest="SHARD_WAIT", type="float", default=600,
+                          help="Seconds the coordinator waits for remote workers. Default is 600.")
+        parser.add_option("--timeout", dest="TIMEOUT", type="float", default=40,
+                          help=("Timeout in seconds for each try, can be set per site with the timeout option. "
+                                "With --adaptive this is the maximum. Default is 40."))
+        parser.add_option("--tries", dest="TRIES", type="int", default=3,
+                          help="Number of tries before a site is considered down, can be set per site with the tries option. Default is 3.")
+        parser.add_option("--expect-limit", dest="EXPECT_LIMIT", type="int", default=65536, metavar="BYTES",
+                          help=("Sites with an expect (text) or expect_regex option are fetched and their body is read "
+                                "until the match is found or this many bytes have been read, then the site is down "
+                                "with result 9. Can be set per site with the expect_limit option. Default is 65536."))
+        parser.add_option("-a", "--adaptive", dest="ADAPTIVE", action="store_true",
+                          help=("Derive the timeout of each site from its latency history, and check sites that are down "
+                                "less often, doubling the delay after each failed check. Set 'backoff = no' for a site to "
+                                "always check it."))
+        parser.add_option("--min-timeout", dest="MIN_TIMEOUT", type="float", default=5,
+                          help="Smallest timeout used with --adaptive. Default is 5.")
+        parser.add_option("--backoff-base", dest="BACKOFF_BASE", type="float", default=60,
+                          help="Seconds until a site that just went down is checked again with --adaptive. Default is 60.")
+        parser.add_option("--backoff-max", dest="BACKOFF_MAX", type="float", default=3600,
+                          help="Longest time between checks of a site that is down with --adaptive. Default is 3600.")
         return parser
 
+    def get_metrics(self):
+        return self.__metrics
+
+    def write_metrics(self):
+        """Write the metrics to the --metrics-file, if given"""
+        if not self.options.METRICS_FILE:
+            return
+        tmpname = self.options.METRICS_FILE + ".tmp"
+        with open(tmpname, 'w') as metricsfile:
+            metricsfile.write(self.__metrics.render())
+        os.rename(tmpname, self.options.METRICS_FILE)
+
+    def start_metrics_server(self):
+        """Serve the metrics on 127.0.0.1:--metrics-port/metrics from a background thread"""
+        handler = type("MetricsHandler", (MetricsHandler, httpserver.BaseHTTPRequestHandler), {})
+        server = httpserver.HTTPServer(("127.0.0.1", self.options.METRICS_PORT), handler)
+        server.metrics = self.__metrics
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.write_debug("Serving metrics on http://127.0.0.1:%d/metrics\n" % server.server_address[1])
+        return server
+
+    def get_host_limiter(self):
+        """Returns the limit of simultaneous checks per host, None if turned off"""
+        if self.__limiter is None and self.options.PER_HOST > 0:
+            self.__limiter = HostLimiter(self.options.PER_HOST)
+        return self.__limiter
+
+    def get_running_checks(self):
+        """The checks that can be cancelled, by groups and at the deadline"""
+        return self.__running
+
+    def get_resolver(self):
+        """Returns the name lookup cache shared by all checks, None if turned off"""
+        if self.__resolver is None and (self.options.DNS_TTL > 0 or self.options.DNS_NEGATIVE_TTL > 0):
+            self.__resolver = ResolverCache(self.options.DNS_TTL, self.options.DNS_NEGATIVE_TTL)
+        return self.__resolver
+
+    def get_probe(self, kind="http"):
+        """Returns the probe for the probe type of a site, each is shared by all checks. Sites
+        of any other type than tcp and tls are checked by the backend."""
+        with self.__probe_lock:
+            probe = self.__probes.get(kind)
+            if probe is None:
+                if kind == "group":
+                    probe = GroupProbe(self, self.options.CONCURRENCY)
+                elif kind in self.PROBES:
+                    probe = self.PROBES[kind](self, self.options.TIMEOUT, self.options.TRIES, kind == "tls")
+                else:
+                    if kind != "http":
+                        self.write_warn("Unknown probe '%s', checking with %s\n" % (kind, self.options.BACKEND))
+                    probe = self.BACKENDS[self.options.BACKEND](self, self.options.TIMEOUT, self.options.TRIES,
+                                                                self.options.EXPECT_LIMIT)
+                self.__probes[kind] = probe
+        return probe
+
     def write(self, text, color=Color.CYAN):
-        """Writes the string only if not in quiet mode"""
-        if self.options.COLOR and color:
-            sys.stdout.write(color)
-        if not self.options.QUIET:
-            sys.stdout.write(text)
+        """Writes the string only if not in quiet mode. The output is flushed at the end of
+        each line, with --format jsonl it goes to stderr to keep stdout for the records."""
+        if self.options.QUIET:
+            return
         if self.options.COLOR and color:
-            sys.stdout.write(Color.RESET)
-        sys.stdout.flush()
+            text = color + text + Color.RESET
+        out = sys.stderr if self.options.FORMAT == "jsonl" else sys.stdout
+        out.write(text)
+        if text.endswith("\n") or text.endswith("\n" + Color.RESET):
+            out.flush()
 
     def write_debug(self, text, color=None):
         """Writes a string prefixed by Debug: only if in debug mode"""
-        if not self.options.DEBUG:
-            return
-        if self.options.COLOR and color:
-            sys.stdout.write(color)
-        if not self.options.QUIET:
-            sys.stdout.write("Debug: " + text)
-        if self.options.COLOR and color:
-            sys.stdout.write(Color.RESET)
-        sys.stdout.flush()
+        if self.options.DEBUG:
+            self.write("Debug: " + text, color)
 
     def write_warn(self, text, color=Color.YELLOW):
         """Writes a string prefixed by Warning: to stderr"""
@@ -284,69 +2690,668 @@ class Alive(object):
             sys.stderr.write(Color.RESET)
         sys.stderr.flush()
 
-    def wait_for_all_to_start(self, sites):
-        """Wait for all checks to start (for strict ordering)"""
-        while True:
-            if not all([s.has_started() for s in sites]):
-                time.sleep(0.1)
-            else:
-                break
-
-    def wait_for_later_sites(self, site, sites):
-        """Makes sure we allow time for the last started to check
-        to get a chance to finish before the currently fastest check
-        to ensure strict ordering"""
-        tsp = site.get_time_spent()
-        last = min(sites, key=lambda s: s.get_time_since_start())
-        to_wait = tsp - last.get_time_since_start()
-        if to_wait > 0:
-            time.sleep(to_wait)
-            SiteThread.results_queue.put(site)
-            return SiteThread.results_queue.get()
-        return site
-
     def check_urls(self, config, urls):
         """Will go through the url list and check if they are up"""
+        run_start = self.take_run_start()
+        deadline = run_start + self.options.DEADLINE if self.options.DEADLINE else None
+        sites = self.create_sites(config, urls)
+        stale = sites
+        if self.options.MAX_AGE is not None:
+            sites, stale = self.use_cached(config, sites, deadline)
+        self.start_marks(site.get_url() for site in stale)
+
+        order = None
+        if self.options.STRICT:
+            order = SiteThread.observer = StrictOrder(len(stale))
+        for site in sites:
+            if id(site) in self.__cached:
+                SiteThread.results_queue.put(site)
+        threads = self.start_checks(stale)
 
-        # Create Site objects
-        sites = []
+        unfinished = self.report_sites(sites, order, deadline, config)
+
+        if unfinished:
+            self.cancel_checks(threads, unfinished)
+        else:
+            # Just to be sure
+            for thread in threads:
+                thread.join()
+        SiteThread.observer = None
+        self.__cached = set()
+        if self.options.DEADLINE:
+            # Sites still in a thread stay cancelled until it is done, the others are forgotten
+            busy = set()
+            for thread in threads:
+                if thread.is_alive():
+                    busy.update(id(site) for site in ([thread.get_site()] if isinstance(thread, SiteThread)
+                                                      else unfinished))
+            running = self.get_running_checks()
+            for site in sites:
+                if id(site) not in busy:
+                    running.forget(site)
+
+        self.finish_run(config, sites, run_start, deadline)
+
+    @staticmethod
+    def input_urls(urls, stream):
+        """The given URLs and then the ones in the lines of stream, read as they are needed.
+        Empty lines and lines starting with # are skipped."""
         for url in urls:
-            sites += [Site(url, [config], self)]
+            yield url
+        for line in stream:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                for url in line.split():
+                    yield url
+
+    def check_input(self, config, urls):
+        """Check the given URLs and the ones read from --input while it is read. At most
+        INPUT_AHEAD sites for each check that can run at the same time are read ahead of
+        the reported ones, and the reported sites are synced in batches of SYNC_BATCH. When
+        the store writes the batches the state of a site is only loaded when it is read and
+        the synced sites are released and forgotten, so the memory used and the locks held
+        do not grow with the number of URLs, except for the sites whose triggers may still
+        be running. The cfg store keeps all of the state and the claims until the end.
+        At the deadline the input is no longer read and the sites read but not reported are
+        cancelled and reported as unknown."""
+        run_start = self.take_run_start()
+        deadline = run_start + self.options.DEADLINE if self.options.DEADLINE else None
+        try:
+            stream = sys.stdin if self.options.INPUT == "-" else open(self.options.INPUT)
+        except IOError as err:
+            self.write_warn("Can not read %s: %s\n" % (self.options.INPUT, err))
+            return
+        slots = threading.Semaphore(self.options.CONCURRENCY * self.INPUT_AHEAD)
+        # Sites are created while others are synced to the config
+        config_lock = threading.Lock()
+        streamed = self.streams_input()
+        runner, jobs, workers = None, None, []
+        if self.options.MODE == "asyncio":
+            runner = AsyncRunner(self, [], self.options.CONCURRENCY, persistent=True, limiter=self.get_host_limiter())
+            runner.daemon = deadline is not None
+            runner.start()
+        else:
+            jobs = queue.Queue()
+            for _ in range(self.options.CONCURRENCY):
+                worker = threading.Thread(target=SiteThread.work, args=(jobs, self.get_host_limiter()))
+                worker.daemon = deadline is not None
+                worker.start()
+                workers.append(worker)
+        # The number of sites to check, once all are read, and the number claimed by other runs
+        total, busy = [], [0]
+        # With a deadline, id(site) -> site of the sites read and not reported yet
+        pending, pending_lock, stopped = {}, threading.Lock(), threading.Event()
+
+        def read():
+            count = 0
+            try:
+                for url in self.input_urls(urls, stream):
+                    slots.acquire()
+                    if stopped.is_set():
+                        break
+                    with config_lock:
+                        if streamed:
+                            self.get_store().fetch(config, [url])
+                        site = self.new_site(config, url)
+                    if not self.claim_site(url):
+                        busy[0] += 1
+                    if self.options.ADAPTIVE and site.is_backing_off(time.time()):
+                        self.write_debug("%s is next checked at %s\n" % (url, time.ctime(site.get_next_check())))
+                        slots.release()
+                        continue
+                    count += 1
+                    if deadline is not None:
+                        self.get_running_checks().track(site)
+                        with pending_lock:
+                            pending[id(site)] = site
+                    cached = None
+                    if self.options.MAX_AGE is not None:
+                        cached = site.get_cached_result(self.options.MAX_AGE, time.time())
+                    if cached is not None:
+                        site.load_result(*cached)
+                        self.__cached.add(id(site))
+                        SiteThread.results_queue.put(site)
+                        continue
+                    self.start_marks([url])
+                    if runner:
+                        runner.submit([site])
+                    else:
+                        jobs.put(site)
+            except (IOError, UnicodeDecodeError) as err:
+                self.write_warn("Reading %s failed: %s\n" % (self.options.INPUT, err))
+            finally:
+                total.append(count)
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+
+        self.open_reporter()
+        reported, batch, triggered, expired = 0, [], set(), False
+        while not total or reported < total[0]:
+            timeout = None if total else 0.2
+            if deadline is not None:
+                remaining = max(0, deadline - time.time())
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            try:
+                site = SiteThread.results_queue.get(timeout=timeout)
+            except queue.Empty:
+                if deadline is not None and time.time() >= deadline:
+                    expired = True
+                    break
+                continue
+            if deadline is not None:
+                with pending_lock:
+                    pending.pop(id(site), None)
+            reported += 1
+            if self.__reporter is None:
+                self.write("[%d] %s: " % (reported, site.get_url()))
+            was_down = site.get_down()
+            self.report_result(site, 0)
+            # The ids of freed sites are used again
+            self.__cached.discard(id(site))
+            # Kept until the end of the run, when the results of their triggers and mails are known
+            if site.get_down() != was_down and (self.options.TO or site.get_trigger(site.get_down())):
+                triggered.add(site.get_url())
+            batch.append(site)
+            slots.release()
+            if len(batch) >= self.SYNC_BATCH:
+                if self.__triggers is not None:
+                    batch += self.__triggers.apply_results()
+                with config_lock:
+                    self.sync_sites(config, batch)
+                if self.get_store().WRITES_UPDATES:
+                    self.end_marks(site.get_url() for site in batch)
+                    released = self.release_sites(site.get_url() for site in batch if site.get_url() not in triggered)
+                    with config_lock:
+                        self.get_store().forget(config, released)
+                batch = []
+
+        if expired:
+            batch += self.cancel_input(reader, stopped, slots, runner, jobs, workers, pending, pending_lock, reported)
+        else:
+            if runner:
+                runner.stop()
+                runner.join()
+            for worker in workers:
+                jobs.put(None)
+            for worker in workers:
+                worker.join()
+        if stream is not sys.stdin and not reader.is_alive():
+            stream.close()
+        if busy[0]:
+            self.write("%d sites are claimed by another run, their state is not updated\n" % busy[0])
+        self.finish_run(config, batch, run_start, deadline)
+
+    def cancel_input(self, reader, stopped, slots, runner, jobs, workers, pending, pending_lock, reported):
+        """Stop reading --input at the deadline, cancel the checks of the sites read and report
+        them as unknown. Returns those sites."""
+        stopped.set()
+        # The reader may wait for a slot
+        for _ in range(self.options.CONCURRENCY * self.INPUT_AHEAD):
+            slots.release()
+        reader.join(self.CANCEL_GRACE)
+        with pending_lock:
+            unfinished = list(pending.values())
+            pending.clear()
+        running = self.get_running_checks()
+        if runner:
+            runner.cancel()
+            runner.stop()
+        else:
+            # Not started, they are forgotten at once
+            while True:
+                try:
+                    site = jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if site is not None:
+                    running.forget(site)
+            for worker in workers:
+                jobs.put(None)
+        running.cancel(*unfinished)
+        end = time.time() + self.CANCEL_GRACE
+        threads = [runner] if runner else workers
+        for thread in threads:
+            thread.join(max(0, end - time.time()))
+        # Results that came in after the deadline are not used
+        while True:
+            try:
+                SiteThread.results_queue.get_nowait()
+            except queue.Empty:
+                break
+        if not any(thread.is_alive() for thread in threads):
+            # Sites still in a thread stay cancelled until it is done
+            for site in unfinished:
+                running.forget(site)
+        self.write_warn("%d sites were not checked by the deadline\n" % len(unfinished))
+        for number, site in enumerate(unfinished, reported + 1):
+            if self.__reporter is None:
+                self.write("[%d] %s: " % (number, site.get_url()))
+            self.report_unknown(site, 0)
+        return unfinished
+
+    def use_cached(self, config, sites, deadline=None):
+        """Give the sites whose last check is at most --max-age old its result. A site that
+        another run claimed is waited for while that run marks it as being checked, at most
+        as long as its check may take and not past the deadline. Its state is then read
+        again so the result of that check can be used. Returns (all sites, the sites to
+        check)."""
+        now = time.time()
+        # URL -> when to stop waiting for it
+        busy = dict((site.get_url(), min(now + site.get_timeout(self.options.TIMEOUT) * site.get_tries(self.options.TRIES),
+                                         deadline or float("inf")))
+                    for site in sites if not self.is_claimed(site.get_url()) and
+                    site.get_cached_result(self.options.MAX_AGE, now) is None)
+        if busy:
+            self.write("Waiting for %d sites that are checked by another run\n" % len(busy))
+            waited = set()
+            while busy:
+                done = [url for url, end in busy.items() if time.time() >= end or not self.__locks.is_checking(url)]
+                if done:
+                    saved = self.get_store().peek(done)
+                    for url in done:
+                        del busy[url]
+                        if saved.has_section(url):
+                            waited.add(url)
+                            if config.has_section(url):
+                                config.remove_section(url)
+                            config.add_section(url)
+                            for key, value in saved.items(url, raw=True):
+                                config.set(url, key, value)
+                if busy:
+                    time.sleep(SiteLocks.POLL)
+            sites = [self.new_site(config, site.get_url()) if site.get_url() in waited else site for site in sites]
+
+        now = time.time()
+        stale = []
+        for site in sites:
+            cached = site.get_cached_result(self.options.MAX_AGE, now)
+            if cached is None:
+                stale.append(site)
+            else:
+                site.load_result(*cached)
+                self.__cached.add(id(site))
+        if self.__cached:
+            self.write("Using the result of the last check for %d of %d sites\n" % (len(self.__cached), len(sites)))
+        return sites, stale
+
+    def create_sites(self, config, urls):
+        """Create the Site objects, without the ones that are backing off"""
+        sites = [self.new_site(config, url) for url in urls]
+
+        if self.options.ADAPTIVE:
+            now = time.time()
+            waiting = [site for site in sites if site.is_backing_off(now)]
+            if waiting:
+                sites = [site for site in sites if not site.is_backing_off(now)]
+                self.write("Not checking %d sites that are down until their next check time\n" % len(waiting))
+                for site in waiting:
+                    self.write_debug("%s is next checked at %s\n" % (site.get_url(), time.ctime(site.get_next_check())))
+        if self.options.DUE or self.options.DEADLINE:
+            # Sorting is stable so the sites stay in due order within each class
+            sites.sort(key=lambda site: site.get_priority())
+        return sites
+
+    def start_checks(self, sites):
+        """Start checking the sites, returns the threads to join. With a deadline the checks
+        can be cancelled from the start and do not keep the process alive."""
+        threads = []
+        if self.options.DEADLINE:
+            running = self.get_running_checks()
+            for site in sites:
+                running.track(site)
+        if self.options.MODE == "asyncio":
+            threads.append(AsyncRunner(self, sites, self.options.CONCURRENCY, limiter=self.get_host_limiter()))
+        else:
+            threads += [SiteThread(site, self.get_host_limiter()) for site in sites]
+        for thread in threads:
+            thread.daemon = bool(self.options.DEADLINE)
+            thread.start()
+        return threads
+
+    def cancel_checks(self, threads, sites):
+        """Cancel the checks of the sites and give the threads a moment to end"""
+        for thread in threads:
+            if isinstance(thread, AsyncRunner):
+                thread.cancel()
+        self.get_running_checks().cancel(*sites)
+        end = time.time() + self.CANCEL_GRACE
+        for thread in threads:
+            thread.join(max(0, end - time.time()))
+        # Results that came in after the deadline are not used
+        while True:
+            try:
+                SiteThread.results_queue.get_nowait()
+            except queue.Empty:
+                break
 
+    def report_sites(self, sites, order=None, deadline=None, config=None):
+        """Report the results as they come in on the results queue. The sites without a result
+        by the deadline are reported as unknown and returned. With config and a store that
+        writes the updates, the reported sites are written whenever no result is waiting or
+        SYNC_BATCH are reported, so other runs waiting for them need not wait for the end."""
+        written = [] if config is not None and self.get_store().WRITES_UPDATES else None
+        self.open_reporter()
         state_pos = 20
         for site in sites:
             if len(site.get_url()) > state_pos:
                 state_pos = len(site.get_url())
 
-        threads = []
-        for site in sites:
-            thread = SiteThread(site)
-            threads.append(thread)
-            thread.start()
-
-        if self.options.STRICT:
-            self.wait_for_all_to_start(sites)
-
-        tlen = len(threads)
+        tlen = len(sites)
+        reported = set()
         for i in range(tlen):
-            site = SiteThread.results_queue.get()
-            if self.options.STRICT:
-                site = self.wait_for_later_sites(site, sites)
-            res = site.get_res()
-            self.write(("[{0:0%dd}/{1}] {2}: " % len(str(tlen))).format(i + 1, tlen, site.get_url()))
-            if res and res != 6:
-                self.report(site, True, state_pos)
-            else:
-                self.report(site, False, state_pos)
+            try:
+                if deadline is None:
+                    site = order.get() if order else SiteThread.results_queue.get()
+                else:
+                    site = order.get(deadline) if order else SiteThread.results_queue.get(
+                        timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                if written:
+                    self.write_reported(config, written)
+                unfinished = [site for site in sites if id(site) not in reported]
+                self.write_warn("%d of %d sites were not checked by the deadline\n" % (len(unfinished), tlen))
+                for j, site in enumerate(unfinished, i + 1):
+                    if self.__reporter is None:
+                        self.write(("[{0:0%dd}/{1}] {2}: " % len(str(tlen))).format(j, tlen, site.get_url()))
+                    self.report_unknown(site, state_pos)
+                return unfinished
+            if deadline is not None:
+                reported.add(id(site))
+            if self.__reporter is None:
+                self.write(("[{0:0%dd}/{1}] {2}: " % len(str(tlen))).format(i + 1, tlen, site.get_url()))
+            self.report_result(site, state_pos)
+            if written is not None:
+                written.append(site)
+                if len(written) >= self.SYNC_BATCH or SiteThread.results_queue.empty():
+                    self.write_reported(config, written)
+                    written = []
+        if written:
+            self.write_reported(config, written)
+        return []
+
+    def write_reported(self, config, sites):
+        """Write the state of reported sites, while the run goes on"""
+        self.sync_sites(config, sites)
+        self.end_marks(site.get_url() for site in sites)
+
+    def finish_run(self, config, sites, run_start, deadline=None):
+        """Wait for the mails and triggers, with a deadline no longer than it leaves, and
+        save the state of the sites"""
+        self.close_reporter()
+        self.close_probe()
+        sites = list(sites) + self.close_mailer(None if deadline is None else max(0, deadline - time.time()))
+        # After the triggers are done so their results are saved too
+        sites += self.close_trigger_runner(None if deadline is None else max(0, deadline - time.time()))
+        self.sync_sites(config, sites)
+        self.__metrics.run_finished(time.time() - run_start)
+        self.write_metrics()
+
+    def get_shard_dir(self):
+        return self.options.SHARD_DIR or self.options.CONFIGFILE + "_shards"
+
+    @staticmethod
+    def get_shard_file(directory, index, count):
+        return os.path.join(directory, "shard-%d-of-%d.json" % (index, count))
+
+    def run_shard(self, config, urls):
+        """Check the URLs of our shard and write the results for the coordinator, one JSON object per line"""
+        index, count = self.options.SHARD
+        ring = HashRing(count)
+        sites = self.create_sites(config, [url for url in urls if ring.shard(url) == index])
+        deadline = time.time() + self.options.DEADLINE if self.options.DEADLINE else None
+        lines = []
+        if self.options.MAX_AGE is not None:
+            # The coordinator reports these as cached, without waiting for other runs
+            stale = []
+            for site in sites:
+                cached = site.get_cached_result(self.options.MAX_AGE, time.time())
+                if cached is None:
+                    stale.append(site)
+                else:
+                    lines.append(json.dumps({"url": site.get_url(), "res": cached[0], "time": cached[1],
+                                             "phases": None, "cert_expires": None, "cached": True}))
+            sites = stale
+        threads = self.start_checks(sites)
+        for _ in sites:
+            try:
+                site = SiteThread.results_queue.get(timeout=None if deadline is None else max(0, deadline - time.time()))
+            except queue.Empty:
+                # The coordinator reports the sites without a result as unknown
+                self.cancel_checks(threads, sites)
+                break
+            lines.append(json.dumps({"url": site.get_url(), "res": site.get_res(), "time": site.get_time_spent(),
+                                     "phases": site.get_phases(), "cert_expires": site.get_cert_expires()}))
+        else:
+            for thread in threads:
+                thread.join()
+        self.close_probe()
+
+        directory = self.get_shard_dir()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = self.get_shard_file(directory, index, count)
+        with open(filename + ".tmp", 'w') as shardfile:
+            shardfile.write("".join(line + "\n" for line in lines))
+        os.rename(filename + ".tmp", filename)
+        self.write("Checked %d of %d URLs for shard %d/%d\n" % (len(lines), len(urls), index, count))
+
+    def worker_args(self, index):
+        """Command line for a local worker, passing on the options that affect the checks"""
+        options = self.options
+        args = [sys.executable, os.path.abspath(__file__), "-q", "-n", "-c", options.CONFIGFILE,
+                "--shard", "%d/%d" % (index, options.SHARDS), "--shard-dir", self.get_shard_dir(),
+                "--state", options.STATE, "-b", options.BACKEND, "-m", options.MODE,
+                "--concurrency", str(options.CONCURRENCY), "--per-host", str(options.PER_HOST),
+                "--timeout", "%g" % options.TIMEOUT, "--tries", str(options.TRIES),
+                "--expect-limit", str(options.EXPECT_LIMIT), "--dns-ttl", "%g" % options.DNS_TTL,
+                "--dns-negative-ttl", "%g" % options.DNS_NEGATIVE_TTL, "--history-size", str(options.HISTORY_SIZE),
+                "--backoff-base", "%g" % options.BACKOFF_BASE, "--backoff-max", "%g" % options.BACKOFF_MAX]
+        if options.STATE_FILE:
+            args += ["--state-file", options.STATE_FILE]
+        if options.ADAPTIVE:
+            args += ["-a", "--min-timeout", "%g" % options.MIN_TIMEOUT]
+        if options.KNOWN:
+            args += ["-k"]
+        if options.DUE:
+            args += ["--due"]
+        if options.DEADLINE:
+            args += ["--deadline", "%g" % options.DEADLINE]
+        if options.MAX_AGE is not None:
+            args += ["--max-age", "%g" % options.MAX_AGE]
+        if options.URL:
+            args += ["-u", options.URL]
+        return args
+
+    def run_coordinator(self, config, urls):
+        """Have the URLs checked by --shards workers and report their merged results"""
+        run_start = self.take_run_start()
+        count = self.options.SHARDS
+        directory = self.get_shard_dir()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        files = [self.get_shard_file(directory, index, count) for index in range(count)]
+        self.start_marks(urls)
+
+        if self.options.REMOTE_WORKERS:
+            # Wait for results written after we started. The files are compared with how they
+            # were then, not by time, as the clocks of the machines may differ.
+            before = dict((name, self.file_stamp(name)) for name in files)
+            deadline = run_start + self.options.SHARD_WAIT
+            if self.options.DEADLINE:
+                deadline = min(deadline, run_start + self.options.DEADLINE)
+            while time.time() < deadline:
+                if all(self.file_stamp(name) not in (None, before[name]) for name in files):
+                    break
+                time.sleep(0.5)
+        else:
+            for name in files:
+                if os.path.exists(name):
+                    os.remove(name)
+            before = dict.fromkeys(files)
+            workers = [subprocess.Popen(self.worker_args(index)) for index in range(count)]
+            for worker in workers:
+                worker.wait()
+
+        results = {}
+        for name in files:
+            if self.file_stamp(name) in (None, before[name]):
+                self.write_warn("no results from shard in '%s'\n" % name)
+                continue
+            with open(name) as shardfile:
+                for line in shardfile:
+                    record = json.loads(line)
+                    results[record["url"]] = record
+
+        sites, unfinished = [], []
+        for url in urls:
+            if url in results:
+                site = self.new_site(config, url)
+                record = results.pop(url)
+                site.load_result(record["res"], record["time"], record["phases"])
+                if record.get("cert_expires"):
+                    site.set_cert_expires(record["cert_expires"])
+                if record.get("cached"):
+                    self.__cached.add(id(site))
+                SiteThread.results_queue.put(site)
+                sites.append(site)
+            elif self.options.DEADLINE:
+                unfinished.append(self.new_site(config, url))
+        if unfinished:
+            # All results are queued, so the deadline of now only ends the reporting of them
+            self.report_sites(sites + unfinished, deadline=time.time())
+        else:
+            if len(sites) < len(urls):
+                self.write("%d of %d URLs were not checked by the workers\n" % (len(urls) - len(sites), len(urls)))
+            self.report_sites(sites)
+        self.__cached = set()
+        self.finish_run(config, sites + unfinished, run_start,
+                        run_start + self.options.DEADLINE if self.options.DEADLINE else None)
+
+    @staticmethod
+    def file_stamp(name):
+        """What tells if a file was written again, None if it does not exist"""
+        try:
+            stat_result = os.stat(name)
+        except OSError:
+            return None
+        return stat_result.st_mtime, stat_result.st_size, stat_result.st_ino
+
+    def close_probe(self):
+        with self.__probe_lock:
+            probes, self.__probes = self.__probes, {}
+        for probe in probes.values():
+            probe.close()
+
+    def report_result(self, site, state_pos):
+        """Record and report the result of the site, returns when it is due again"""
+        res = site.get_res()
+        down = bool(res and res != Result.AUTH)
+        if self.is_claimed(site.get_url()) and id(site) not in self.__cached:
+            site.add_to_history()
+            site.update_backoff(down)
+            due = site.update_due(time.time(), self.options.INTERVAL)
+            site.set_last_check(time.time())
+        else:
+            due = site.get_due(time.time(), self.options.INTERVAL)
+        self.report(site, down, state_pos)
+        return due
+
+    def stop(self):
+        """Makes a running daemon exit after its next wakeup"""
+        self.__stop.set()
+
+    def run_daemon(self, config, urls):
+        """Keeps checking the sites until stopped, each one at its own interval. The config
+        file is written every --flush-interval seconds and when the daemon stops."""
+        # The suspects first when all are due at start, a URL given with -u that is known is checked once
+        sites = sorted((self.new_site(config, url) for url in self.unique_urls(urls)),
+                       key=lambda site: site.get_priority())
+        state_pos = max([20] + [len(site.get_url()) for site in sites])
+
+        runner = None
+        if self.options.MODE == "asyncio":
+            runner = AsyncRunner(self, [], self.options.CONCURRENCY, persistent=True, limiter=self.get_host_limiter())
+            runner.start()
+        metrics_server = None
+        if self.options.METRICS_PORT is not None:
+            metrics_server = self.start_metrics_server()
+
+        # Heap of (due time, index in sites), all sites are due at start
+        now = time.time()
+        schedule = [(site.get_next_check() if site.is_backing_off(now) else now, i) for i, site in enumerate(sites)]
+        heapq.heapify(schedule)
+        index = dict((id(site), i) for i, site in enumerate(sites))
+        next_flush = now + self.options.FLUSH_INTERVAL
+        self.__stop.clear()
+        self.open_reporter()
+
+        def terminate(_signum, _frame):
+            raise SystemExit(0)
+
+        old_handler = None
+        if threading.current_thread().name == "MainThread":
+            old_handler = signal.signal(signal.SIGTERM, terminate)
 
-        # Just to be sure
-        for thread in threads:
-            thread.join()
+        try:
+            while not self.__stop.is_set():
+                now = time.time()
+                due = []
+                while schedule and schedule[0][0] <= now:
+                    site = sites[heapq.heappop(schedule)[1]]
+                    site.reset()
+                    due.append(site)
+                if runner:
+                    runner.submit(due)
+                else:
+                    for site in due:
+                        # Running checks do not keep the process from exiting when stopped
+                        thread = SiteThread(site, self.get_host_limiter())
+                        thread.daemon = True
+                        thread.start()
+
+                if now >= next_flush:
+                    self.sync_sites(config, sites)
+                    self.write_config(config)
+                    self.write_metrics()
+                    self.flush_reporter()
+                    next_flush = now + self.options.FLUSH_INTERVAL
+
+                wakeup = min(next_flush, schedule[0][0]) if schedule else next_flush
+                try:
+                    site = SiteThread.results_queue.get(timeout=max(0, wakeup - now))
+                except queue.Empty:
+                    continue
+                if self.__reporter is None:
+                    self.write("[%s] %s: " % (time.strftime("%Y-%m-%d %H:%M:%S"), site.get_url()))
+                due = self.report_result(site, state_pos)
+                if self.__triggers is not None:
+                    self.__triggers.apply_results()
+                heapq.heappush(schedule, (due, index[id(site)]))
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            if old_handler is not None:
+                signal.signal(signal.SIGTERM, old_handler)
+            if runner:
+                runner.stop()
+                runner.join()
+            self.close_reporter()
+            self.close_probe()
+            self.close_mailer()
+            self.close_trigger_runner()
+            self.sync_sites(config, sites)
+            self.write_config(config)
+            self.write_metrics()
+            if metrics_server is not None:
+                metrics_server.shutdown()
+                metrics_server.server_close()
 
     def report(self, site, down, state_pos):
         """Report the state and eventual change"""
 
         known_earlier = down == site.get_down()
+        claimed = self.is_claimed(site.get_url())
 
         if down:
             state = "down"
@@ -357,67 +3362,339 @@ class Alive(object):
             color = Color.GREEN
             space = "  "
 
-        self.write("%s%s%s" % (space, (state_pos - len(site.get_url())) * " ", state), color)
-
-        if site.get_new():
-            self.write(" ( New URL")
-        elif known_earlier:
-            self.write(" ( Known")
-            if site.get_last_change():
-                self.write(" since %s" % time.ctime(site.get_last_change()))
+        if self.__reporter is not None:
+            previous = None if site.get_new() else ("down" if site.get_down() else "up")
+            self.__reporter.add(site, state, previous, claimed, id(site) in self.__cached)
         else:
-            self.write(" ( State changed")
-        self.write(") Check took %.2f s\n" % site.get_time_spent())
+            self.report_text(site, state, color, space, state_pos, known_earlier, claimed)
 
+        if not claimed:
+            return
         if not known_earlier:
             if self.options.TO:
-                if not self.send_mail("%s %s" % (site.get_url(), state),
-                                      "Site is %s at %s" % (state, datetime.datetime.now().ctime())):
-                    return
+                self.send_mail("%s %s" % (site.get_url(), state),
+                               "Site is %s at %s" % (state, datetime.datetime.now().ctime()),
+                               (site, site.get_down(), site.get_last_change()))
             site.activate_triggers(down)
             site.set_last_change(int(time.time()))
 
         site.set_down(down)
 
-    def send_mail(self, subject, body):
-        """Send a mail using smtp server on localhost"""
-        self.write("Mailing...")
-        msg = MIMEText(body)
-        msg['Subject'] = subject
-        if self.options.FROM:
-            msg['From'] = self.options.FROM
-        msg['To'] = self.options.TO
-        smtp = smtplib.SMTP()
-        if self.options.DEBUG:
-            smtp.set_debuglevel(True)
-        try:
-            smtp.connect()
-        except IOError:
-            print("Could not send email, do you have an SMTP server running on localhost?")
-            return False
-        smtp.sendmail(self.options.FROM, [self.options.TO], msg.as_string())
-        smtp.quit()
-        return True
+    def report_unknown(self, site, state_pos):
+        """Report a site whose check did not finish, its state is left as it was"""
+        claimed = self.is_claimed(site.get_url())
+        if claimed:
+            site.set_unfinished()
+        previous = None if site.get_new() else ("down" if site.get_down() else "up")
+        if self.__reporter is not None:
+            self.__reporter.add(site, "unknown", previous, claimed)
+            return
+        self.write("%sunknown" % ((state_pos - len(site.get_url()) - 3) * " "), Color.YELLOW)
+        if not claimed:
+            self.write(" ( Claimed by another run, not saved )\n")
+        elif previous is None:
+            self.write(" ( New URL, not finished by the deadline )\n")
+        else:
+            self.write(" ( Not finished by the deadline, still %s )\n" % previous)
+
+    def report_text(self, site, state, color, space, state_pos, known_earlier, claimed):
+        self.write("%s%s%s" % (space, (state_pos - len(site.get_url())) * " ", state), color)
+
+        if not claimed:
+            self.write(" ( Claimed by another run, not saved")
+        elif site.get_new():
+            self.write(" ( New URL")
+        elif known_earlier:
+            self.write(" ( Known")
+            if site.get_last_change():
+                self.write(" since %s" % time.ctime(site.get_last_change()))
+        else:
+            self.write(" ( State changed")
+        self.write(") Check took %.2f s" % site.get_time_spent())
+        if id(site) in self.__cached:
+            self.write(", cached result")
+        if site.get_probe_type() == "tls" and site.get_cert_expires():
+            self.write(", certificate expires %s" % time.ctime(site.get_cert_expires()))
+        self.write("\n")
+
+    def send_mail(self, subject, body, change=None):
+        """Queue a mail, it is sent by the mail dispatcher using the smtp server given by --smtp.
+        If it can not be sent, change is the (site, down, time) its state is set back to."""
+        self.write_debug("Queueing mail '%s'\n" % subject)
+        self.get_mailer().notify(subject, body, change)
+
+    def get_mailer(self):
+        if self.__mailer is None:
+            window = None
+            if self.options.DIGEST or self.options.DIGEST_WINDOW:
+                window = self.options.DIGEST_WINDOW or (self.options.FLUSH_INTERVAL if self.options.DAEMON else 0)
+            self.__mailer = MailDispatcher(self, window)
+            self.__mailer.start()
+        return self.__mailer
+
+    def get_trigger_runner(self):
+        if self.__triggers is None:
+            self.__triggers = TriggerRunner(self, self.options.TRIGGER_WORKERS)
+        return self.__triggers
+
+    def close_trigger_runner(self, timeout=None):
+        """Wait for the running triggers and record their results, returns their sites"""
+        sites = []
+        if self.__triggers is not None:
+            sites = self.__triggers.close(timeout)
+            self.__triggers = None
+        return sites
+
+    def open_reporter(self):
+        """With --format jsonl the results are written as JSON records instead of text"""
+        if self.options.FORMAT == "jsonl" and self.__reporter is None:
+            self.__reporter = JsonLinesReporter(sys.stdout, self.options.OUTPUT_FLUSH)
+
+    def flush_reporter(self):
+        if self.__reporter is not None:
+            self.__reporter.flush()
+
+    def close_reporter(self):
+        if self.__reporter is not None:
+            self.__reporter.close()
+            self.__reporter = None
+
+    def close_mailer(self, timeout=None):
+        """Wait for the queued mails to be sent, at most timeout seconds. The state change of
+        a site whose mail was not sent is not recorded, so the next run notices it and mails
+        it again. Returns those sites."""
+        sites = []
+        if self.__mailer is not None:
+            for _, _, change in self.__mailer.close(timeout):
+                if change is not None and self.is_claimed(change[0].get_url()):
+                    site, down, last_change = change
+                    site.set_down(down)
+                    site.set_last_change(last_change)
+                    sites.append(site)
+            self.__mailer = None
+        if sites:
+            self.write_warn("%d state changes are not saved as their mail could not be sent\n" % len(sites))
+        return sites
+
+    def print_percentiles(self, config, urls):
+        """Print the check time percentiles from the latency history of the sites"""
+        urls = [url for url in urls or config.sections() if config.has_section(url)]
+        if not urls:
+            self.write("No URLs with history in '%s'\n" % self.get_state_file())
+            return
+        width = max([20] + [len(url) for url in urls])
+        self.write("%s %6s %9s %9s %9s\n" % ("URL".ljust(width), "checks", "p50", "p95", "p99"))
+        for url in urls:
+            history = self.new_site(config, url).get_history()
+            line = "%s %6d" % (url.ljust(width), len(history))
+            for pct in (50, 95, 99):
+                value = history.percentile(pct)
+                line += "        -" if value is None else " %8.3fs" % value
+            print(line)
+
+    def get_state_file(self):
+        if self.options.STATE == "sqlite":
+            return self.options.STATE_FILE or self.options.CONFIGFILE + ".db"
+        return self.options.CONFIGFILE
+
+    def get_store(self):
+        """Returns the store keeping the state of the sites"""
+        if self.__store is None:
+            if self.options.STATE == "sqlite":
+                self.__store = SqliteStore(self.get_state_file(), read_only=self.options.SHARD is not None)
+            else:
+                self.__store = ConfigStore(self.get_state_file())
+        return self.__store
+
+    def close_store(self):
+        if self.__store is not None:
+            self.__store.close()
+            self.__store = None
+
+    def claim_site(self, url):
+        """Claim one site for this run, returns False if another run has it"""
+        if fcntl is None:
+            return True
+        if self.__locks is None:
+            self.__locks = SiteLocks(self.options.CONFIGFILE + "_lock")
+        return self.__locks.claim(url)
+
+    def lock_sites(self, urls):
+        """Claim the sites for this run. The state of sites claimed by other runs is not
+        changed, they are still checked and reported."""
+        busy = [url for url in urls if not self.claim_site(url)]
+        if busy:
+            self.write("%d sites are claimed by another run, their state is not updated\n" % len(busy))
+            for url in busy:
+                self.write_debug("%s is claimed by another run\n" % url)
+
+    def release_sites(self, urls):
+        """Give up the claims on the sites, returns the released URLs"""
+        if self.__locks is None:
+            return []
+        urls = list(urls)
+        for url in urls:
+            self.__locks.release(url)
+        return urls
+
+    def is_claimed(self, url):
+        return self.__locks is None or self.__locks.is_claimed(url)
+
+    def start_marks(self, urls):
+        """Let other runs know the claimed sites are being checked"""
+        if self.__locks is not None:
+            for url in urls:
+                if self.__locks.is_claimed(url):
+                    self.__locks.start_check(url)
+
+    def end_marks(self, urls):
+        """Let other runs know the state of the sites is written"""
+        if self.__locks is not None:
+            for url in urls:
+                self.__locks.end_check(url)
+
+    def close_locks(self):
+        if self.__locks is not None:
+            self.__locks.close()
+            self.__locks = None
+
+    def list_urls(self):
+        """Print the known URLs as they are read, without loading the whole state"""
+        count = 0
+        for url in self.get_store().sections():
+            if not count:
+                self.write("Known URLs in the config file '%s':\n\n" % self.options.CONFIGFILE)
+            print(url)
+            count += 1
+        if not count:
+            self.write("No URLs in the config file '%s'\n" % self.options.CONFIGFILE)
+
+    def new_site(self, config, url):
+        """A Site with the state and options of its section in the config"""
+        if config.has_section(url):
+            return Site(url, self, dict(config.items(url, raw=True)))
+        return Site(url, self)
+
+    def sync_sites(self, config, sites):
+        """Copy what changed in the sites to the config and the store in one batch. The
+        sites claimed by other runs are left alone."""
+        changes = []
+        for site in sites:
+            url = site.get_url()
+            if not self.is_claimed(url):
+                continue
+            items = site.pop_changes()
+            if items and not config.has_section(url):
+                config.add_section(url)
+            for key, value in items:
+                config.set(url, key, value)
+                changes.append((url, key, value))
+        self.get_store().update(changes)
 
     def write_config(self, config):
-        # Write the configuration file
-        with open(self.options.CONFIGFILE, 'w') as configfile:
-            config.write(configfile)
-            os.chmod(self.options.CONFIGFILE, stat.S_IRUSR | stat.S_IWUSR)
+        """Save the state, with the cfg store this writes the configuration file. When
+        sites are locked only the claimed ones are written, merged with the saved state."""
+        if self.__locks is None:
+            self.get_store().save(config, config.sections() if self.__partial else None)
+            return
+        self.__locks.lock_state()
+        try:
+            self.get_store().save(config, self.__locks.get_claimed())
+        finally:
+            self.__locks.unlock_state()
+        self.__locks.end_checks()
+
+    def import_config(self, config, filename):
+        """Add the sections and options of a file in the config file format to the state"""
+        imported = configparser.ConfigParser()
+        if not imported.read(filename):
+            self.write_warn("could not read '%s'\n" % filename)
+            return
+        self.lock_sites(imported.sections())
+        for section in imported.sections():
+            if not self.is_claimed(section):
+                continue
+            if not config.has_section(section):
+                config.add_section(section)
+            for key in imported.options(section):
+                config.set(section, key, imported.get(section, key, raw=True))
+        self.write_config(config)
+        self.write("Imported %d URLs from '%s'\n" % (len(imported.sections()), filename))
+
+    def export_config(self, config, filename):
+        ConfigStore.write_file(config, filename)
+        self.write("Exported %d URLs to '%s'\n" % (len(config.sections()), filename))
 
     def setup(self):
-        """Read in the config file and URLs"""
+        """Read in the state and URLs"""
+        self.__run_start = time.time()
         urls = []
         if self.options.URL:
             urls += self.options.URL.split()
 
-        config = configparser.ConfigParser()
-        config.read(self.options.CONFIGFILE)
-
-        if self.options.KNOWN:
+        if self.options.DUE:
+            due = self.get_store().due(time.time())
+            if due is not None and not self.options.EXPORT:
+                # Only the sections of the sites to check are loaded
+                config = self.get_store().load(urls + due)
+                self.__partial = True
+                urls += self.due_urls(config, due)
+                return config, self.unique_urls(urls)
+
+        if self.streams_input():
+            # check_input loads the sites as it reads them
+            config = self.get_store().load(urls)
+            self.__partial = True
+            return config, self.unique_urls(urls)
+
+        config = self.get_store().load()
+        self.__partial = False
+
+        if self.options.DUE:
+            urls += self.due_urls(config)
+        elif self.options.KNOWN or self.options.DAEMON:
             urls += config.sections()
 
-        return config, urls
+        return config, self.unique_urls(urls)
+
+    def streams_input(self):
+        """Whether the run checks --input with a store that writes the state in batches, then
+        the sites are loaded while the input is read and not all at the start"""
+        options = self.options
+        return bool(options.INPUT and self.get_store().WRITES_UPDATES and
+                    not (options.KNOWN or options.DAEMON or options.SHARD or options.SHARDS or options.LIST or
+                         options.PERCENTILES or options.IMPORT or options.EXPORT))
+
+    def take_run_start(self):
+        """When the run started, at setup() so that claiming the sites counts against
+        --deadline. A second run without setup() starts now."""
+        run_start, self.__run_start = self.__run_start or time.time(), None
+        return run_start
+
+    @staticmethod
+    def unique_urls(urls):
+        """The URLs without the repeated ones, in the order they were first given"""
+        seen = set()
+        return [url for url in urls if not (url in seen or seen.add(url))]
+
+    def due_urls(self, config, urls=None):
+        """The known URLs whose next_due time has passed, the ones due the longest first. The
+        store keeps an index of the due times, given as urls, without it all sections are
+        looked at."""
+        now = time.time()
+        if urls is None:
+            self.write_debug("No due index, scanning all sections\n")
+            due = []
+            for url in config.sections():
+                next_due = 0
+                if config.has_option(url, "next_due"):
+                    next_due = Site.parse_float(config.get(url, "next_due", raw=True), 0)
+                if next_due <= now:
+                    due.append((next_due, url))
+            urls = [url for _, url in sorted(due)]
+        urls = [url for url in urls if config.has_section(url)]
+        self.write("%d known URLs are due\n" % len(urls))
+        return urls
 
 
 def main():
@@ -428,21 +3705,41 @@ def main():
     if not alive.parse_command_line_options():
         sys.exit(1)
 
-    (config, urls) = alive.setup()
+    if alive.options.LIST and not (alive.options.IMPORT or alive.options.EXPORT or alive.options.PERCENTILES):
+        # Listing only needs the section names
+        alive.list_urls()
+        alive.close_store()
+        return
 
-    if alive.options.LIST:
-        if len(config.sections()):
-            alive.write("Known URLs in the config file '%s':\n\n" % alive.options.CONFIGFILE)
-            for url in config.sections():
-                print(url)
-        else:
-            alive.write("No URLs in the config file '%s'\n" % alive.options.CONFIGFILE)
-    else:
+    (config, urls) = alive.setup()
+    if not (alive.options.PERCENTILES or alive.options.LIST or alive.options.SHARD):
+        # Shard workers only read the state, the coordinator claims the sites
+        alive.lock_sites(urls)
+
+    if alive.options.IMPORT:
+        alive.import_config(config, alive.options.IMPORT)
+    if alive.options.EXPORT:
+        alive.export_config(config, alive.options.EXPORT)
+
+    if alive.options.PERCENTILES:
+        alive.print_percentiles(config, urls)
+    elif alive.options.LIST:
+        alive.list_urls()
+    elif alive.options.SHARD:
+        alive.run_shard(config, urls)
+    elif alive.options.DAEMON:
+        alive.run_daemon(config, urls)
+    elif alive.options.SHARDS:
+        alive.run_coordinator(config, urls)
+        alive.write_config(config)
+    elif alive.options.INPUT:
+        alive.check_input(config, urls)
+        alive.write_config(config)
+    elif alive.options.URL or alive.options.KNOWN or alive.options.DUE:
         alive.check_urls(config, urls)
         alive.write_config(config)
-
-    lockfilename = alive.options.CONFIGFILE + "_lock"
-    os.remove(lockfilename)
+    alive.close_store()
+    alive.close_locks()
 
 
 if __name__ == "__main__":
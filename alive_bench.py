@@ -0,0 +1,406 @@
+#!/usr/bin/python
+"""
+Benchmarks for alive.py that do not need internet access.
+
+A fleet of virtual sites is served from the loopback interface by a separate
+process. Each site answers with a latency taken from a configurable
+distribution, and some requests can fail with an error, hang or have their
+connection reset. Alive.check_urls is then run against the fleet in each
+requested execution mode and the throughput, wall time, peak RSS and peak
+thread and file descriptor counts are reported.
+
+With --startup the time to start alive.py is measured instead, for importing
+the module and for listing the URLs of a large config file with -l, and with
+--memory the memory used for each URL by the loaded state and the Site objects.
+"""
+
+from optparse import OptionParser
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from alive import Alive
+
+
+class Latency(object):
+    """A latency distribution given as 'const:S', 'uniform:MIN:MAX', 'exp:MEAN' or 'lognormal:MU:SIGMA'"""
+
+    def __init__(self, spec):
+        parts = spec.split(":")
+        self.kind = parts[0]
+        try:
+            self.params = [float(param) for param in parts[1:]]
+        except ValueError:
+            raise ValueError("Invalid latency '%s'" % spec)
+        expected = {"const": 1, "uniform": 2, "exp": 1, "lognormal": 2}
+        if expected.get(self.kind) != len(self.params):
+            raise ValueError("Invalid latency '%s'" % spec)
+
+    def sample(self, rand):
+        if self.kind == "const":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rand.uniform(*self.params)
+        if self.kind == "exp":
+            return rand.expovariate(1.0 / self.params[0]) if self.params[0] > 0 else 0
+        return rand.lognormvariate(*self.params)
+
+
+class FleetHandler(BaseHTTPRequestHandler):
+    """Answers for all virtual sites, /site/N is site N"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        server = self.server
+        roll = random.random()
+        if roll < server.reset_rate:
+            # Close with a RST instead of answering
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.close_connection = True
+            return
+        roll -= server.reset_rate
+        if roll < server.hang_rate:
+            time.sleep(server.hang_time)
+            self.close_connection = True
+            return
+        roll -= server.hang_rate
+        time.sleep(max(0, server.latency.sample(random)))
+        status = 500 if roll < server.error_rate else 200
+        body = b"" if self.command == "HEAD" else b"ok\n"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.do_HEAD()
+
+    def log_message(self, *args):
+        pass
+
+
+class FleetServer(ThreadingMixIn, HTTPServer):
+    """HTTP server for the virtual sites"""
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency, error_rate, hang_rate, reset_rate, hang_time):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FleetHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.reset_rate = reset_rate
+        self.hang_time = hang_time
+
+
+def serve_fleet(pipe, hosts, latency, error_rate, hang_rate, reset_rate, hang_time):
+    """Runs in the fleet process, one server per host, and sends the ports back over the pipe"""
+    servers = [FleetServer(Latency(latency), error_rate, hang_rate, reset_rate, hang_time) for _ in range(hosts)]
+    for server in servers[1:]:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    pipe.send([server.server_address[1] for server in servers])
+    servers[0].serve_forever()
+
+
+class Fleet(object):
+    """The virtual sites, served by a separate process so they do not affect the measurements"""
+
+    def __init__(self, sites, hosts=1, latency="exp:0.02", error_rate=0.0, hang_rate=0.0, reset_rate=0.0, hang_time=30):
+        parent, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve_fleet,
+                                               args=(child, hosts, latency, error_rate, hang_rate, reset_rate, hang_time))
+        self.process.daemon = True
+        self.process.start()
+        self.ports = parent.recv()
+        self.sites = sites
+
+    def urls(self):
+        return ["http://127.0.0.1:%d/site/%d" % (self.ports[i % len(self.ports)], i) for i in range(self.sites)]
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+
+class Sampler(threading.Thread):
+    """Records the peak number of threads and open file descriptors while running"""
+
+    def __init__(self, interval=0.01):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_fds = 0
+        self.running = threading.Event()
+        self.running.set()
+
+    def run(self):
+        while self.running.is_set():
+            self.sample()
+            time.sleep(self.interval)
+
+    def sample(self):
+        self.peak_threads = max(self.peak_threads, threading.active_count())
+        fds = count_fds()
+        if fds is not None:
+            self.peak_fds = max(self.peak_fds, fds)
+
+    def stop(self):
+        self.running.clear()
+        self.join()
+        self.sample()
+
+
+def count_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process, ru_maxrss is in kB on Linux and bytes on macOS"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+
+def run_benchmark(urls, mode="threads", backend="http", concurrency=100, timeout=5, tries=1, extra=(), per_host=0):
+    """Check the urls with Alive.check_urls and return the measurements as a dict"""
+    workdir = tempfile.mkdtemp(prefix="alive_bench")
+    argv = sys.argv
+    try:
+        sys.argv = [argv[0], "-q", "-n", "-c", os.path.join(workdir, "bench.cfg"), "-m", mode, "-b", backend,
+                    "--concurrency", str(concurrency), "--per-host", str(per_host), "--timeout", str(timeout),
+                    "--tries", str(tries),
+                    "-u", " ".join(urls)] + list(extra)
+        alive = Alive()
+        alive.parse_command_line_options()
+        (config, urls) = alive.setup()
+        sampler = Sampler()
+        sampler.start()
+        start = time.time()
+        alive.check_urls(config, urls)
+        wall = time.time() - start
+        sampler.stop()
+        down = len([url for url in urls if config.getboolean(url, "down")])
+    finally:
+        sys.argv = argv
+        shutil.rmtree(workdir)
+    return {"mode": mode, "backend": backend, "checks": len(urls), "down": down, "wall": wall,
+            "rate": len(urls) / wall if wall else float("inf"), "rss_mb": peak_rss_mb(),
+            "threads": sampler.peak_threads, "fds": sampler.peak_fds}
+
+
+def startup_benchmark(runs=20, sites=1000):
+    """Time fresh interpreters importing alive and listing a config file of the given size,
+    returns the median and fastest of the runs for each command"""
+    workdir = tempfile.mkdtemp(prefix="alive_bench")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alive.py")
+    configfile = os.path.join(workdir, "bench.cfg")
+    try:
+        write_config(configfile, sites)
+        commands = [("import", [sys.executable, "-c", "import alive"]),
+                    ("list", [sys.executable, script, "-n", "-c", configfile, "-l"])]
+        results = []
+        with open(os.devnull, "w") as devnull:
+            for name, command in commands:
+                times = []
+                for _ in range(runs):
+                    start = time.time()
+                    subprocess.check_call(command, stdout=devnull, cwd=os.path.dirname(script))
+                    times.append(time.time() - start)
+                times.sort()
+                results.append({"command": name, "median": times[len(times) // 2], "min": times[0]})
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def write_config(filename, sites):
+    """A config file with sites URLs that have been checked a few times"""
+    with open(filename, "w") as config:
+        for i in range(sites):
+            config.write("[http://site%d.example.com/]\ntime = 1500000000\ndown = no\n"
+                         "history = 0.123:0 0.456:0 0.789:0\n\n" % i)
+
+
+def memory_benchmark(sites=50000):
+    """Bytes allocated for each URL by loading the state and by creating the Site objects"""
+    workdir = tempfile.mkdtemp(prefix="alive_bench")
+    argv = sys.argv
+    try:
+        configfile = os.path.join(workdir, "bench.cfg")
+        write_config(configfile, sites)
+        sys.argv = [argv[0], "-q", "-n", "-c", configfile, "-k"]
+        alive = Alive()
+        alive.parse_command_line_options()
+        tracemalloc.start()
+        (config, urls) = alive.setup()
+        loaded = tracemalloc.get_traced_memory()[0]
+        objects = [alive.new_site(config, url) for url in urls]
+        created = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    finally:
+        sys.argv = argv
+        shutil.rmtree(workdir)
+    return [{"command": "state", "bytes": float(loaded) / len(objects)},
+            {"command": "sites", "bytes": float(created - loaded) / len(objects)}]
+
+
+def format_memory(results):
+    return "".join("%-8s %8.0f bytes per URL\n" % (res["command"], res["bytes"]) for res in results)
+
+
+def format_startup(results):
+    lines = ["%-8s %12s %12s" % ("command", "median (ms)", "min (ms)")]
+    for res in results:
+        lines.append("%-8s %12.1f %12.1f" % (res["command"], res["median"] * 1000, res["min"] * 1000))
+    return "\n".join(lines) + "\n"
+
+
+def compare_startup(results, baseline, tolerance):
+    """Returns a list of regressions, commands whose median time is more than tolerance above the baseline"""
+    regressions = []
+    for res in results:
+        for base in baseline:
+            if base.get("command") == res["command"] and res["median"] > base["median"] * (1 + tolerance):
+                regressions.append("%s: %.1f ms, baseline %.1f ms" % (res["command"], res["median"] * 1000,
+                                                                      base["median"] * 1000))
+    return regressions
+
+
+def format_results(results):
+    lines = ["%-8s %-7s %7s %6s %9s %10s %8s %8s %6s" %
+             ("mode", "backend", "checks", "down", "wall (s)", "checks/s", "rss (MB)", "threads", "fds")]
+    for res in results:
+        lines.append("%-8s %-7s %7d %6d %9.2f %10.1f %8.1f %8d %6d" %
+                     (res["mode"], res["backend"], res["checks"], res["down"], res["wall"], res["rate"],
+                      res["rss_mb"], res["threads"], res["fds"]))
+    return "\n".join(lines) + "\n"
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regressions, runs whose throughput is more than tolerance below the baseline"""
+    regressions = []
+    for res in results:
+        for base in baseline:
+            if (base["mode"], base["backend"]) == (res["mode"], res["backend"]) and res["rate"] < base["rate"] * (1 - tolerance):
+                regressions.append("%s/%s: %.1f checks/s, baseline %.1f" % (res["mode"], res["backend"], res["rate"], base["rate"]))
+    return regressions
+
+
+def main():
+    """main"""
+
+    parser = OptionParser(usage="%prog [options]",
+                          description="Benchmark alive.py against a fleet of virtual sites served on the loopback interface.")
+    parser.add_option("--sites", dest="SITES", type="int", default=1000, help="Number of virtual sites. Default is 1000.")
+    parser.add_option("--hosts", dest="HOSTS", type="int", default=1,
+                      help="Number of servers (ports) the sites are spread over. Default is 1.")
+    parser.add_option("--latency", dest="LATENCY", default="exp:0.02",
+                      help="Latency distribution, 'const:S', 'uniform:MIN:MAX', 'exp:MEAN' or 'lognormal:MU:SIGMA'. Default is exp:0.02.")
+    parser.add_option("--error-rate", dest="ERROR_RATE", type="float", default=0.0, help="Fraction of requests answered with 500.")
+    parser.add_option("--hang-rate", dest="HANG_RATE", type="float", default=0.0, help="Fraction of requests that never get an answer.")
+    parser.add_option("--reset-rate", dest="RESET_RATE", type="float", default=0.0, help="Fraction of connections that are reset.")
+    parser.add_option("--modes", dest="MODES", default="threads,asyncio",
+                      help="Comma separated execution modes to run. Default is threads,asyncio.")
+    parser.add_option("--backends", dest="BACKENDS", default="http", help="Comma separated backends to run. Default is http.")
+    parser.add_option("--concurrency", dest="CONCURRENCY", type="int", default=100, help="Concurrency in asyncio mode. Default is 100.")
+    parser.add_option("--per-host", dest="PER_HOST", type="int", default=0,
+                      help="Simultaneous checks per server, 0 for no limit. Default is 0 since the fleet has few servers.")
+    parser.add_option("--timeout", dest="TIMEOUT", type="int", default=5, help="Timeout of each check. Default is 5.")
+    parser.add_option("--tries", dest="TRIES", type="int", default=1, help="Tries of each check. Default is 1.")
+    parser.add_option("--startup", dest="STARTUP", action="store_true",
+                      help="Measure the startup time instead, --sites is then the size of the config file listed.")
+    parser.add_option("--memory", dest="MEMORY", action="store_true",
+                      help="Measure the memory used for each of --sites URLs loaded from a config file instead.")
+    parser.add_option("--runs", dest="RUNS", type="int", default=20, help="Runs of each command with --startup. Default is 20.")
+    parser.add_option("--save", dest="SAVE", metavar="FILE", help="Save the results as JSON, to be used with --compare.")
+    parser.add_option("--compare", dest="COMPARE", metavar="FILE",
+                      help="Compare with results saved by --save and exit with 1 if the throughput regressed.")
+    parser.add_option("--tolerance", dest="TOLERANCE", type="float", default=0.2,
+                      help="Allowed throughput loss or startup time increase compared to --compare, as a fraction. Default is 0.2.")
+    (options, args) = parser.parse_args()
+    if len(args):
+        parser.print_help()
+        sys.exit(1)
+    try:
+        Latency(options.LATENCY)
+    except ValueError as err:
+        parser.error(str(err))
+
+    if options.MEMORY:
+        if tracemalloc is None:
+            parser.error("--memory requires Python 3")
+        sys.stdout.write(format_memory(memory_benchmark(options.SITES)))
+        return
+    if options.STARTUP:
+        results = startup_benchmark(options.RUNS, options.SITES)
+        sys.stdout.write(format_startup(results))
+        report(results, options, compare_startup)
+        return
+
+    fleet = Fleet(options.SITES, options.HOSTS, options.LATENCY, options.ERROR_RATE, options.HANG_RATE,
+                  options.RESET_RATE, options.TIMEOUT * options.TRIES + 5)
+    results = []
+    try:
+        for backend in options.BACKENDS.split(","):
+            for mode in options.MODES.split(","):
+                # Each run in its own process so the peak RSS and counts are not carried over
+                pool = multiprocessing.Pool(1)
+                results.append(pool.apply(run_benchmark, (fleet.urls(), mode, backend, options.CONCURRENCY,
+                                                          options.TIMEOUT, options.TRIES, (), options.PER_HOST)))
+                pool.close()
+                pool.join()
+    finally:
+        fleet.stop()
+
+    sys.stdout.write(format_results(results))
+    report(results, options, compare)
+
+
+def report(results, options, comparison):
+    """Save the results and exit with 1 if they regressed compared to the saved ones"""
+    if options.SAVE:
+        with open(options.SAVE, "w") as saved:
+            json.dump(results, saved, indent=1)
+    if options.COMPARE:
+        with open(options.COMPARE) as saved:
+            regressions = comparison(results, json.load(saved), options.TOLERANCE)
+        for regression in regressions:
+            sys.stderr.write("Regression: %s\n" % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
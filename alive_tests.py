@@ -3,14 +3,167 @@
 Unit tests for alive.py
 """
 
+import json
 import os
+import re
+import socket
+import ssl
+import subprocess
 import sys
+import threading
 import time
 import unittest
 
-from alive import Alive, Site
+import alive
+from alive import Alive, HashRing, HttpProbe, LatencyHistory, ResolverCache, Result, Site, SiteThread
+import shutil
 from tempfile import NamedTemporaryFile
 
+try:
+    from io import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    from socketserver import StreamRequestHandler, TCPServer, ThreadingMixIn
+except ImportError:
+    from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn
+
+
+class LocalHandler(BaseHTTPRequestHandler):
+    """Answers on a few fixed paths, used to test without internet access"""
+
+    protocol_version = "HTTP/1.1"
+    STATUS = {"/ok": 200, "/missing": 404, "/auth": 401, "/broken": 500, "/nohead": 200}
+    PAGE = b"<html>Welcome" + b" " * 1000000 + b"Footer</html>"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_HEAD(self):
+        self.server.requests.append(self.path)
+        path = self.path.split("?")[0]
+        if path == "/sleep":
+            with self.server.lock:
+                self.server.active += 1
+                self.server.max_active = max(self.server.max_active, self.server.active)
+            time.sleep(float(self.path.split("?")[1].split("&")[0]))
+            with self.server.lock:
+                self.server.active -= 1
+            self.answer(200)
+        elif path == "/nohead":
+            self.answer(405)
+        elif path == "/redirect":
+            self.answer(302, {"Location": "/ok"})
+        else:
+            self.answer(self.STATUS.get(path, 404))
+
+    def do_GET(self):
+        if self.path == "/nohead":
+            self.answer(200, body=b"hello")
+        elif self.path.split("?")[0] == "/page":
+            self.server.requests.append(self.path)
+            self.answer(200, body=self.PAGE)
+        else:
+            self.do_HEAD()
+
+    def answer(self, status, headers=None, body=b""):
+        self.send_response(status)
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            try:
+                self.wfile.write(body)
+            except socket.error:
+                # The client stopped reading
+                pass
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer(ThreadingMixIn, HTTPServer):
+    """HTTP server on the loopback interface running in a background thread"""
+
+    daemon_threads = True
+
+    def __init__(self, handler=LocalHandler):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), handler)
+        self.connections = 0
+        self.requests = []
+        # Requests being answered at the same time
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SmtpHandler(StreamRequestHandler):
+    """Just enough SMTP to receive mails from smtplib"""
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 localhost")
+        data = None
+        for line in self.rfile:
+            line = line.decode().rstrip("\r\n")
+            if data is not None:
+                if line == ".":
+                    self.server.messages.append("\n".join(data))
+                    data = None
+                    self.reply("250 OK")
+                else:
+                    data.append(line)
+            elif line.upper().startswith("DATA"):
+                data = []
+                self.reply("354 Go ahead")
+            elif line.upper().startswith("QUIT"):
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+    def reply(self, text):
+        self.wfile.write((text + "\r\n").encode())
+
+
+class LocalSmtpServer(ThreadingMixIn, TCPServer):
+    """SMTP server on the loopback interface running in a background thread"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        TCPServer.__init__(self, ("127.0.0.1", 0), SmtpHandler)
+        self.connections = 0
+        self.messages = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def address(self):
+        return "127.0.0.1:%d" % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
 
 class TestAlive(unittest.TestCase):
 
@@ -27,10 +180,13 @@ class TestAlive(unittest.TestCase):
             pass
 
     def tearDown(self):
-        try:
-            os.remove(self.configfile)
-        except OSError:
-            pass
+        for filename in (self.configfile, self.configfile + ".db", self.configfile + ".exported", self.configfile + "_lock",
+                         self.configfile + "_lock.checking", self.configfile + ".due"):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        shutil.rmtree(self.configfile + "_shards", ignore_errors=True)
 
     def test_empty_config(self):
         sys.argv = [sys.argv[0], "-c", self.configfile, "-l"]
@@ -39,6 +195,33 @@ class TestAlive(unittest.TestCase):
         self.assertEqual(len(config.sections()), 0)
         self.assertEqual([], urls)
 
+    def list_test(self, state):
+        sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "--state", state]
+        self.alive.parse_command_line_options()
+        (config, _) = self.alive.setup()
+        for url in ("http://b.example.com/", "http://a.example.com/"):
+            config.add_section(url)
+            config.set(url, "down", "no")
+        self.alive.write_config(config)
+        self.alive.close_store()
+        script = os.path.join(os.path.dirname(os.path.abspath(alive.__file__)), "alive.py")
+        output = subprocess.check_output([sys.executable, script, "-n", "-c", self.configfile, "--state", state,
+                                          "-l"]).decode()
+        self.assertEqual(output.splitlines()[2:], ["http://b.example.com/", "http://a.example.com/"])
+
+    def test_list(self):
+        self.list_test("cfg")
+
+    def test_list_sqlite(self):
+        self.list_test("sqlite")
+
+    def test_lazy_imports(self):
+        # Quick commands must not pay for the modules only checks, mail and state need
+        heavy = ["asyncio", "email.mime.text", "http.client", "http.server", "smtplib", "sqlite3", "ssl", "subprocess"]
+        output = subprocess.check_output([sys.executable, "-c", "import sys, alive; print(' '.join(name for name in %r "
+                                          "if name in sys.modules))" % heavy])
+        self.assertEqual(output.strip(), b"")
+
     def url_test(self, url, should_be_up, count=1):
         sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "-u", url]
         self.alive.parse_command_line_options()
@@ -66,8 +249,12 @@ class TestAlive(unittest.TestCase):
     def get_a_site(self, url="www.test.com"):
         sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "-k"]
         self.alive.parse_command_line_options()
-        (config, _) = self.alive.setup()
-        return Site(url, [config], self.alive)
+        (self.config, _) = self.alive.setup()
+        return self.alive.new_site(self.config, url)
+
+    def save_site(self, site):
+        self.alive.sync_sites(self.config, [site])
+        self.alive.write_config(self.config)
 
     def test_set_get_down_config(self):
         site = self.get_a_site()
@@ -89,6 +276,19 @@ class TestAlive(unittest.TestCase):
         site.set_last_change(1500)
         self.assertTrue(site.get_last_change() == 1500)
 
+    def test_site_changes(self):
+        site = Site("www.test.com", self.alive, {"time": "1500", "down": "yes", "interval": "30"})
+        self.assertFalse(hasattr(site, "__dict__"))
+        self.assertFalse(site.get_new())
+        self.assertTrue(site.get_down())
+        self.assertEqual(site.get_interval(60), 30)
+        self.assertEqual(site.pop_changes(), [])
+        site.set_down(False)
+        site.set_last_change(1600)
+        # Handed over once, in one batch
+        self.assertEqual(site.pop_changes(), [("down", "no"), ("time", "1600")])
+        self.assertEqual(site.pop_changes(), [])
+
     def test_set_get_url(self):
         site = self.get_a_site()
         self.assertTrue(site.get_url() == "www.test.com")
@@ -106,10 +306,9 @@ class TestAlive(unittest.TestCase):
         # First create a site object for which google is down
         site = self.get_a_site(url)
         site.set_down(True)
-        config = site.get_config()
         # Now add a trigger
-        config[0].set(url, "up_trigger", "touch %s" % trigger_file)
-        self.alive.write_config(config[0])
+        site.set_option("up_trigger", "touch %s" % trigger_file)
+        self.save_site(site)
         self.url_test(url, True)
         # Check if trigger file was created
         self.assertTrue(os.path.exists(trigger_file))
@@ -124,10 +323,9 @@ class TestAlive(unittest.TestCase):
         # First create a site object for which google is down
         site = self.get_a_site(url)
         site.set_down(True)
-        config = site.get_config()
         # Now add a trigger
-        config[0].set(url, "up_trigger", "ls|wc > %s" % trigger_file)
-        self.alive.write_config(config[0])
+        site.set_option("up_trigger", "ls|wc > %s" % trigger_file)
+        self.save_site(site)
         self.url_test(url, True)
         # Check if trigger file was created
         self.assertTrue(os.path.exists(trigger_file))
@@ -142,10 +340,9 @@ class TestAlive(unittest.TestCase):
         # First create a site object with an invalid url and set it to be up
         site = self.get_a_site(url)
         site.set_down(False)
-        config = site.get_config()
         # Now add a trigger
-        config[0].set(url, "down_trigger", "touch %s" % trigger_file)
-        self.alive.write_config(config[0])
+        site.set_option("down_trigger", "touch %s" % trigger_file)
+        self.save_site(site)
         self.url_test(url, False)
         # Check if trigger file was created
         self.assertTrue(os.path.exists(trigger_file))
@@ -163,10 +360,9 @@ class TestAlive(unittest.TestCase):
         # First create a site object with an invalid url and set it to be up
         site = self.get_a_site(url)
         site.set_down(False)
-        config = site.get_config()
         # Now add a trigger
-        config[0].set(url, "down_trigger", "touch %s; touch %s" % (trigger_file, trigger_file_2))
-        self.alive.write_config(config[0])
+        site.set_option("down_trigger", "touch %s; touch %s" % (trigger_file, trigger_file_2))
+        self.save_site(site)
         self.url_test(url, False)
         # Check if trigger file was created
         self.assertTrue(os.path.exists(trigger_file))
@@ -204,6 +400,1254 @@ class TestAlive(unittest.TestCase):
     def test_permission_check_non_existing(self):
         self.alive.permission_check("pqaiweufhnqa")
 
+    def test_http_probe_codes(self):
+        server = LocalServer()
+        try:
+            self.url_test(server.url("/ok"), True)
+            self.url_test(server.url("/redirect"), True, 2)
+            self.url_test(server.url("/nohead"), True, 3)
+            # An authentication failure means the site is alive
+            self.url_test(server.url("/auth"), True, 4)
+            self.url_test(server.url("/missing"), False, 5)
+            self.url_test(server.url("/broken"), False, 6)
+        finally:
+            server.stop()
+
+    def test_http_probe_refused(self):
+        server = LocalServer()
+        url = server.url("/ok")
+        server.stop()
+        self.url_test(url, False)
+
+    def test_http_probe_keep_alive(self):
+        server = LocalServer()
+        try:
+            site = self.get_a_site(server.url("/ok"))
+            probe = HttpProbe(self.alive)
+            for _ in range(5):
+                self.assertEqual(probe.check(site), Result.OK)
+            probe.close()
+            self.assertEqual(server.connections, 1)
+        finally:
+            server.stop()
+
+    def test_wget_backend(self):
+        server = LocalServer()
+        try:
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "-b", "wget", "--tries", "1", "-u",
+                        server.url("/ok") + " " + server.url("/missing")]
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            self.alive.check_urls(config, urls)
+            self.assertFalse(config.getboolean(server.url("/ok"), "down"))
+            self.assertTrue(config.getboolean(server.url("/missing"), "down"))
+        finally:
+            server.stop()
+
+    def mode_test(self, *extra):
+        server = LocalServer()
+        try:
+            up = [server.url("/ok?%d" % i) for i in range(6)]
+            down = [server.url("/missing?%d" % i) for i in range(4)]
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "-m", "asyncio", "--concurrency", "3",
+                        "--tries", "1", "-u", " ".join(up + down)] + list(extra)
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            self.alive.check_urls(config, urls)
+            for url in up:
+                self.assertFalse(config.getboolean(url, "down"))
+            for url in down:
+                self.assertTrue(config.getboolean(url, "down"))
+        finally:
+            server.stop()
+
+    def strict_test(self, *extra):
+        server = LocalServer()
+        stdout = sys.stdout
+        try:
+            delays = ["0.6", "0.1", "0.4", "0.2"]
+            urls = [server.url("/sleep?" + delay) for delay in delays]
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-n", "-s", "-u", " ".join(urls)] + list(extra)
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            sys.stdout = StringIO()
+            self.alive.check_urls(config, urls)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            server.stop()
+        self.assertEqual(re.findall(r"sleep\?([0-9.]+)", output), sorted(delays))
+
+    def test_strict_order(self):
+        self.strict_test()
+
+    def test_strict_order_asyncio(self):
+        # With a concurrency of two some checks only start when others have finished
+        self.strict_test("-m", "asyncio", "--concurrency", "2")
+
+    def test_asyncio_mode(self):
+        self.mode_test()
+
+    def test_asyncio_mode_wget(self):
+        self.mode_test("-b", "wget")
+
+    def test_asyncio_mode_wget_executor(self):
+        # As on Python 3.6 and 3.7, where wget is run by the executor
+        alive.WgetProbe.ASYNC_CHILDREN = False
+        try:
+            self.mode_test("-b", "wget")
+        finally:
+            alive.WgetProbe.ASYNC_CHILDREN = sys.version_info >= (3, 8)
+
+    def test_asyncio_mode_strict(self):
+        self.mode_test("-s")
+
+    def test_daemon(self):
+        server = LocalServer()
+        try:
+            fast = server.url("/ok?fast")
+            slow = server.url("/ok?slow")
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "--daemon", "--interval", "0.2",
+                        "--flush-interval", "0.5", "-u", fast]
+            self.alive.parse_command_line_options()
+            (config, _) = self.alive.setup()
+            config.add_section(slow)
+            config.set(slow, "interval", "100")
+            self.alive.write_config(config)
+            # Known and given with -u, still checked once per interval
+            self.alive.options.URL += " " + slow
+            (config, urls) = self.alive.setup()
+            self.assertEqual(urls, [fast, slow])
+            timer = threading.Timer(1.5, self.alive.stop)
+            timer.start()
+            updates = []
+            update_due = Site.update_due
+            Site.update_due = lambda site, *args: updates.append(site.get_url()) or update_due(site, *args)
+            try:
+                self.alive.run_daemon(config, urls + [slow])
+            finally:
+                Site.update_due = update_due
+            timer.join()
+            self.assertTrue(server.requests.count("/ok?fast") >= 4)
+            # The due time is set once per check, a check running at the stop is not reported
+            self.assertTrue(0 < len(updates) <= len(server.requests))
+            self.assertEqual(server.requests.count("/ok?slow"), 1)
+            (config, urls) = self.alive.setup()
+            self.assertFalse(config.getboolean(fast, "down"))
+        finally:
+            server.stop()
+
+    def test_config_written_atomically(self):
+        site = self.get_a_site()
+        site.set_down(True)
+        self.save_site(site)
+        self.assertFalse(os.path.exists(self.configfile + ".tmp"))
+        (config, _) = self.alive.setup()
+        self.assertTrue(config.getboolean("www.test.com", "down"))
+
+    def test_sqlite_state(self):
+        server = LocalServer()
+        try:
+            url = server.url("/ok")
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "--state", "sqlite", "-u", url]
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            self.alive.check_urls(config, urls)
+            # The changes are in the database without saving the config
+            self.alive.close_store()
+            (config, _) = self.alive.setup()
+            self.assertFalse(config.getboolean(url, "down"))
+            self.assertFalse(os.path.exists(self.configfile))
+            self.assertTrue(os.path.exists(self.configfile + ".db"))
+        finally:
+            server.stop()
+
+    def test_sqlite_import_export(self):
+        site = self.get_a_site()
+        site.set_down(True)
+        site.set_option("up_trigger", "touch up")
+        self.save_site(site)
+
+        sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "--state", "sqlite", "--import", self.configfile]
+        self.alive.parse_command_line_options()
+        (config, _) = self.alive.setup()
+        self.alive.import_config(config, self.configfile)
+
+        sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "--state", "sqlite", "--export", self.configfile + ".exported"]
+        self.alive.parse_command_line_options()
+        (config, _) = self.alive.setup()
+        self.assertTrue(config.getboolean("www.test.com", "down"))
+        config.remove_option("www.test.com", "up_trigger")
+        self.alive.write_config(config)
+        self.alive.export_config(config, self.configfile + ".exported")
+
+        with open(self.configfile + ".exported") as exported:
+            content = exported.read()
+        self.assertTrue("[www.test.com]" in content)
+        self.assertTrue("down = yes" in content)
+        self.assertFalse("up_trigger" in content)
+
+    def test_latency_history(self):
+        history = LatencyHistory(4)
+        self.assertEqual(history.percentile(50), None)
+        for i in range(1, 7):
+            history.add(i / 10.0, i % 2)
+        # Only the last four are kept
+        self.assertEqual(len(history), 4)
+        self.assertEqual([code for _, code in history.entries()], [1, 0, 1, 0])
+        self.assertAlmostEqual(history.percentile(50), 0.4)
+        self.assertAlmostEqual(history.percentile(99), 0.6)
+        decoded = LatencyHistory.decode(history.encode(), 3)
+        self.assertEqual(len(decoded), 3)
+        self.assertAlmostEqual(decoded.percentile(1), 0.4)
+
+    def test_latency_history_persisted(self):
+        server = LocalServer()
+        stdout = sys.stdout
+        try:
+            url = server.url("/ok")
+            for _ in range(3):
+                self.url_test(url, True)
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-n", "-p"]
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            self.assertEqual(len(config.get(url, "history").split()), 3)
+            sys.stdout = StringIO()
+            self.alive.print_percentiles(config, urls)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            server.stop()
+        self.assertTrue(re.search(re.escape(url) + r" +3 ", output))
+
+    def mail_test(self, *extra):
+        server = LocalServer()
+        smtp = LocalSmtpServer()
+        try:
+            urls = [server.url("/missing?%d" % i) for i in range(3)]
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "--tries", "1", "-t", "to@localhost",
+                        "-f", "from@localhost", "--smtp", smtp.address(), "-u", " ".join(urls)] + list(extra)
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            self.alive.check_urls(config, urls)
+            return urls, smtp
+        finally:
+            smtp.stop()
+            server.stop()
+
+    def test_mail_one_session(self):
+        urls, smtp = self.mail_test()
+        self.assertEqual(smtp.connections, 1)
+        self.assertEqual(len(smtp.messages), 3)
+
+    def test_mail_digest(self):
+        urls, smtp = self.mail_test("--digest")
+        self.assertEqual(smtp.connections, 1)
+        self.assertEqual(len(smtp.messages), 1)
+        self.assertTrue("3 sites changed state" in smtp.messages[0])
+        for url in urls:
+            self.assertTrue(url in smtp.messages[0])
+
+    def test_mail_digest_window(self):
+        urls, smtp = self.mail_test("--digest-window", "30")
+        self.assertEqual(len(smtp.messages), 1)
+
+    def test_mail_failed(self):
+        server = LocalServer()
+        try:
+            url = server.url("/missing")
+            argv = [sys.argv[0], "-c", self.configfile, "-q", "--tries", "1", "-t", "to@localhost", "-f", "from@localhost",
+                    "--smtp", "127.0.0.1:%d" % self.closed_port(), "-u", url]
+            self.capture_run(argv)
+            # Not saved as down, so the next run mails the change
+            (config, _) = self.alive.setup()
+            self.assertFalse(config.getboolean(url, "down"))
+
+            smtp = LocalSmtpServer()
+            try:
+                argv[argv.index("--smtp") + 1] = smtp.address()
+                self.capture_run(argv)
+            finally:
+                smtp.stop()
+            self.assertEqual(len(smtp.messages), 1)
+            (config, _) = self.alive.setup()
+            self.assertTrue(config.getboolean(url, "down"))
+        finally:
+            server.stop()
+
+    def trigger_test(self, trigger, *extra):
+        server = LocalServer()
+        try:
+            url = server.url("/missing")
+            site = self.get_a_site(url)
+            site.set_option("down_trigger", trigger)
+            self.save_site(site)
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "--tries", "1", "-u", url] + list(extra)
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            start = time.time()
+            self.alive.check_urls(config, urls)
+            return config.get(url, "trigger_status"), time.time() - start
+        finally:
+            server.stop()
+
+    def test_trigger_status(self):
+        status, _ = self.trigger_test("exit 3")
+        self.assertEqual(status, "3")
+
+    def test_trigger_timeout(self):
+        trigger_file = "timeout_trigger"
+        status, took = self.trigger_test("sleep 5; touch %s" % trigger_file, "--trigger-timeout", "0.5")
+        self.assertEqual(status, "timeout")
+        self.assertTrue(took < 4)
+        time.sleep(0.1)
+        self.assertFalse(os.path.exists(trigger_file))
+
+    def test_trigger_deadline(self):
+        # The trigger still running at the deadline is killed and recorded
+        status, took = self.trigger_test("sleep 5", "--deadline", "1")
+        self.assertEqual(status, "deadline")
+        self.assertTrue(took < 4)
+
+    def test_resolver_cache(self):
+        lookups = []
+        getaddrinfo = socket.getaddrinfo
+
+        def counting_getaddrinfo(host, *args):
+            lookups.append(host)
+            if host == "nxdomain.invalid":
+                raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+            return getaddrinfo("127.0.0.1", *args)
+
+        alive.socket.getaddrinfo = counting_getaddrinfo
+        try:
+            resolver = ResolverCache(300, 60)
+            for _ in range(3):
+                self.assertTrue(resolver.resolve("example.test", 80))
+                self.assertRaises(socket.gaierror, resolver.resolve, "nxdomain.invalid", 80)
+            self.assertEqual(lookups, ["example.test", "nxdomain.invalid"])
+            # Without negative caching the missing name is looked up every time
+            resolver = ResolverCache(300, 0)
+            for _ in range(2):
+                self.assertRaises(socket.gaierror, resolver.resolve, "nxdomain.invalid", 80)
+            self.assertEqual(lookups.count("nxdomain.invalid"), 3)
+            # Only the missing names are cached
+            sys.argv = [sys.argv[0], "--dns-ttl", "0", "--dns-negative-ttl", "60"]
+            self.alive.parse_command_line_options()
+            resolver = self.alive.get_resolver()
+            for _ in range(2):
+                self.assertTrue(resolver.resolve("example.test", 80))
+                self.assertRaises(socket.gaierror, resolver.resolve, "nxdomain.invalid", 80)
+            self.assertEqual((lookups.count("example.test"), lookups.count("nxdomain.invalid")), (3, 4))
+        finally:
+            alive.socket.getaddrinfo = getaddrinfo
+
+    def test_resolver_cache_shared(self):
+        server = LocalServer()
+        lookups = []
+        getaddrinfo = socket.getaddrinfo
+
+        def counting_getaddrinfo(*args):
+            lookups.append(args[0])
+            return getaddrinfo(*args)
+
+        alive.socket.getaddrinfo = counting_getaddrinfo
+        try:
+            urls = [server.url("/ok?%d" % i) for i in range(5)]
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "-u", " ".join(urls)]
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            self.alive.check_urls(config, urls)
+            for url in urls:
+                self.assertFalse(config.getboolean(url, "down"))
+            self.assertEqual(lookups, ["127.0.0.1"])
+        finally:
+            alive.socket.getaddrinfo = getaddrinfo
+            server.stop()
+
+    def test_benchmark(self):
+        import alive_bench
+        fleet = alive_bench.Fleet(20, hosts=2, latency="uniform:0:0.01", error_rate=1.0)
+        try:
+            result = alive_bench.run_benchmark(fleet.urls(), mode="asyncio", concurrency=5)
+        finally:
+            fleet.stop()
+        self.assertEqual(result["checks"], 20)
+        self.assertEqual(result["down"], 20)
+        self.assertTrue(result["rate"] > 0)
+        self.assertTrue(result["threads"] >= 1)
+        self.assertEqual(alive_bench.compare([result], [dict(result, rate=result["rate"] * 2)], 0.2),
+                         ["asyncio/http: %.1f checks/s, baseline %.1f" % (result["rate"], result["rate"] * 2)])
+
+    def test_memory_benchmark(self):
+        import alive_bench
+        if alive_bench.tracemalloc is None:
+            self.skipTest("tracemalloc is not available")
+        results = alive_bench.memory_benchmark(100)
+        self.assertEqual([res["command"] for res in results], ["state", "sites"])
+        self.assertTrue(all(res["bytes"] > 0 for res in results))
+
+    def test_startup_benchmark(self):
+        import alive_bench
+        results = alive_bench.startup_benchmark(runs=1, sites=10)
+        self.assertEqual([res["command"] for res in results], ["import", "list"])
+        self.assertTrue(all(res["min"] > 0 for res in results))
+        slower = [dict(res, median=res["median"] / 2) for res in results]
+        self.assertEqual(len(alive_bench.compare_startup(results, slower, 0.2)), 2)
+
+    def test_redirect_ipv6(self):
+        class LocalServer6(LocalServer):
+            address_family = socket.AF_INET6
+
+            def __init__(self):
+                HTTPServer.__init__(self, ("::1", 0), LocalHandler)
+                self.connections = 0
+                self.requests = []
+                self.lock = threading.Lock()
+                self.active = 0
+                self.max_active = 0
+                self.thread = threading.Thread(target=self.serve_forever)
+                self.thread.daemon = True
+                self.thread.start()
+
+        try:
+            server = LocalServer6()
+        except (socket.error, ValueError):
+            self.skipTest("no IPv6 loopback")
+        try:
+            # The relative location is resolved against the URL with its brackets
+            site = self.get_a_site("http://[::1]:%d/redirect" % server.server_address[1])
+            site.check_alive()
+            self.assertEqual(site.get_res(), Result.OK)
+            self.assertEqual(server.requests, ["/redirect", "/ok"])
+        finally:
+            server.stop()
+
+    def test_check_phases(self):
+        server = LocalServer()
+        try:
+            site = self.get_a_site(server.url("/redirect"))
+            site.check_alive()
+            phases = site.get_phases()
+            self.assertEqual(site.get_res(), Result.OK)
+            self.assertEqual(sorted(phases), ["connect", "dns", "retries", "tls", "ttfb"])
+            self.assertEqual(phases["retries"], 0)
+            self.assertEqual(phases["tls"], 0)
+            self.assertTrue(phases["ttfb"] > 0)
+            self.assertTrue(sum(phases.values()) <= site.get_time_spent())
+        finally:
+            server.stop()
+
+    def test_metrics_file(self):
+        server = LocalServer()
+        metrics_file = self.configfile + ".prom"
+        try:
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "--tries", "2", "--metrics-file", metrics_file,
+                        "-u", server.url("/ok") + " " + server.url("/missing")]
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            self.alive.check_urls(config, urls)
+            with open(metrics_file) as metrics:
+                content = metrics.read()
+        finally:
+            server.stop()
+            os.remove(metrics_file)
+        self.assertTrue('alive_checks_total{result="0"} 1\n' in content)
+        self.assertTrue('alive_checks_total{result="8"} 1\n' in content)
+        self.assertTrue("alive_checks_in_flight 0\n" in content)
+        self.assertTrue("alive_runs_total 1\n" in content)
+        self.assertTrue("alive_queue_wait_seconds_count 2\n" in content)
+        self.assertTrue('alive_check_phase_seconds_count{phase="connect"} 2\n' in content)
+
+    def test_metrics_server(self):
+        sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "--daemon", "--metrics-port", "0"]
+        self.alive.parse_command_line_options()
+        server = self.alive.start_metrics_server()
+        try:
+            conn = alive.httplib.HTTPConnection("127.0.0.1", server.server_address[1])
+            conn.request("GET", "/metrics")
+            response = conn.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertTrue(b"alive_checks_in_flight 0" in response.read())
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_adaptive_timeout(self):
+        sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "-k", "-a", "--min-timeout", "0.1"]
+        self.alive.parse_command_line_options()
+        site = Site("www.test.com", self.alive, {"history": "0.050:0 0.100:6 0.080:0 9.000:4 0.060:0"})
+        self.assertAlmostEqual(site.get_timeout(40), 0.4)
+        # The timeout option wins
+        site.set_option("timeout", "2.5")
+        self.assertEqual(site.get_timeout(40), 2.5)
+        # Not enough history
+        site = Site("www.other.com", self.alive, {"history": "0.050:0"})
+        self.assertEqual(site.get_timeout(40), 40)
+
+    def test_backoff(self):
+        server = LocalServer()
+        try:
+            url = server.url("/missing")
+            argv = [sys.argv[0], "-c", self.configfile, "-q", "-a", "--tries", "1", "-u", url]
+            for _ in range(3):
+                sys.argv = argv
+                self.alive.parse_command_line_options()
+                (config, urls) = self.alive.setup()
+                self.alive.check_urls(config, urls)
+                self.alive.write_config(config)
+            # Only the first run checked it
+            self.assertEqual(len(server.requests), 1)
+            self.assertEqual(config.getint(url, "failures"), 1)
+            self.assertTrue(config.getint(url, "next_check") > time.time() + 50)
+
+            config.set(url, "backoff", "no")
+            self.alive.write_config(config)
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            self.alive.check_urls(config, urls)
+            self.assertEqual(len(server.requests), 2)
+            self.assertEqual(config.getint(url, "failures"), 2)
+            self.assertTrue(config.getint(url, "next_check") > time.time() + 110)
+        finally:
+            server.stop()
+
+    def test_hash_ring(self):
+        urls = ["http://site%d.example.com/" % i for i in range(3000)]
+        ring = HashRing(3)
+        counts = [0, 0, 0]
+        for url in urls:
+            counts[ring.shard(url)] += 1
+        for count in counts:
+            self.assertTrue(700 < count < 1300, counts)
+        # A new shard only takes URLs, the others stay where they were
+        bigger = HashRing(4)
+        moved = [url for url in urls if bigger.shard(url) != ring.shard(url)]
+        self.assertTrue(all(bigger.shard(url) == 3 for url in moved))
+        self.assertTrue(len(moved) < len(urls) / 2)
+
+    def test_shards(self):
+        server = LocalServer()
+        try:
+            urls = [server.url("/ok?%d" % i) for i in range(6)] + [server.url("/missing")]
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "--state", "sqlite", "--shards", "2",
+                        "-u", " ".join(urls)]
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            self.alive.run_coordinator(config, urls)
+            self.alive.write_config(config)
+            self.assertEqual(len(server.requests), 7)
+            for url in urls[:-1]:
+                self.assertFalse(config.getboolean(url, "down"))
+            self.assertTrue(config.getboolean(urls[-1], "down"))
+            self.assertTrue(os.path.exists(os.path.join(self.configfile + "_shards", "shard-1-of-2.json")))
+        finally:
+            server.stop()
+
+    def test_shards_deadline(self):
+        server = LocalServer()
+        try:
+            fast, slow = server.url("/ok"), server.url("/sleep?4")
+            start = time.time()
+            output = self.capture_run([sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--tries", "1",
+                                       "--shards", "2", "--deadline", "1", "-u", fast + " " + slow],
+                                      self.alive.run_coordinator)
+            self.assertTrue(time.time() - start < 4)
+            records = dict((record["url"], record) for record in map(json.loads, output.splitlines()))
+            self.assertEqual((records[fast]["state"], records[slow]["state"]), ("up", "unknown"))
+        finally:
+            server.stop()
+
+        sys.argv = [sys.argv[0], "-c", self.configfile, "--shards", "2", "--strict", "-u", fast]
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.assertRaises(SystemExit, self.alive.parse_command_line_options)
+        finally:
+            sys.stderr = stderr
+
+    def test_remote_workers_clock_skew(self):
+        url = "http://127.0.0.1:1/"
+        directory = self.configfile + "_shards"
+        os.makedirs(directory)
+        shardfile = os.path.join(directory, "shard-0-of-1.json")
+
+        def write_results():
+            # Written by a worker whose clock is an hour behind
+            with open(shardfile, "w") as results:
+                results.write(json.dumps({"url": url, "res": 0, "time": 0.5, "phases": None}) + "\n")
+            os.utime(shardfile, (time.time() - 3600, time.time() - 3600))
+
+        timer = threading.Timer(0.3, write_results)
+        timer.start()
+        output = self.capture_run([sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--shards", "1",
+                                   "--remote-workers", "--shard-wait", "5", "-u", url], self.alive.run_coordinator)
+        timer.join()
+        self.assertEqual(json.loads(output)["state"], "up")
+
+    def test_site_locks_shared_byte(self):
+        class SharedByte(alive.SiteLocks):
+            def offset(self, url):
+                return 7
+
+        def locked_elsewhere():
+            return subprocess.check_output([sys.executable, "-c", "import fcntl, os, sys\n"
+                                            "fd = os.open(sys.argv[1], os.O_RDWR)\n"
+                                            "try:\n    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, 7)\n"
+                                            "except (IOError, OSError):\n    print('locked')",
+                                            self.configfile + "_lock"]).strip() == b"locked"
+
+        locks = SharedByte(self.configfile + "_lock")
+        try:
+            self.assertTrue(locks.claim("http://a.test/") and locks.claim("http://b.test/"))
+            # Releasing one site keeps the byte of the other locked
+            locks.release("http://a.test/")
+            self.assertTrue(locked_elsewhere())
+            locks.release("http://b.test/")
+            self.assertFalse(locked_elsewhere())
+        finally:
+            locks.close()
+
+    def test_site_locks_slots(self):
+        # Many sites take no more than SLOTS locks, so claiming them stays fast
+        urls = ["http://site%d.test/" % i for i in range(20000)]
+        locks = alive.SiteLocks(self.configfile + "_lock")
+        try:
+            self.assertTrue(all(1 <= locks.offset(url) <= alive.SiteLocks.SLOTS for url in urls))
+            start = time.time()
+            self.assertTrue(all(locks.claim(url) for url in urls))
+            for url in urls:
+                locks.start_check(url)
+            self.assertTrue(time.time() - start < 5)
+            self.assertEqual(len(locks.get_claimed()), len(urls))
+        finally:
+            locks.close()
+
+    def locked_test(self, state):
+        server = LocalServer()
+        # Another process claims the first site
+        holder = subprocess.Popen([sys.executable, "-c", "import sys, alive; locks = alive.SiteLocks(sys.argv[1]); "
+                                   "print(locks.claim(sys.argv[2])); sys.stdout.flush(); sys.stdin.read()",
+                                   self.configfile + "_lock", server.url("/missing")],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            self.assertEqual(holder.stdout.readline().strip(), b"True")
+            busy, free = server.url("/missing"), server.url("/ok")
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-n", "--state", state, "-u", busy + " " + free]
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            output = StringIO()
+            stdout, sys.stdout = sys.stdout, output
+            try:
+                self.alive.lock_sites(urls)
+                self.alive.check_urls(config, urls)
+            finally:
+                sys.stdout = stdout
+            # Both are checked, only the claimed one is saved
+            self.assertEqual(len(server.requests), 2)
+            self.assertTrue("1 sites are claimed by another run" in output.getvalue())
+            self.assertTrue("Claimed by another run" in output.getvalue())
+
+            # Meanwhile the other run saved its site
+            other = Alive()
+            other.parse_command_line_options()
+            (other_config, _) = other.setup()
+            other_config.add_section(busy)
+            other_config.set(busy, "down", "yes")
+            other.write_config(other_config)
+            other.close_store()
+
+            self.alive.write_config(config)
+            self.alive.close_store()
+            self.alive.close_locks()
+            (config, _) = self.alive.setup()
+            self.assertTrue(config.getboolean(busy, "down"))
+            self.assertFalse(config.getboolean(free, "down"))
+        finally:
+            holder.communicate()
+            server.stop()
+
+    def test_site_locks(self):
+        self.locked_test("cfg")
+
+    def test_site_locks_sqlite(self):
+        self.locked_test("sqlite")
+
+    def due_test(self, state):
+        server = LocalServer()
+        try:
+            later, up, down = server.url("/ok"), server.url("/ok?2"), server.url("/missing")
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "--state", state, "-u", " ".join((later, up, down))]
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            self.alive.check_urls(config, urls)
+            self.assertTrue(config.getfloat(later, "next_due") > time.time())
+
+            # The up site has been due the longest but the down site goes first
+            config.set(up, "next_due", "50")
+            config.set(down, "next_due", "100")
+            self.alive.write_config(config)
+            self.alive.close_store()
+            del server.requests[:]
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "--state", state, "--due"]
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            self.assertEqual(urls, [up, down])
+            # Only the due sites are loaded and saved
+            self.assertEqual(sorted(config.sections()), sorted([up, down]))
+            self.assertEqual([site.get_url() for site in self.alive.create_sites(config, urls)], [down, up])
+            self.alive.check_urls(config, urls)
+            self.alive.write_config(config)
+            self.alive.close_store()
+            self.assertEqual(sorted(server.requests), ["/missing", "/ok?2"])
+
+            # Nothing is due now
+            (config, urls) = self.alive.setup()
+            self.assertEqual(urls, [])
+            self.assertEqual(sorted(self.alive.get_store().load().sections()), sorted([later, up, down]))
+        finally:
+            server.stop()
+
+    def test_due(self):
+        self.due_test("cfg")
+
+    def test_due_sqlite(self):
+        self.due_test("sqlite")
+
+    def test_due_priority(self):
+        site = self.get_a_site()
+        self.assertEqual(site.get_priority(), 3)
+        history = site.get_history()
+        for duration in (0.1, 0.12, 0.1, 0.11, 0.3, 0.35, 0.4):
+            history.add(duration, Result.OK)
+        self.assertEqual(site.get_priority(), 2)
+        site.set_down(True)
+        self.assertEqual(site.get_priority(), 0)
+
+    def expect_test(self, *extra):
+        server = LocalServer()
+        try:
+            url = server.url("/page")
+            expects = {"start": "expect = Welcome", "regex": "expect_regex = W[el]+come",
+                       "end": "expect = Footer", "limit": "expect = Footer\nexpect_limit = 2000000",
+                       "wrong": "expect = Maintenance"}
+            with open(self.configfile, "w") as configfile:
+                for name, option in sorted(expects.items()):
+                    configfile.write("[%s?%s]\n%s\n\n" % (url, name, option))
+            output = self.capture_run([sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--tries", "1", "-k"]
+                                      + list(extra))
+            results = dict((json.loads(line)["url"].split("?")[1], json.loads(line)["result"])
+                           for line in output.splitlines())
+            self.assertEqual(results, {"start": Result.OK, "regex": Result.OK, "end": Result.CONTENT,
+                                       "limit": Result.OK, "wrong": Result.CONTENT})
+        finally:
+            server.stop()
+
+    def test_expect(self):
+        self.expect_test()
+
+    def test_expect_wget(self):
+        self.expect_test("-b", "wget")
+
+    def test_expect_wget_asyncio(self):
+        self.expect_test("-b", "wget", "-m", "asyncio")
+
+    def probe_test(self, sites, *extra):
+        """Check the {url: options} sites and return {url: (result, record)}"""
+        with open(self.configfile, "w") as configfile:
+            for url, options in sorted(sites.items()):
+                configfile.write("[%s]\n%s\n\n" % (url, options))
+        output = self.capture_run([sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--tries", "1", "-k"]
+                                  + list(extra))
+        records = [json.loads(line) for line in output.splitlines()]
+        return dict((record["url"], (record["result"], record)) for record in records)
+
+    @staticmethod
+    def closed_port():
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def test_tcp_probe(self):
+        server = LocalServer()
+        try:
+            port, closed = server.server_address[1], self.closed_port()
+            results = self.probe_test({"tcp://127.0.0.1:%d" % port: "probe = tcp",
+                                       "127.0.0.1:%d" % closed: "probe = tcp",
+                                       "tcp://127.0.0.1": "probe = tcp"})
+            self.assertEqual(results["tcp://127.0.0.1:%d" % port][0], Result.OK)
+            self.assertEqual(results["127.0.0.1:%d" % closed][0], Result.NETWORK)
+            # No port to connect to
+            self.assertEqual(results["tcp://127.0.0.1"][0], Result.GENERIC)
+            # Only connected, nothing was requested
+            self.assertEqual(server.requests, [])
+        finally:
+            server.stop()
+
+    def test_tls_probe(self):
+        certfile = self.configfile + ".pem"
+        try:
+            subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-subj", "/CN=localhost",
+                                   "-days", "30", "-keyout", certfile, "-out", certfile],
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest("openssl is needed to make a certificate")
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile)
+        os.remove(certfile)
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+
+        def serve():
+            while True:
+                try:
+                    conn = listener.accept()[0]
+                except (OSError, socket.error):
+                    return
+                try:
+                    context.wrap_socket(conn, server_side=True).close()
+                except (ssl.SSLError, OSError, socket.error):
+                    conn.close()
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = "tls://127.0.0.1:%d" % listener.getsockname()[1]
+            plain = LocalServer()
+            try:
+                results = self.probe_test({url: "probe = tls", plain.url("/"): "probe = tls"}, "-m", "asyncio")
+            finally:
+                plain.stop()
+            res, record = results[url]
+            self.assertEqual(res, Result.OK)
+            self.assertTrue(abs(record["cert_expires"] - (time.time() + 30 * 86400)) < 86400)
+            # The handshake fails against a plain http server
+            self.assertEqual(results[plain.url("/")][0], Result.SSL)
+            (config, _) = self.alive.setup()
+            self.assertEqual(config.getint(url, "cert_expires"), record["cert_expires"])
+        finally:
+            listener.close()
+
+    def group_test(self, *extra):
+        server = LocalServer()
+        try:
+            ok, missing, slow = server.url("/ok"), server.url("/missing"), server.url("/sleep?5")
+            groups = {"group:any": "members = %s %s" % (slow, ok),
+                      "group:quorum": "members = %s %s?2 %s\nquorum = 2" % (missing, missing, slow),
+                      "group:empty": "quorum = 1"}
+            start = time.time()
+            results = self.probe_test(groups, *extra)
+            # Decided without waiting for the slow member
+            self.assertTrue(time.time() - start < 4)
+            self.assertEqual(results["group:any"][0], Result.OK)
+            self.assertEqual(results["group:quorum"][0], Result.SERVER)
+            self.assertEqual(results["group:empty"][0], Result.GENERIC)
+            # The checks of the slow members were cancelled
+            deadline = time.time() + 2
+            while time.time() < deadline and any(" member " in thread.name for thread in threading.enumerate()):
+                time.sleep(0.05)
+            self.assertEqual([thread.name for thread in threading.enumerate() if " member " in thread.name], [])
+        finally:
+            server.stop()
+
+    def test_group(self):
+        self.group_test()
+
+    def test_group_wget_asyncio(self):
+        self.group_test("-b", "wget", "-m", "asyncio")
+
+    def test_group_per_host(self):
+        server = LocalServer()
+        try:
+            members = " ".join(server.url("/sleep?0.1&%d" % i) for i in range(4))
+            results = self.probe_test({"group:all": "members = %s\nquorum = 4" % members}, "--per-host", "1")
+            self.assertEqual(results["group:all"][0], Result.OK)
+            self.assertEqual(server.max_active, 1)
+        finally:
+            server.stop()
+
+    def test_cancel_pooled_socket(self):
+        running = alive.RunningChecks()
+        left, right = socket.socketpair()
+
+        def check(site):
+            alive.RunningChecks.add_current(left)
+            # Handed back to the pool, cancelling the check leaves it alone
+            self.assertTrue(alive.RunningChecks.remove_current(left))
+            running.cancel(site)
+            self.assertFalse(alive.RunningChecks.remove_current(right))
+            return Result.OK
+
+        try:
+            self.assertEqual(running.call(self.get_a_site(), check), Result.OK)
+            left.sendall(b"x")
+            self.assertEqual(right.recv(1), b"x")
+        finally:
+            left.close()
+            right.close()
+
+    def deadline_test(self, *extra):
+        server = LocalServer()
+        try:
+            ok, slow, new = server.url("/ok"), server.url("/sleep?4"), server.url("/sleep?4&2")
+            with open(self.configfile, "w") as configfile:
+                configfile.write("[%s]\n\n[%s]\ndown = no\ntime = 100\nnext_due = 200\n\n" % (ok, slow))
+            start = time.time()
+            output = self.capture_run([sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--tries", "1", "-k",
+                                       "--deadline", "1", "-u", new] + list(extra))
+            self.assertTrue(time.time() - start < 3)
+            records = dict((record["url"], record) for record in map(json.loads, output.splitlines()))
+            self.assertEqual(records[ok]["state"], "up")
+            self.assertEqual((records[slow]["state"], records[slow]["previous"], records[slow]["changed"]),
+                             ("unknown", "up", False))
+            self.assertEqual((records[new]["state"], records[new]["previous"]), ("unknown", None))
+
+            # The state is kept and the unfinished sites go first next time
+            (config, _) = self.alive.setup()
+            self.assertFalse(config.getboolean(slow, "down"))
+            self.assertEqual(config.getint(slow, "time"), 100)
+            self.assertEqual(config.getfloat(slow, "next_due"), 0)
+            self.assertTrue(config.getboolean(slow, "unfinished"))
+            self.assertTrue(config.getfloat(ok, "next_due") > time.time())
+            self.assertFalse(config.has_option(ok, "unfinished"))
+            sites = self.alive.create_sites(config, [ok, slow, new])
+            self.assertEqual([site.get_url() for site in sites], [slow, new, ok])
+            # A site saved before next_due was kept is not taken for an unfinished one
+            self.assertEqual(Site(ok, self.alive, {"down": "no", "time": "100"}).get_priority(), 3)
+            # The mark is cleared once a check finishes
+            sites[0].update_due(time.time(), 60)
+            self.assertEqual(sites[0].get_priority(), 3)
+        finally:
+            server.stop()
+
+    def test_deadline(self):
+        self.deadline_test()
+
+    def test_deadline_asyncio(self):
+        self.deadline_test("-m", "asyncio")
+
+    def test_deadline_wget(self):
+        self.deadline_test("-b", "wget")
+
+    def test_deadline_strict(self):
+        self.deadline_test("--strict")
+
+    def test_deadline_next_run(self):
+        server = LocalServer()
+        try:
+            slow, waiting, ok = server.url("/sleep?3"), server.url("/sleep?3&2"), server.url("/ok")
+            # The second site waits for the host until after the deadline
+            self.capture_run([sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--tries", "1", "--per-host",
+                              "1", "--deadline", "0.5", "-u", slow + " " + waiting])
+            output = self.capture_run([sys.argv[0], "-c", self.configfile, "--format", "jsonl", "-u", ok])
+            time.sleep(0.5)
+            # The cancelled checks are not started later and do not show up in the next run
+            self.assertEqual([json.loads(line)["url"] for line in output.splitlines()], [ok])
+            self.assertFalse("/sleep?3&2" in server.requests)
+            self.assertEqual(SiteThread.results_queue.qsize(), 0)
+        finally:
+            server.stop()
+
+    def input_test(self, *extra):
+        server = LocalServer()
+        try:
+            urls = [server.url("/sleep?0.05&%d" % i) for i in range(40)] + [server.url("/missing")]
+            inputfile = self.configfile + ".input"
+            with open(inputfile, "w") as urlfile:
+                urlfile.write("# inventory\n\n%s\n%s %s\n" % ("\n".join(urls[:-2]), urls[-2], urls[-1]))
+            try:
+                output = self.capture_run([sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--tries", "1",
+                                           "--concurrency", "3", "--input", inputfile] + list(extra),
+                                          self.alive.check_input)
+            finally:
+                os.remove(inputfile)
+            records = [json.loads(line) for line in output.splitlines()]
+            self.assertEqual(sorted(record["url"] for record in records), sorted(urls))
+            # Only --concurrency checks at once, also with threads
+            self.assertTrue(0 < server.max_active <= 3)
+            config = self.alive.get_store().load()
+            self.assertEqual(sorted(config.sections()), sorted(urls))
+            self.assertTrue(config.getboolean(urls[-1], "down"))
+
+            # The state of the sites read is used
+            with open(inputfile, "w") as urlfile:
+                urlfile.write("%s\n" % urls[-1])
+            try:
+                output = self.capture_run([sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--tries", "1",
+                                           "--input", inputfile] + list(extra), self.alive.check_input)
+            finally:
+                os.remove(inputfile)
+            record = json.loads(output)
+            self.assertEqual((record["state"], record["previous"]), ("down", "down"))
+        finally:
+            server.stop()
+
+    def test_input(self):
+        self.input_test()
+
+    def test_input_asyncio(self):
+        self.input_test("-m", "asyncio")
+
+    def test_input_sqlite(self):
+        # Small batches so sites are written, released and forgotten during the run
+        self.alive.SYNC_BATCH = 7
+        self.input_test("--state", "sqlite")
+        # Only the given sites are loaded at the start
+        (config, _) = self.alive.setup()
+        self.assertEqual(config.sections(), [])
+
+    def input_deadline_test(self, *extra):
+        server = LocalServer()
+        try:
+            ok, slow, later = server.url("/ok"), server.url("/sleep?10"), server.url("/sleep?10&2")
+            inputfile = self.configfile + ".input"
+            with open(inputfile, "w") as urlfile:
+                urlfile.write("%s\n%s\n%s\n" % (ok, slow, later))
+            start = time.time()
+            try:
+                output = self.capture_run([sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--tries", "1",
+                                           "--concurrency", "2", "--deadline", "1", "--input", inputfile] + list(extra),
+                                          self.alive.check_input)
+            finally:
+                os.remove(inputfile)
+            self.assertTrue(time.time() - start < 4)
+            records = dict((record["url"], record) for record in map(json.loads, output.splitlines()))
+            self.assertEqual((records[ok]["state"], records[slow]["state"]), ("up", "unknown"))
+            config = self.alive.get_store().load()
+            self.assertTrue(config.getboolean(slow, "unfinished"))
+            self.assertEqual(SiteThread.results_queue.qsize(), 0)
+        finally:
+            server.stop()
+
+    def test_input_deadline(self):
+        self.input_deadline_test()
+
+    def test_input_deadline_sqlite(self):
+        self.input_deadline_test("--state", "sqlite")
+
+    def test_input_deadline_asyncio(self):
+        self.input_deadline_test("-m", "asyncio")
+
+    def test_input_stdin(self):
+        # The first URL is checked before the rest of the input is written
+        server = LocalServer()
+        try:
+            script = os.path.join(os.path.dirname(os.path.abspath(alive.__file__)), "alive.py")
+            checker = subprocess.Popen([sys.executable, script, "-c", self.configfile, "--format", "jsonl", "--input",
+                                        "-"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            checker.stdin.write((server.url("/ok") + "\n").encode())
+            checker.stdin.flush()
+            self.assertEqual(json.loads(checker.stdout.readline().decode())["url"], server.url("/ok"))
+            checker.stdin.write((server.url("/missing") + "\n").encode())
+            checker.stdin.close()
+            self.assertEqual(json.loads(checker.stdout.readline().decode())["state"], "down")
+            checker.wait()
+        finally:
+            server.stop()
+
+    def test_max_age(self):
+        server = LocalServer()
+        try:
+            up, down = server.url("/ok"), server.url("/missing")
+            argv = [sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--tries", "1", "--max-age", "60",
+                    "-u", up + " " + down]
+            records = [json.loads(line) for line in self.capture_run(argv).splitlines()]
+            self.assertFalse(any(record.get("cached") for record in records))
+            self.assertEqual(len(server.requests), 2)
+
+            # Answered from the last check without a request
+            del server.requests[:]
+            records = dict((record["url"], record) for record in map(json.loads, self.capture_run(argv).splitlines()))
+            self.assertEqual(server.requests, [])
+            self.assertEqual((records[up]["state"], records[up]["cached"]), ("up", True))
+            self.assertEqual((records[down]["state"], records[down]["changed"]), ("down", False))
+
+            # Too old, checked again
+            argv[argv.index("60")] = "0"
+            self.capture_run(argv)
+            self.assertEqual(len(server.requests), 2)
+        finally:
+            server.stop()
+
+    def checking_run(self, url):
+        """Another run that claims the site and marks it as being checked until it gets a line"""
+        holder = subprocess.Popen([sys.executable, "-c", "import sys, alive; locks = alive.SiteLocks(sys.argv[1]); "
+                                   "print(locks.claim(sys.argv[2])); locks.start_check(sys.argv[2]); sys.stdout.flush(); "
+                                   "sys.stdin.readline(); locks.end_check(sys.argv[2]); sys.stdin.read()",
+                                   self.configfile + "_lock", url], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.assertEqual(holder.stdout.readline().strip(), b"True")
+        return holder
+
+    def test_max_age_wait(self):
+        server = LocalServer()
+        url = server.url("/ok")
+        with open(self.configfile, "w") as configfile:
+            configfile.write("[%s]\ndown = no\nlast_check = 100 0 0.5\n\n" % url)
+        # Another run is checking the site, saves its result a bit later and keeps its claim
+        holder = self.checking_run(url)
+
+        def finish():
+            with open(self.configfile, "w") as configfile:
+                configfile.write("[%s]\ndown = yes\nlast_check = %d 3 0.25\n\n" % (url, time.time()))
+            holder.stdin.write(b"\n")
+            holder.stdin.flush()
+
+        try:
+            timer = threading.Timer(0.5, finish)
+            timer.start()
+            argv = [sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--max-age", "60", "-u", url]
+            output = self.capture_run(argv, lambda config, urls: (self.alive.lock_sites(urls),
+                                                                  self.alive.check_urls(config, urls)))
+            timer.join()
+            record = json.loads(output.splitlines()[-1])
+            self.assertEqual(server.requests, [])
+            self.assertEqual((record["state"], record["cached"], record["duration"]), ("down", True, 0.25))
+            # Done while the other run still has the site
+            self.assertEqual(holder.poll(), None)
+        finally:
+            holder.stdin.close()
+            holder.wait()
+            server.stop()
+
+    def test_max_age_wait_deadline(self):
+        server = LocalServer()
+        url = server.url("/ok")
+        holder = self.checking_run(url)
+        try:
+            start = time.time()
+            argv = [sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--max-age", "60", "--timeout", "10",
+                    "--deadline", "1", "-u", url]
+            output = self.capture_run(argv, lambda config, urls: (self.alive.lock_sites(urls),
+                                                                  self.alive.check_urls(config, urls)))
+            self.assertTrue(time.time() - start < 3)
+            self.assertFalse(json.loads(output.splitlines()[-1]).get("cached"))
+        finally:
+            holder.stdin.close()
+            holder.wait()
+            server.stop()
+
+    def test_max_age_input_shards(self):
+        server = LocalServer()
+        try:
+            up, down = server.url("/ok"), server.url("/missing")
+            self.capture_run([sys.argv[0], "-c", self.configfile, "-q", "--tries", "1", "-u", up + " " + down])
+            del server.requests[:]
+            inputfile = self.configfile + ".input"
+            with open(inputfile, "w") as urlfile:
+                urlfile.write("%s\n%s\n" % (up, down))
+            try:
+                output = self.capture_run([sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--max-age", "60",
+                                           "--input", inputfile], self.alive.check_input)
+            finally:
+                os.remove(inputfile)
+            records = dict((record["url"], record) for record in map(json.loads, output.splitlines()))
+            self.assertEqual((records[up]["state"], records[up]["cached"]), ("up", True))
+            self.assertEqual((records[down]["state"], records[down]["cached"]), ("down", True))
+            # The workers are given --max-age
+            output = self.capture_run([sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--max-age", "60",
+                                       "--shards", "2", "-u", up + " " + down], self.alive.run_coordinator)
+            records = dict((record["url"], record) for record in map(json.loads, output.splitlines()))
+            self.assertEqual((records[up]["cached"], records[down]["cached"]), (True, True))
+            self.assertEqual(server.requests, [])
+        finally:
+            server.stop()
+
+        # The workers do not read the input
+        sys.argv = [sys.argv[0], "-c", self.configfile, "--max-age", "60", "--shards", "2", "--input", inputfile]
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.assertRaises(SystemExit, self.alive.parse_command_line_options)
+        finally:
+            sys.stderr = stderr
+
+    def test_cert_expires(self):
+        # A certificate cut after the validity, with a GeneralizedTime notAfter
+        validity = b"\x30\x1e\x17\x0d491231235959Z\x18\x0f20500101000000Z"
+        tbs = b"\xa0\x03\x02\x01\x02" + b"\x02\x01\x01" + b"\x30\x00" + b"\x30\x00" + validity
+        cert = b"\x30\x81" + bytearray([len(tbs) + 3]) + b"\x30\x81" + bytearray([len(tbs)]) + tbs
+        self.assertEqual(alive.SocketProbe.cert_expires(bytes(cert)), 2524608000)
+        self.assertEqual(alive.SocketProbe.cert_expires(b"\x30\x05"), None)
+
+    def test_body_matcher(self):
+        matcher = alive.BodyMatcher("needle", limit=20)
+        # Split over two chunks
+        self.assertFalse(matcher.feed(b"hay nee"))
+        self.assertTrue(matcher.feed(b"dle hay"))
+        matcher.reset()
+        self.assertFalse(matcher.feed(b"x" * 18 + b"needle"))
+        self.assertTrue(matcher.is_done())
+
+    def per_host_test(self, *extra):
+        server = LocalServer()
+        try:
+            urls = [server.url("/sleep?0.1&%d" % i) for i in range(8)]
+            sys.argv = [sys.argv[0], "-c", self.configfile, "-q", "--per-host", "2", "-u", " ".join(urls)] + list(extra)
+            self.alive.parse_command_line_options()
+            (config, urls) = self.alive.setup()
+            self.alive.check_urls(config, urls)
+            self.assertEqual(len(server.requests), 8)
+            self.assertEqual(server.max_active, 2)
+            # The host's checks take turns on two keep-alive connections
+            self.assertEqual(server.connections, 2)
+            for url in urls:
+                self.assertFalse(config.getboolean(url, "down"))
+        finally:
+            server.stop()
+
+    def test_per_host(self):
+        self.per_host_test()
+
+    def test_per_host_asyncio(self):
+        self.per_host_test("-m", "asyncio", "--concurrency", "8")
+
+    def capture_run(self, argv, check=None):
+        sys.argv = argv
+        self.alive.parse_command_line_options()
+        (config, urls) = self.alive.setup()
+        output = StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            (check or self.alive.check_urls)(config, urls)
+        finally:
+            sys.stdout = stdout
+        self.alive.write_config(config)
+        return output.getvalue()
+
+    def test_jsonl_format(self):
+        server = LocalServer()
+        try:
+            up, down = server.url("/ok"), server.url("/missing")
+            argv = [sys.argv[0], "-c", self.configfile, "--format", "jsonl", "--output-flush", "0", "--tries", "1",
+                    "-u", up + " " + down]
+            records = [json.loads(line) for line in self.capture_run(argv).splitlines()]
+            self.assertEqual(sorted(record["url"] for record in records), sorted([up, down]))
+            for record in records:
+                self.assertEqual(record["previous"], None)
+                self.assertFalse(record["changed"])
+                self.assertTrue(record["duration"] >= 0)
+            self.assertEqual(dict((record["url"], (record["state"], record["result"])) for record in records),
+                             {up: ("up", Result.OK), down: ("down", Result.SERVER)})
+
+            argv[-1] = down
+            os.rename(self.configfile, self.configfile + ".exported")
+            with open(self.configfile + ".exported") as exported, open(self.configfile, "w") as configfile:
+                configfile.write(exported.read().replace("down = yes", "down = no"))
+            [record] = [json.loads(line) for line in self.capture_run(argv).splitlines()]
+            self.assertEqual((record["state"], record["previous"], record["changed"]), ("down", "up", True))
+        finally:
+            server.stop()
+
+    def test_quiet_without_color(self):
+        server = LocalServer()
+        try:
+            output = self.capture_run([sys.argv[0], "-c", self.configfile, "-q", "-u", server.url("/ok")])
+            self.assertEqual(output, "")
+        finally:
+            server.stop()
+
     # TODO: Should check the Time value, and command line options
 
 
@@ -212,7 +1656,6 @@ def main():
 
     suite = unittest.TestLoader().loadTestsFromTestCase(TestAlive)
     result = unittest.TextTestRunner(verbosity=2).run(suite)
-    os.remove("unittest_test_config" + "_lock")
     sys.exit(0 if result.wasSuccessful() else 1)
 
 if __name__ == "__main__":